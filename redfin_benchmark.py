@@ -0,0 +1,351 @@
+"""Benchmarks for partitioning efficiency, page parsing and SQLite writes.
+
+Every suite returns Result records, written as JSON so that a run can be
+compared against the results of an earlier one:
+
+    python redfin_benchmark.py --output bench.json
+    python redfin_benchmark.py --baseline bench.json --tolerance 0.2
+
+The second run exits with status 1 when any result got worse than the
+baseline by more than the tolerance. Counts, like requests per 1,000
+listings, are deterministic for a given seed; rates depend on the machine.
+
+Suites:
+    split    partition trees of synthetic listing distributions, simulated
+             without HTTP, for the count-aware and the fixed splitting
+    parse    extract_listings, extract_summary and parse_pages on rendered
+             pages, or on pages recorded in an HTTP cache file
+    storage  LISTINGS, page store, LISTING_DETAILS and URLS writes
+    crawl    a whole crawl against the local stand-in server
+"""
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import redfin_crawler
+from redfin_extract import extract_listings, extract_listings_bs4, extract_summary
+from redfin_fake_server import BASE_PATH, PER_PAGE, FakeRedfin, ProxyStub, ServerThread, generate_listings
+from redfin_filters import observe_partition, observe_priors, split_partition
+from redfin_listings import parse_pages
+from redfin_page_store import PageStore
+from redfin_partition import Partition
+from redfin_planner import DensityModel
+from redfin_proxy_pool import ProxyPool
+from redfin_rate_limit import RateScheduler
+from redfin_storage import connect, migrate, save_listing_details, save_listings, save_page_infos
+
+LOGGER = logging.getLogger(__name__)
+
+SUITES = ('split', 'parse', 'storage', 'crawl')
+# name -> (listings, condo towers) of the synthetic distributions.
+DISTRIBUTIONS = collections.OrderedDict([
+    ('spread', (20000, 0)),
+    ('towers', (20000, 4)),
+])
+SIMULATED_BASE_URL = 'https://www.redfin.com' + BASE_PATH
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_REPEAT = 3
+BS4_PAGES = 50
+
+
+class Result(collections.namedtuple('Result', ['name', 'value', 'unit', 'better'])):
+    """One measurement. better is 'higher' or 'lower'."""
+    __slots__ = ()
+
+
+def _best_time(fn, repeat=DEFAULT_REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def simulate_partition(fake, planned=True, max_levels=12):
+    """Partition the listings of fake the way url_partition does, level by level,
+    reading counts straight from fake instead of over HTTP.
+    Return a Counter of partition requests, leaves, leaf pages, page requests
+    (the leaf pages minus the first pages kept from the partition requests),
+    unsplittable partitions and listings covered by leaves.
+    """
+    density = DensityModel()
+    if planned:
+        observe_priors(density)
+    stats = collections.Counter()
+    level, partitions = 0, [Partition(SIMULATED_BASE_URL, ())]
+    while partitions and level < max_levels:
+        results = []
+        for partition in partitions:
+            url = partition.url
+            matches = fake.search(url.partition('/filter/')[2])
+            page_info = redfin_crawler.parse_page_info(url, fake.render(matches, 1))
+            results.append((partition, page_info))
+            stats['partition_requests'] += 1
+        for partition, page_info in results:
+            observe_partition(density, partition, redfin_crawler.property_count(page_info[1:]))
+
+        children = []
+        for partition, page_info in results:
+            url, count, num_pages, per_page = page_info
+            if not redfin_crawler.is_leaf(page_info[1:]) or level == 0:
+                if planned:
+                    limit = num_pages * per_page if num_pages and per_page else None
+                    expanded = split_partition(partition, count=count, limit=limit, density=density)
+                else:
+                    expanded = split_partition(partition)
+                if expanded == [partition]:
+                    stats['unsplittable'] += 1
+                else:
+                    children.extend(expanded)
+                continue
+            pages = redfin_crawler.leaf_page_urls(*page_info)
+            stats['leaves'] += 1
+            stats['leaf_pages'] += len(pages)
+            stats['page_requests'] += max(0, len(pages) - 1) if partition.ranges else len(pages)
+            stats['covered'] += count if count is not None else (per_page or 0)
+        partitions = list(dict.fromkeys(children))
+        level += 1
+    return stats
+
+
+def bench_split(seed=0, max_levels=12):
+    results = []
+    for name, (count, towers) in DISTRIBUTIONS.items():
+        fake = FakeRedfin(generate_listings(count, seed, towers=towers))
+        total = len(fake.listings)
+        for strategy, planned in (('planned', True), ('fixed', False)):
+            stats = simulate_partition(fake, planned, max_levels)
+            prefix = 'split.{}.{}.'.format(name, strategy)
+            results.extend([
+                Result(prefix + 'partition_requests_per_1000', 1000 * stats['partition_requests'] / total,
+                       'requests', 'lower'),
+                Result(prefix + 'requests_per_1000',
+                       1000 * (stats['partition_requests'] + stats['page_requests']) / total, 'requests', 'lower'),
+                Result(prefix + 'leaves', stats['leaves'], 'partitions', 'lower'),
+                Result(prefix + 'recall', min(stats['covered'], total) / total, 'share', 'higher'),
+            ])
+    return results
+
+
+def synthetic_pages(count, seed=0):
+    """Return count (url, html) pages of 20 listings rendered by the stand-in server."""
+    fake = FakeRedfin(generate_listings(count * PER_PAGE, seed))
+    return [('page-{}'.format(page), fake.render(fake.listings[page * PER_PAGE:(page + 1) * PER_PAGE], 1))
+            for page in range(count)]
+
+
+def recorded_pages(path):
+    """Return the (url, html) pages stored in an HTTP cache file."""
+    with contextlib.closing(connect(path)) as db:
+        return [(url, zlib.decompress(body).decode('utf-8'))
+                for url, body in db.execute("SELECT URL, BODY FROM HTTP_CACHE")]
+
+
+def bench_parse(pages, repeat=DEFAULT_REPEAT):
+    size = sum(len(html) for _, html in pages) / 1e6
+    extract_time = _best_time(lambda: [extract_listings(html) for _, html in pages], repeat)
+    summary_time = _best_time(lambda: [extract_summary(html) for _, html in pages], repeat)
+    sample = pages[:BS4_PAGES]
+    bs4_time = _best_time(lambda: [extract_listings_bs4(html) for _, html in sample], 1)
+    rows = [(url, json.dumps(extract_listings(html))) for url, html in pages]
+    num_listings = len(parse_pages(rows))
+    parse_time = _best_time(lambda: parse_pages(rows), repeat)
+    return [
+        Result('parse.extract_listings.pages_per_sec', len(pages) / extract_time, 'pages/s', 'higher'),
+        Result('parse.extract_listings.mb_per_sec', size / extract_time, 'MB/s', 'higher'),
+        Result('parse.extract_summary.pages_per_sec', len(pages) / summary_time, 'pages/s', 'higher'),
+        Result('parse.extract_listings_bs4.pages_per_sec', len(sample) / bs4_time, 'pages/s', 'higher'),
+        Result('parse.parse_pages.listings_per_sec', num_listings / parse_time, 'listings/s', 'higher'),
+    ]
+
+
+def bench_storage(directory, pages, batch_size=redfin_crawler.DEFAULT_BATCH_SIZE):
+    rows = [(url, json.dumps(extract_listings(html))) for url, html in pages]
+    details = parse_pages(rows)
+    page_infos = [(url, PER_PAGE * i, i, PER_PAGE) for i, (url, _) in enumerate(pages)]
+
+    def timed(name, write, items, unit='rows/s'):
+        path = os.path.join(directory, '{}.db'.format(name))
+        with contextlib.closing(connect(path)) as db:
+            migrate(db)
+            store = PageStore(os.path.join(directory, name), db)
+            start = time.perf_counter()
+            for i in range(0, len(items), batch_size):
+                write(db, items[i:i + batch_size], store)
+                db.commit()
+            elapsed = time.perf_counter() - start
+            store.close()
+        return Result('storage.{}.rows_per_sec'.format(name), len(items) / elapsed, unit, 'higher')
+
+    results = [
+        timed('listings_text', lambda db, batch, store: save_listings(db, batch), rows),
+        timed('listings_page_store', lambda db, batch, store: save_listings(db, batch, store), rows),
+        timed('listing_details', lambda db, batch, store: save_listing_details(db, batch), details),
+        timed('page_infos', lambda db, batch, store: save_page_infos(db, batch), page_infos),
+    ]
+    text_size = sum(len(info.encode('utf-8')) for _, info in rows)
+    stored_size = sum(os.path.getsize(os.path.join(directory, 'listings_page_store', f))
+                      for f in os.listdir(os.path.join(directory, 'listings_page_store')))
+    results.append(Result('storage.page_store.compression_ratio', text_size / stored_size, 'ratio', 'higher'))
+    return results
+
+
+@contextlib.contextmanager
+def crawler_paths(directory):
+    """Point the crawler database and page store at directory for the duration."""
+    saved = redfin_crawler.SQLITE_DB_PATH, redfin_crawler.PAGE_STORE_PATH, redfin_crawler.LOGGER
+    redfin_crawler.SQLITE_DB_PATH = os.path.join(directory, 'crawl.db')
+    redfin_crawler.PAGE_STORE_PATH = os.path.join(directory, 'pages')
+    redfin_crawler.LOGGER = redfin_crawler.LOGGER or logging.getLogger('redfin_crawler')
+    try:
+        redfin_crawler.create_tables_if_not_exist()
+        yield redfin_crawler.SQLITE_DB_PATH
+    finally:
+        redfin_crawler.SQLITE_DB_PATH, redfin_crawler.PAGE_STORE_PATH, redfin_crawler.LOGGER = saved
+
+
+def bench_crawl(directory, count=DISTRIBUTIONS['towers'][0], towers=DISTRIBUTIONS['towers'][1], seed=0,
+                latency=0, num_proxies=4, pipeline=False):
+    fake = FakeRedfin(generate_listings(count, seed, towers=towers), latency=latency, seed=seed)
+    total = len(fake.listings)
+    server = ServerThread()
+    try:
+        base_url = 'http://127.0.0.1:{}{}'.format(server.start(fake.app()), BASE_PATH)
+        pool = ProxyPool([redfin_crawler.construct_proxy('127.0.0.1', server.start(ProxyStub(seed=i).app()))
+                          for i in range(num_proxies)])
+        scheduler = RateScheduler(pool.proxies, proxy_rps=1000, global_rps=0, pool=pool)
+        with crawler_paths(directory) as db_path:
+            start = time.perf_counter()
+            if pipeline:
+                redfin_crawler.crawl_pipelined(base_url, scheduler, max_levels=12)
+                partition_requests, partition_time = None, None
+            else:
+                redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+                partition_requests, partition_time = fake.stats['requests'], time.perf_counter() - start
+                redfin_crawler.crawl_redfin_with_proxies(scheduler)
+            fetch_time = time.perf_counter() - start
+            parse_start = time.perf_counter()
+            redfin_crawler.parse_addresses(workers=1)
+            parse_time = time.perf_counter() - parse_start
+            with contextlib.closing(connect(db_path)) as db:
+                found, = db.execute("SELECT COUNT(*) FROM LISTING_DETAILS").fetchone()
+    finally:
+        server.stop()
+
+    prefix = 'crawl.{}.'.format('pipelined' if pipeline else 'staged')
+    results = [
+        Result(prefix + 'requests_per_1000', 1000 * fake.stats['requests'] / total, 'requests', 'lower'),
+        Result(prefix + 'requests_per_sec', fake.stats['requests'] / fetch_time, 'requests/s', 'higher'),
+        Result(prefix + 'listings_per_sec', total / (fetch_time + parse_time), 'listings/s', 'higher'),
+        Result(prefix + 'recall', found / total, 'share', 'higher'),
+    ]
+    if partition_requests is not None:
+        results.append(Result(prefix + 'partition_requests_per_1000', 1000 * partition_requests / total,
+                              'requests', 'lower'))
+        results.append(Result(prefix + 'partition_seconds', partition_time, 's', 'lower'))
+    return results
+
+
+def run(suites=SUITES, seed=0, pages_from=None, num_pages=500, crawl_latency=0):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        pages = recorded_pages(pages_from) if pages_from else synthetic_pages(num_pages, seed)
+        for suite in suites:
+            LOGGER.info('Running the {} benchmarks'.format(suite))
+            if suite == 'split':
+                results.extend(bench_split(seed))
+            elif suite == 'parse':
+                results.extend(bench_parse(pages))
+            elif suite == 'storage':
+                path = os.path.join(directory, 'storage')
+                os.makedirs(path)
+                results.extend(bench_storage(path, pages))
+            elif suite == 'crawl':
+                for pipeline in (False, True):
+                    path = os.path.join(directory, 'crawl-{}'.format(pipeline))
+                    os.makedirs(path)
+                    results.extend(bench_crawl(path, seed=seed, latency=crawl_latency, pipeline=pipeline))
+                    shutil.rmtree(path)
+            else:
+                raise ValueError('Unknown benchmark suite {}'.format(suite))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, **meta):
+    """Return the JSON document of a run."""
+    meta.update(commit=_git_commit(), python=platform.python_version(), machine=platform.machine(),
+                timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+    return {'meta': meta, 'results': [r._asdict() for r in results]}
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return (result, baseline value) pairs of results that got worse than the baseline
+    document by more than tolerance, relative to the baseline value.
+    """
+    previous = {r['name']: r['value'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get(result.name)
+        if base is None:
+            continue
+        if result.better == 'higher' and result.value < base * (1 - tolerance):
+            regressions.append((result, base))
+        elif result.better == 'lower' and result.value > base * (1 + tolerance):
+            regressions.append((result, base))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the partitioning, parsing and storage of the crawler.')
+    parser.add_argument('--suite', action='append', choices=SUITES,
+                        help='Suite to run, may be repeated. Defaults to all of them.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic listings.')
+    parser.add_argument('--pages', type=int, default=500, help='Number of synthetic pages to parse and store.')
+    parser.add_argument('--pages_from', help='Parse and store the pages recorded in this HTTP cache file instead.')
+    parser.add_argument('--crawl_latency', type=float, default=0,
+                        help='Median latency of the stand-in server in the crawl suite, in seconds.')
+    parser.add_argument('--output', help='Write the results to this JSON file instead of stdout.')
+    parser.add_argument('--baseline', help='Results of an earlier run to check for regressions.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative change allowed before a result counts as a regression.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    LOGGER.setLevel(logging.INFO)
+
+    suites = args.suite or SUITES
+    results = run(suites, args.seed, args.pages_from, args.pages, args.crawl_latency)
+    document = json.dumps(report(results, suites=list(suites), seed=args.seed, pages_from=args.pages_from),
+                          indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, base in regressions:
+            LOGGER.error('{} regressed from {:.4g} to {:.4g} {}'.format(result.name, base, result.value, result.unit))
+        if regressions:
+            sys.exit(1)
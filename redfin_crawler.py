@@ -1,16 +1,30 @@
+import os
 import re
 import json
-import random
-import requests
+import collections
+import contextlib
 import logging
-import time
 import pandas as pd
 import argparse
 from concurrent.futures import ProcessPoolExecutor
-from bs4 import BeautifulSoup
-import sqlite3
 
-from redfin_filters import apply_filters
+from redfin_fetcher import (DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, DEFAULT_MAX_ATTEMPTS, FetchFailedException,
+                            run_streaming, run_work_queue)
+from redfin_extract import extract_listings, extract_summary
+from redfin_filters import DIMENSIONS, PRIOR_GROUP, observe_partition, observe_priors, split_partition
+from redfin_http_cache import DEFAULT_MAX_AGE, DEFAULT_TTL, HttpCache
+from redfin_lease import (DEFAULT_LEASE_SIZE, DEFAULT_VISIBILITY_TIMEOUT, LeaseQueue, coordinator_app, remote_error,
+                         run_leased_work, serve_until_done)
+from redfin_listings import parse_pages
+from redfin_metrics import DEFAULT_INTERVAL, FANOUT_BUCKETS, METRICS, SnapshotWriter, profiled, serve_metrics
+from redfin_page_store import PageStore
+from redfin_partition import Partition
+from redfin_planner import DensityModel, shape_distance
+from redfin_proxy_pool import ProxyPool
+from redfin_rate_limit import DEFAULT_GLOBAL_RPS, DEFAULT_PROXY_RPS, RateScheduler
+from redfin_storage import (connect, get_state, load_density_cache, migrate, move_listings_to_store, prefix_range,
+                            record_failures, save_density_cache, save_listing_details, save_listings,
+                            save_page_infos, set_state)
 
 LOGGER = None
 HEADER = {
@@ -18,6 +32,19 @@ HEADER = {
                   ' Chrome/49.0.2623.112 Safari/537.36'
 }
 SQLITE_DB_PATH = 'redfin_scraper_data.db'
+# Segment files of the compressed page payloads referenced by LISTINGS.
+PAGE_STORE_PATH = 'redfin_pages'
+# Responses of both stages, revalidated once they are older than --cache_ttl and deleted after --cache_max_age.
+HTTP_CACHE_PATH = 'redfin_http_cache.db'
+DEFAULT_COORDINATOR_PORT = 8780
+# Work item kinds fetched with get_partition_info_async.
+PARTITION_KINDS = ('partition', 'probe')
+# Work item kinds fetched with scrape_page_async.
+PAGE_KINDS = ('page', 'rescrape')
+# Work item kinds of a refresh, which have to see the current pages and not the ones cached by the last crawl.
+REFRESH_KINDS = ('probe', 'rescrape')
+# Rewrite a cached histogram once the observed one moved this far from it.
+DENSITY_DRIFT = 0.05
 
 
 def construct_proxy(ip_addr, port, user=None, password=None):
@@ -33,270 +60,668 @@ def construct_proxy(ip_addr, port, user=None, password=None):
     }
 
 
+def open_page_store(db):
+    return PageStore(PAGE_STORE_PATH, db)
+
+
+def compact_listings(batch_size=DEFAULT_BATCH_SIZE):
+    """Move the JSON text of LISTINGS rows written before the page store into it."""
+    with connect(SQLITE_DB_PATH) as db:
+        store = open_page_store(db)
+        moved = move_listings_to_store(db, store, batch_size)
+        store.close()
+        if moved:
+            LOGGER.info('Reclaiming the space of {} moved pages'.format(moved))
+            db.execute("VACUUM")
+    LOGGER.warning('Moved {} pages to the page store!'.format(moved))
+
+
 def create_tables_if_not_exist():
-    conn = sqlite3.connect(SQLITE_DB_PATH)
-    conn.execute('''CREATE TABLE IF NOT EXISTS URLS
-             (
-             URL            TEXT    NOT NULL,
-             NUM_PROPERTIES INT,
-             NUM_PAGES      INT,
-             PER_PAGE_PROPERTIES   INT);''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS LISTINGS
-             (
-             URL            TEXT    NOT NULL,
-             INFO           TEXT);''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS LISTING_DETAILS
-             (
-             URL            TEXT    NOT NULL,
-             NUMBER_OF_ROOMS INT,
-             NAME           TEXT,
-             COUNTRY        TEXT,
-             REGION         TEXT,
-             LOCALITY       TEXT,
-             STREET         TEXT,
-             POSTOAL        TEXT,
-             TYPE           TEXT,
-             PRICE          REAL
-             );''')
+    conn = connect(SQLITE_DB_PATH)
+    migrate(conn)
     conn.close()
 
 
-def get_page_info(url_and_proxy):
-    """Return property count, page count and total properties under a given URL."""
-    url, proxy = url_and_proxy
-
-    time.sleep(random.random() * 10)
-    session = requests.Session()
+def parse_page_info(url, html):
+    """Return (url, total properties, page count, properties per page) parsed from a results page."""
     total_properties, num_pages, properties_per_page = None, None, None
+    page_description, pages = extract_summary(html)
+    if page_description is None:
+        # The page has nothing!
+        return (url, 0, 0, 20)
+    if 'of' in page_description:
+        property_cnt_pattern = r'Showing ([0-9]+) of ([0-9]+) .*'
+        m = re.match(property_cnt_pattern, page_description)
+        if m:
+            properties_per_page = int(m.group(1))
+            total_properties = int(m.group(2))
+        num_pages = max(pages)
+    else:
+        property_cnt_pattern = r'Showing ([0-9]+) .*'
+        m = re.match(property_cnt_pattern, page_description)
+        if m:
+            properties_per_page = int(m.group(1))
+        num_pages = 1
+    return (url, total_properties, num_pages, properties_per_page)
+
+
+async def get_page_info_async(fetcher, url):
+    """Return (url, total properties, page count, properties per page) of url, fetched through the
+    shared AsyncFetcher, whose scheduler picks the proxy, paces the request and retries failures.
+    Return a FetchFailedException instead of the page info if the url failed.
+    """
     try:
-        resp = session.get(url, headers=HEADER, proxies=proxy)
-        resp.raise_for_status()
-
-        if resp.status_code == 200:
-            bf = BeautifulSoup(resp.text, 'lxml')
-            page_description_div = bf.find('div', {'class': 'homes summary'})
-            if not page_description_div:
-                # The page has nothing!
-                return(url, 0, 0, 20)
-            page_description = page_description_div.get_text()
-            if 'of' in page_description:
-                property_cnt_pattern = r'Showing ([0-9]+) of ([0-9]+) .*'
-                m = re.match(property_cnt_pattern, page_description)
-                if m:
-                    properties_per_page = int(m.group(1))
-                    total_properties = int(m.group(2))
-                pages = [int(x.get_text()) for x in bf.find_all('a', {'class': "goToPage"})]
-                num_pages = max(pages)
-            else:
-                property_cnt_pattern = r'Showing ([0-9]+) .*'
-                m = re.match(property_cnt_pattern, page_description)
-                if m:
-                    properties_per_page = int(m.group(1))
-                num_pages = 1
+        html = await fetcher.fetch(url)
+    except FetchFailedException as e:
+        return e
+    try:
+        with METRICS.timer('parse_seconds', stage='partition'):
+            return parse_page_info(url, html)
     except Exception as e:
-        LOGGER.exception('Swallowing exception {} on url {}'.format(e, url))
-    return (url, total_properties, num_pages, properties_per_page)
+        LOGGER.exception('Failed to parse url {}'.format(url))
+        return FetchFailedException(url, 1, e)
+
+
+def first_page_url(url):
+    return '{},sort=lo-price/page-1'.format(url)
+
+
+async def get_partition_info_async(fetcher, partition_and_level, revalidate=False):
+    """Return (partition, level, get_page_info_async result, listings JSON or None).
+
+    Filtered partitions are fetched through the first of their paginated urls,
+    so when one turns out to be a leaf its listings are kept and page 1 does
+    not have to be scraped again. The partition is rendered to a url only here.
+    With revalidate set, a cached response is not trusted without asking the server.
+    """
+    partition, level = partition_and_level
+    url = partition.url
+    try:
+        html = await fetcher.fetch(first_page_url(url) if partition.ranges else url, revalidate=revalidate)
+    except FetchFailedException as e:
+        return partition, level, e, None
+    try:
+        with METRICS.timer('parse_seconds', stage='partition'):
+            page_info = parse_page_info(url, html)
+            listings = None
+            if partition.ranges and is_leaf(page_info[1:]):
+                listings = json.dumps(extract_listings(html))
+        return partition, level, page_info, listings
+    except Exception as e:
+        LOGGER.exception('Failed to parse url {}'.format(url))
+        return partition, level, FetchFailedException(url, 1, e), None
+
+
+def property_count(page_info):
+    """Number of properties under a url from its (total, page count, per page) info, None if unknown."""
+    total_properties, num_pages, properties_per_page = page_info
+    if total_properties is not None:
+        return total_properties
+    if num_pages == 1:
+        return properties_per_page
+    return None
 
 
-def url_partition(base_url, proxies, max_levels=6):
+def load_cached_density(db, region, density):
+    """Seed density with the cached histograms of region, or of the other regions
+    if it was never partitioned. Return the sibling set keys that came from the cache.
+    """
+    cache_groups = set()
+    for cached_region, dimension, lo, hi, share in load_density_cache(db, region):
+        cache_groups.add(('cache', cached_region))
+        density.observe(dimension, ('cache', cached_region), lo, hi, share)
+    return cache_groups
+
+
+def refresh_density_cache(db, region, density, cache_groups):
+    """Store the histograms observed for region whose shape drifted from the cached one."""
+    for dimension, (_, _, (lo, hi), _, _) in DIMENSIONS.items():
+        observed = density.shape(dimension, lo, hi, skip=cache_groups)
+        if not observed:
+            continue
+        cached = density.shape(dimension, lo, hi, skip=set(density.groups[dimension]) - {('cache', region)})
+        if cached and shape_distance(observed, cached) < DENSITY_DRIFT:
+            continue
+        LOGGER.info('Refreshing the cached {} histogram of {}'.format(dimension, region))
+        save_density_cache(db, region, dimension, observed)
+    db.commit()
+
+
+def is_leaf(page_info):
+    """Whether every property under a (total, page count, per page) info is reachable through its pages."""
+    total_properties, num_pages, properties_per_page = page_info
+    return not (total_properties and num_pages and properties_per_page and
+                total_properties > num_pages * properties_per_page)
+
+
+def start_partition(db, base_url):
+    """Queue base_url in FRONTIER and build the DensityModel for it.
+    Return the model and the sibling sets refresh_density_cache has to skip.
+    """
+    db.execute("""
+        INSERT OR IGNORE INTO FRONTIER (URL, BASE_URL, LEVEL)
+        VALUES (?, ?, 0)""", (base_url, base_url))
+    # Urls that failed last time get another chance.
+    db.execute("""
+        UPDATE FRONTIER SET STATUS = 'pending'
+        WHERE BASE_URL = ? AND STATUS = 'failed'""", (base_url,))
+    db.commit()
+
+    density = DensityModel()
+    observe_priors(density)
+    for url, *page_info in db.execute("""
+            SELECT URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES FROM URLS
+            WHERE URL >= ? AND URL < ?""", prefix_range(base_url)):
+        observe_partition(density, url, property_count(page_info))
+    return density, load_cached_density(db, base_url, density) | {PRIOR_GROUP}
+
+
+def save_partition_results(db, base_url, results, density, store=None):
+    """Record a batch of get_partition_info_async results in URLS and FRONTIER, splitting the
+    partitions that are over their page limit, and the first pages of leaves in LISTINGS.
+    The caller commits.
+    Return the (child partition, level) pairs new to FRONTIER, and the page urls of the
+    leaves that still have to be scraped.
+    """
+    failures = [x for _, _, x, _ in results if isinstance(x, FetchFailedException)]
+    scraper_results = [x for x in results if not isinstance(x[2], FetchFailedException)]
+    LOGGER.info('saving {} partition results to db!'.format(len(scraper_results)))
+    record_failures(db, 'partition', failures)
+    save_page_infos(db, [x for _, _, x, _ in scraper_results])
+
+    # The failure carries the fetched page-1 url, FRONTIER is keyed by the partition url.
+    statuses = [('failed', partition.url) for partition, _, x, _ in results if isinstance(x, FetchFailedException)]
+    children, leaf_pages, first_pages = [], [], []
+    for partition, _, result, _ in scraper_results:
+        observe_partition(density, partition, property_count(result[1:]))
+    for partition, level, result, listings in scraper_results:
+        if not is_leaf(result[1:]) or level == 0:
+            page_limit = result[2] * result[3] if result[2] and result[3] else None
+            expanded = split_partition(partition, count=result[1], limit=page_limit, density=density)
+            if expanded == [partition]:
+                LOGGER.info('Cannot further split {}'.format(result[0]))
+                statuses.append(('unsplittable', result[0]))
+            else:
+                children.extend((child, level + 1) for child in expanded)
+                statuses.append(('split', result[0]))
+                METRICS.observe('partition_fanout', len(expanded), buckets=FANOUT_BUCKETS, level=level)
+        else:
+            statuses.append(('leaf', result[0]))
+            page_urls = leaf_page_urls(*result)
+            if listings is not None and page_urls:
+                first_pages.append((page_urls.pop(0), listings))
+            leaf_pages.extend(page_urls)
+    new_children = []
+    for child, level in children:
+        cursor = db.execute("""
+            INSERT OR IGNORE INTO FRONTIER (URL, BASE_URL, LEVEL)
+            VALUES (?, ?, ?)""", (child.url, base_url, level))
+        if cursor.rowcount:
+            new_children.append((child, level))
+    db.executemany("UPDATE FRONTIER SET STATUS = ? WHERE URL = ?", statuses)
+    save_listings(db, first_pages, store)
+    for status, _ in statuses:
+        METRICS.incr('partitions', status=status)
+    return new_children, leaf_pages
+
+
+def url_partition(base_url, scheduler, max_levels=6, concurrency=DEFAULT_CONCURRENCY,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS, batch_size=DEFAULT_BATCH_SIZE, cache=None):
     """Partition the listings for a given url into multiple sub-urls,
     such that each url contains at most 20 properties.
+
+    Ranges are split according to the property counts seen so far, so that
+    children are likely to fit under the page limit in one step. Histograms
+    learned on earlier runs, of this or other regions, are read from and
+    written back to DENSITY_CACHE, so the base url can be cut into leaf-sized
+    price ranges right away.
+    The partition tree is checkpointed in the FRONTIER table every batch_size urls,
+    so a restarted run only fetches the urls that are still pending.
     """
-    urls = [base_url]
-    num_levels = 0
-    partitioned_urls = []
-    while urls and (num_levels < max_levels):
-        rand_move = random.randint(0, len(proxies) - 1)
-        partition_inputs = []
-        for i, url in enumerate(urls):
-            proxy = construct_proxy(*proxies[(rand_move + i) % len(proxies)])
-            LOGGER.debug(f"scraping url {url} with proxy {proxy}")
-            partition_inputs.append((url, proxy))
-
-        scraper_results = []
-        with ProcessPoolExecutor(max_workers=min(50, len(partition_inputs))) as executor:
-            scraper_results = list(executor.map(get_page_info, partition_inputs))
-
-        LOGGER.info('Getting {} results'.format(len(scraper_results)))
-
-        with sqlite3.connect(SQLITE_DB_PATH) as db:
-            LOGGER.info('stage {} saving to db!'.format(num_levels))
-            values = []
-            for result in scraper_results:
-                to_nulls = [x if x else 'NULL' for x in result]
-                values.append("('{}', {}, {}, {})".format(*to_nulls))
-            cursor = db.cursor()
-            cursor.execute("""
-                INSERT INTO URLS (URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES)
-                VALUES {};
-            """.format(','.join(values)))
-
-        LOGGER.info('Writing to sqlite {} results'.format(len(scraper_results)))
-        new_urls = []
-        for result in scraper_results:
-            if (result[1] and result[2] and result[3] and result[1] > result[2] * result[3]) or (num_levels == 0):
-                expanded_urls = apply_filters(result[0], base_url)
-                if len(expanded_urls) == 1 and expanded_urls[0] == result[0]:
-                    LOGGER.info('Cannot further split {}'.format(result[0]))
-                else:
-                    new_urls.extend(expanded_urls)
-            else:
-                partitioned_urls.append(result)
-        LOGGER.info('stage {}: running for {} urls. We already captured {} urls'.format(
-            num_levels, len(new_urls), len(partitioned_urls)))
-        urls = new_urls
-        num_levels += 1
-        time.sleep(random.randint(2, 5))
+    with connect(SQLITE_DB_PATH) as db:
+        density, cache_groups = start_partition(db, base_url)
+        store = open_page_store(db)
+
+        while True:
+            num_levels, = db.execute("""
+                SELECT MIN(LEVEL) FROM FRONTIER
+                WHERE BASE_URL = ? AND STATUS = 'pending'""", (base_url,)).fetchone()
+            if num_levels is None or num_levels >= max_levels:
+                break
+            partitions = [(Partition.from_url(row[0], base_url), num_levels) for row in db.execute("""
+                SELECT URL FROM FRONTIER
+                WHERE BASE_URL = ? AND LEVEL = ? AND STATUS = 'pending'""", (base_url, num_levels))]
+
+            def write_batch(results):
+                LOGGER.info('stage {} saving {} results to db!'.format(num_levels, len(results)))
+                with METRICS.timer('db_write_seconds', stage='partition'):
+                    save_partition_results(db, base_url, results, density, store)
+                    db.commit()
+
+            LOGGER.info('stage {}: running for {} urls'.format(num_levels, len(partitions)))
+            run_streaming(get_partition_info_async, partitions, write_batch, batch_size=batch_size, headers=HEADER,
+                          concurrency=concurrency, scheduler=scheduler, max_attempts=max_attempts, cache=cache)
+            refresh_density_cache(db, base_url, density, cache_groups)
+        store.close()
+
+        partitioned_urls = db.execute("""
+            SELECT U.URL, U.NUM_PROPERTIES, U.NUM_PAGES, U.PER_PAGE_PROPERTIES
+            FROM URLS U JOIN FRONTIER F ON U.URL = F.URL
+            WHERE F.BASE_URL = ? AND F.STATUS = 'leaf'""", (base_url,)).fetchall()
+    LOGGER.info('We already captured {} urls'.format(len(partitioned_urls)))
     return partitioned_urls
 
 
-def parse_addresses():
-    listing_details = {}
-    with sqlite3.connect(SQLITE_DB_PATH) as db:
-        cur = db.cursor()
-        cur.execute("SELECT * FROM listings")
-        rows = cur.fetchall()
-        urls = set()
-
-        for url, json_details in rows:
-            if url in urls:
-                continue
-            urls.add(url)
-            listings_on_page = (json.loads(json_details))
-            for listing in listings_on_page:
-                # print('listing {}'.format(listing))
-                num_rooms, name, country, region, locality, street, postal, house_type, price = \
-                    None, None, None, None, None, None, None, None, None
-                listing_url = None
-                if (not isinstance(listing, list)) and (not isinstance(listing, dict)):
-                    continue
-
-                if isinstance(listing, dict):
-                    info = listing
-                    if ('url' in info) and ('address' in info):
-                        listing_url = info.get('url')
-                        address_details = info['address']
-                        num_rooms = info.get('numberOfRooms')
-                        name = info.get('name')
-                        country = address_details.get('addressCountry')
-                        region = address_details.get('addressRegion')
-                        locality = address_details.get('addressLocality')
-                        street = address_details.get('streetAddress')
-                        postal = address_details.get('postalCode')
-                        house_type = info.get('@type')
-                        listing_details[listing_url] = (listing_url, num_rooms, name, country,
-                                                        region, locality, street, postal, house_type, price)
-                    continue
-
-                for info in listing:
-                    if ('url' in info) and ('address' in info):
-                        listing_url = info.get('url')
-                        address_details = info['address']
-                        num_rooms = info.get('numberOfRooms')
-                        name = info.get('name')
-                        country = address_details.get('addressCountry')
-                        region = address_details.get('addressRegion')
-                        locality = address_details.get('addressLocality')
-                        street = address_details.get('streetAddress')
-                        postal = address_details.get('postalCode')
-                        house_type = info.get('@type')
-                    if 'offers' in info:
-                        price = info['offers'].get('price')
-                if listing_url:
-                    listing_details[listing_url] = (listing_url, num_rooms, name, country,
-                                                    region, locality, street, postal, house_type, price)
-
-    # print(listing_details)
-    with sqlite3.connect(SQLITE_DB_PATH) as db:
-        cursor = db.cursor()
-        try:
-            cursor.executemany("""
-                INSERT INTO LISTING_DETAILS (
-                             URL,
-                             NUMBER_OF_ROOMS,
-                             NAME     ,
-                             COUNTRY  ,
-                             REGION    ,
-                             LOCALITY  ,
-                             STREET    ,
-                             POSTOAL   ,
-                             TYPE      ,
-                             PRICE)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """, listing_details.values())
-        except Exception as e:
-            LOGGER.info(e)
-
-
-def scrape_page(url_proxy):
-    time.sleep(random.random() * 16)
-    details = []
+def reset_frontier(base_url):
+    """Forget the partition progress of base_url so the next run starts from scratch."""
+    with connect(SQLITE_DB_PATH) as db:
+        db.execute("DELETE FROM FRONTIER WHERE BASE_URL = ?", (base_url,))
+
+
+def _bounded_map(executor, fn, keyed_items, max_pending):
+    """Like executor.map over (key, item) pairs, yielding (key, fn(item)) in order,
+    but only keeping max_pending tasks queued at a time.
+    """
+    pending = collections.deque()
+    for key, item in keyed_items:
+        pending.append((key, executor.submit(fn, item)))
+        if len(pending) >= max_pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result()
+
+
+def _listing_chunks(cursor, chunk_size, store):
+    """Yield (last rowid, [(url, info), ...]) chunks of a (rowid, url, info, page store location) cursor.
+    Pages kept in the page store get a PageRef as info, which the parse workers read themselves.
+    """
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows[-1][0], [(url, info if segment is None else store.ref(segment, offset, length))
+                            for _, url, info, segment, offset, length in rows]
+
+
+def parse_addresses(batch_size=DEFAULT_BATCH_SIZE, workers=None, full=False):
+    """Parse scraped pages in LISTINGS into LISTING_DETAILS.
+
+    Only pages added since the last run are parsed, unless full is set. The
+    LISTINGS rowid of the last parsed page is kept in CRAWL_STATE as a
+    high-water mark and moves forward with every committed batch.
+    Pages are read batch_size at a time, parsed in a process pool and upserted
+    by listing url, so memory does not grow with the size of the table.
+    """
+    num_details = 0
+    with connect(SQLITE_DB_PATH) as db, ProcessPoolExecutor(max_workers=workers) as executor:
+        last_rowid = 0 if full else get_state(db, 'listings_parsed_rowid', 0)
+        # A page may have been scraped more than once, only parse its latest copy.
+        cursor = db.execute("""
+            SELECT L.rowid, L.URL, L.INFO, S.SEGMENT, S.OFFSET, S.LENGTH
+            FROM LISTINGS L LEFT JOIN PAGE_STORE S ON L.PAGE_HASH = S.HASH
+            WHERE L.rowid IN (SELECT MAX(rowid) FROM LISTINGS WHERE rowid > ? GROUP BY URL)
+            ORDER BY L.rowid""", (last_rowid,))
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        chunks = _listing_chunks(cursor, batch_size, open_page_store(db))
+        for last_rowid, listing_details in _bounded_map(executor, parse_pages, chunks, max_pending):
+            try:
+                with METRICS.timer('db_write_seconds', stage='details'):
+                    save_listing_details(db, listing_details)
+                    set_state(db, 'listings_parsed_rowid', last_rowid)
+                    db.commit()
+                num_details += len(listing_details)
+                METRICS.incr('listing_details_parsed', len(listing_details))
+            except Exception:
+                db.rollback()
+                LOGGER.exception('Failed to save listing details, stopping before rowid {}'.format(last_rowid))
+                break
+    LOGGER.info('Parsed {} listing details'.format(num_details))
+
+
+async def scrape_page_async(fetcher, url, revalidate=False):
+    """Return (url, JSON-LD listings of the page) of url, fetched through the shared AsyncFetcher,
+    whose scheduler picks the proxy, paces the request and retries failures.
+    Return a FetchFailedException instead of the listings if the url failed.
+    With revalidate set, a cached response is not trusted without asking the server.
+    """
+    try:
+        html = await fetcher.fetch(url, revalidate=revalidate)
+    except FetchFailedException as e:
+        return e
     try:
-        url, proxy = url_proxy
-        session = requests.Session()
-        resp = session.get(url, headers=HEADER, proxies=proxy)
-        bf = BeautifulSoup(resp.text, 'lxml')
-        details = [json.loads(x.text) for x in bf.find_all('script', type='application/ld+json')]
+        with METRICS.timer('parse_seconds', stage='page'):
+            return url, json.dumps(extract_listings(html))
     except Exception as e:
-        LOGGER.exception('failed for url {}, proxy {}'.format(url, proxy))
-    return url, json.dumps(details)
+        LOGGER.exception('failed for url {}'.format(url))
+        return FetchFailedException(url, 1, e)
+
+
+def leaf_page_urls(url, num_properties, num_pages, per_page_properties):
+    """Return the paginated urls of a URLS row, with at most 20 properties each.
+    Rows over their page limit have none, they are split instead.
+    """
+    if num_properties == 0:
+        return []
+    if not num_pages:
+        return [url]
+    if (not num_properties) and int(num_pages) == 1 and per_page_properties:
+        return [first_page_url(url)]
+    if num_properties <= num_pages * per_page_properties:
+        # Build per page urls.
+        return ['{},sort=lo-price/page-{}'.format(url, p) for p in range(1, num_pages + 1)]
+    return []
 
 
 def get_paginated_urls(prefix):
     # Return a set of paginated urls with at most 20 properties each.
     paginated_urls = []
-    with sqlite3.connect(SQLITE_DB_PATH) as db:
-        cursor = db.execute("""
+    with connect(SQLITE_DB_PATH) as db:
+        query = """
             SELECT URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES
             FROM URLS
-        """)
-        seen_urls = set()
+        """
+        if prefix:
+            cursor = db.execute(query + "WHERE URL >= ? AND URL < ?", prefix_range(prefix))
+        else:
+            cursor = db.execute(query)
         for row in cursor:
-            url, num_properties, num_pages, per_page_properties = row
-            if prefix and (prefix not in url):
-                continue
-            if url in seen_urls:
-                continue
-            if num_properties == 0:
-                continue
-            urls = []
-            # print(num_properties, num_pages, per_page_properties, url)
-            if not num_pages:
-                urls = [url]
-            elif (not num_properties) and int(num_pages) == 1 and per_page_properties:
-                urls = ['{},sort=lo-price/page-1'.format(url)]
-            elif num_properties < num_pages * per_page_properties:
-                # Build per page urls.
-                # print('num pages {}'.format(num_pages))
-                urls = ['{},sort=lo-price/page-{}'.format(url, p) for p in range(1, num_pages + 1)]
-            paginated_urls.extend(urls)
-    return list(set(paginated_urls))
-
-
-def crawl_redfin_with_proxies(proxies, prefix=''):
+            paginated_urls.extend(leaf_page_urls(*row))
+    return paginated_urls
+
+
+def crawl_redfin_with_proxies(scheduler, prefix='', concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE,
+                              max_attempts=DEFAULT_MAX_ATTEMPTS, cache=None):
+    """Scrape every paginated url and stream the pages into LISTINGS,
+    committing every batch_size pages.
+    """
     small_urls = get_paginated_urls(prefix)
-    rand_move = random.randint(0, len(proxies) - 1)
-    scrape_inputs, scraper_results = [], []
-    for i, url in enumerate(small_urls):
-        proxy = construct_proxy(*proxies[(rand_move + i) % len(proxies)])
-        scrape_inputs.append((url, proxy))
+    with connect(SQLITE_DB_PATH) as db:
+        scraped_urls = {row[0] for row in db.execute("SELECT DISTINCT URL FROM LISTINGS")}
+    if scraped_urls:
+        LOGGER.info('Skipping already scraped urls')
+        small_urls = [url for url in small_urls if url not in scraped_urls]
+
+    with connect(SQLITE_DB_PATH) as db:
+        store = open_page_store(db)
+
+        def write_batch(results):
+            pages = [x for x in results if not isinstance(x, FetchFailedException)]
+            with METRICS.timer('db_write_seconds', stage='page'):
+                record_failures(db, 'page', [x for x in results if isinstance(x, FetchFailedException)])
+                save_listings(db, pages, store)
+                db.commit()
+            METRICS.incr('pages_scraped', len(pages))
+
+        num_pages = run_streaming(scrape_page_async, small_urls, write_batch, batch_size=batch_size,
+                                  headers=HEADER, concurrency=concurrency, scheduler=scheduler,
+                                  max_attempts=max_attempts, cache=cache)
+        store.close()
+
+    LOGGER.warning('Finished scraping {} pages!'.format(num_pages))
+
+
+async def pipeline_worker(fetcher, item):
+    """Fetch one (base url, 'partition' or 'probe', (partition, level)) or (base url, 'page' or 'rescrape', url)
+    work item of crawl_regions.
+    """
+    base_url, kind, payload = item
+    revalidate = kind in REFRESH_KINDS
+    if kind in PARTITION_KINDS:
+        return base_url, kind, await get_partition_info_async(fetcher, payload, revalidate)
+    return base_url, kind, await scrape_page_async(fetcher, payload, revalidate)
 
-    with ProcessPoolExecutor(max_workers=min(50, len(scrape_inputs))) as executor:
-        scraper_results = list(executor.map(scrape_page, scrape_inputs))
 
-    LOGGER.warning('Finished scraping!')
+def region_work(db, base_url, max_levels, seen_pages, scrape=True):
+    """Return the work items a crawl of base_url starts from: the unscraped pages of its
+    leaves and its pending FRONTIER urls. Queued pages are added to seen_pages.
+    """
+    items = []
+    if scrape:
+        for leaf in db.execute("""
+                SELECT U.URL, U.NUM_PROPERTIES, U.NUM_PAGES, U.PER_PAGE_PROPERTIES
+                FROM URLS U JOIN FRONTIER F ON U.URL = F.URL
+                WHERE F.BASE_URL = ? AND F.STATUS = 'leaf'""", (base_url,)).fetchall():
+            for url in leaf_page_urls(*leaf):
+                if url not in seen_pages:
+                    seen_pages.add(url)
+                    items.append((base_url, 'page', url))
+    items.extend((base_url, 'partition', (Partition.from_url(url, base_url), level)) for url, level in db.execute("""
+        SELECT URL, LEVEL FROM FRONTIER
+        WHERE BASE_URL = ? AND LEVEL < ? AND STATUS = 'pending'
+        ORDER BY LEVEL""", (base_url, max_levels)))
+    return items
+
+
+def refresh_probes(db, base_url):
+    """Return a 'probe' work item for every leaf of base_url.
+
+    Every leaf is probed, as the count of a split partition may stay the same
+    while listings come and go under it, e.g. new sales making up for sales
+    that dropped out of the sold-3yr window.
+    """
+    return [(base_url, 'probe', (Partition.from_url(url, base_url), level)) for url, level in db.execute("""
+        SELECT URL, LEVEL FROM FRONTIER
+        WHERE BASE_URL = ? AND STATUS = 'leaf'""", (base_url,))]
 
-    with sqlite3.connect(SQLITE_DB_PATH) as db:
-        cursor = db.cursor()
-        for result in scraper_results:
-            url, info = result
-            try:
-                cursor.execute("""
-                    INSERT INTO LISTINGS (URL, INFO)
-                    VALUES (?, ?)""", (url, info))
-            except Exception as e:
-                LOGGER.info('failed record: {}'.format(result))
-                LOGGER.info(e)
+
+def save_probe_results(db, probes):
+    """Check a batch of get_partition_info_async results of probed leaves against URLS.
+
+    Return the results of the leaves whose counts changed, to be saved like
+    new partition results. Failed probes go to FAILED_URLS and leave their leaf as it was.
+    """
+    failures = [x for _, _, x, _ in probes if isinstance(x, FetchFailedException)]
+    record_failures(db, 'probe', failures)
+    METRICS.incr('probes', len(failures), result='failed')
+    changed = []
+    for probe in probes:
+        page_info = probe[2]
+        if isinstance(page_info, FetchFailedException):
+            continue
+        # Single page partitions only report their count as the number of properties on the page.
+        row = db.execute("""
+            SELECT NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES FROM URLS
+            WHERE URL = ?""", (page_info[0],)).fetchone()
+        if row != tuple(page_info[1:]):
+            changed.append(probe)
+    METRICS.incr('probes', len(changed), result='changed')
+    METRICS.incr('probes', len(probes) - len(failures) - len(changed), result='unchanged')
+    return changed
+
+
+def start_regions(db, base_urls, max_levels, scrape=True, refresh=False):
+    """Return ({base url: (density, cache groups)}, scraped or queued page urls, initial work items)
+    of a crawl of base_urls, see crawl_regions.
+    """
+    seen_pages = {row[0] for row in db.execute("SELECT DISTINCT URL FROM LISTINGS")} if scrape else set()
+    regions, items = collections.OrderedDict(), []
+    for base_url in base_urls:
+        regions[base_url] = start_partition(db, base_url)
+        if refresh:
+            items.extend(refresh_probes(db, base_url))
+        items.extend(region_work(db, base_url, max_levels, seen_pages, scrape))
+    return regions, seen_pages, items
+
+
+def save_region_results(db, regions, results, store, seen_pages, max_levels, scrape=True):
+    """Save a batch of pipeline_worker results of any of regions and commit.
+    Return the new work items: child partitions above max_levels and, when scraping, unseen leaf pages.
+    Probed partitions whose counts changed are saved like new ones, and their pages are scraped again.
+    """
+    by_region = collections.OrderedDict()
+    for base_url, kind, result in results:
+        by_region.setdefault(base_url, []).append((kind, result))
+    new_items = []
+    with METRICS.timer('db_write_seconds', stage='pipeline'):
+        for base_url, region_results in by_region.items():
+            partition_results = [x for kind, x in region_results if kind == 'partition']
+            changed = save_probe_results(db, [x for kind, x in region_results if kind == 'probe'])
+            rescrape = set()
+            for _, _, page_info, _ in changed:
+                rescrape.update(leaf_page_urls(*page_info))
+            seen_pages.difference_update(rescrape)
+            partition_results.extend(changed)
+            pages = [x for kind, x in region_results if kind in PAGE_KINDS]
+            children, leaf_pages = [], []
+            if partition_results:
+                density, _ = regions[base_url]
+                children, leaf_pages = save_partition_results(db, base_url, partition_results, density, store)
+            scraped = [x for x in pages if not isinstance(x, FetchFailedException)]
+            record_failures(db, 'page', [x for x in pages if isinstance(x, FetchFailedException)])
+            save_listings(db, scraped, store)
+            METRICS.incr('pages_scraped', len(scraped))
+
+            new_items.extend((base_url, 'partition', child) for child in children if child[1] < max_levels)
+            for url in leaf_pages if scrape else ():
+                if url not in seen_pages:
+                    seen_pages.add(url)
+                    new_items.append((base_url, 'rescrape' if url in rescrape else 'page', url))
+        db.commit()
+    return new_items
+
+
+def finish_regions(db, regions, store):
+    for base_url, (density, cache_groups) in regions.items():
+        refresh_density_cache(db, base_url, density, cache_groups)
+    store.close()
+
+
+def crawl_regions(base_urls, scheduler, max_levels=6, concurrency=DEFAULT_CONCURRENCY,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS, batch_size=DEFAULT_BATCH_SIZE, cache=None, scrape=True,
+                  refresh=False):
+    """Partition every region in base_urls and scrape the pages of their leaves through a single work queue.
+
+    All regions share the scheduler, so one proxy budget goes to whichever
+    region has work, and the queue takes turns between regions, so a big city
+    does not hold back the others. There is no barrier between partition
+    levels, and the pages of a leaf are queued as soon as the leaf is found.
+    Pending FRONTIER urls and unscraped pages of earlier runs are picked up
+    first. With scrape=False only the partition trees are built.
+
+    With refresh set, the known leaves are probed again through their first
+    page instead of partitioning from scratch, revalidating any cached copy.
+    Leaves with the same counts as before are left alone, the pages of changed
+    ones are scraped again, and those that outgrew the page limit are split
+    further. A leaf where as many listings dropped out as came in keeps its
+    count and is missed.
+    """
+    with connect(SQLITE_DB_PATH) as db:
+        store = open_page_store(db)
+        regions, seen_pages, items = start_regions(db, base_urls, max_levels, scrape, refresh)
+
+        def write_batch(results):
+            return save_region_results(db, regions, results, store, seen_pages, max_levels, scrape)
+
+        num_results = run_work_queue(pipeline_worker, items, write_batch, batch_size=batch_size,
+                                     key=lambda item: item[0], headers=HEADER, concurrency=concurrency,
+                                     scheduler=scheduler, max_attempts=max_attempts, cache=cache)
+        finish_regions(db, regions, store)
+    LOGGER.warning('Finished crawling {} regions after {} requests!'.format(len(regions), num_results))
+
+
+def crawl_pipelined(base_url, scheduler, max_levels=6, concurrency=DEFAULT_CONCURRENCY,
+                    max_attempts=DEFAULT_MAX_ATTEMPTS, batch_size=DEFAULT_BATCH_SIZE, cache=None):
+    """Partition base_url and scrape the pages of its leaves through a single work queue.
+
+    There is no barrier between partition levels, and the pages of a leaf are
+    queued as soon as the leaf is found, so scraping overlaps with deeper
+    partitioning. See crawl_regions.
+    """
+    crawl_regions([base_url], scheduler, max_levels=max_levels, concurrency=concurrency,
+                  max_attempts=max_attempts, batch_size=batch_size, cache=cache)
+
+
+def encode_item(item):
+    """Turn a crawl_regions work item into a JSON value for a remote worker."""
+    base_url, kind, payload = item
+    if kind in PARTITION_KINDS:
+        partition, level = payload
+        return [base_url, kind, partition.url, level]
+    return [base_url, kind, payload, None]
+
+
+def decode_item(data):
+    base_url, kind, url, level = data
+    if kind in PARTITION_KINDS:
+        return base_url, kind, (Partition.from_url(url, base_url), level)
+    return base_url, kind, url
+
+
+def _encode_failure(failure):
+    return {'url': failure.url, 'attempts': failure.attempts, 'error': type(failure.error).__name__,
+            'message': str(failure.error)}
+
+
+def encode_result(kind, result):
+    """Turn the pipeline_worker result of an item into a JSON value, see decode_result."""
+    if kind in PARTITION_KINDS:
+        _, _, page_info, listings = result
+        if isinstance(page_info, FetchFailedException):
+            return {'failure': _encode_failure(page_info)}
+        return {'page_info': page_info, 'listings': listings}
+    if isinstance(result, FetchFailedException):
+        return {'failure': _encode_failure(result)}
+    return {'listings': result[1]}
+
+
+def decode_result(data, result):
+    """Return the pipeline_worker result of the encoded item data from its encoded result."""
+    base_url, kind, payload = decode_item(data)
+    failure = result.get('failure')
+    if failure:
+        failure = FetchFailedException(failure['url'], failure['attempts'],
+                                       remote_error(failure['error'], failure['message']))
+    if kind in PARTITION_KINDS:
+        partition, level = payload
+        return base_url, kind, (partition, level, failure or tuple(result['page_info']), result.get('listings'))
+    return base_url, kind, failure or (payload, result['listings'])
+
+
+async def remote_pipeline_worker(fetcher, data):
+    """Run pipeline_worker on an item leased from a coordinator and encode its result."""
+    _, kind, result = await pipeline_worker(fetcher, decode_item(data))
+    return encode_result(kind, result)
+
+
+def coordinate_regions(base_urls, host='0.0.0.0', port=DEFAULT_COORDINATOR_PORT, max_levels=6,
+                       visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, scrape=True, refresh=False):
+    """Hand the work of crawl_regions out to run_worker processes, possibly on other machines,
+    and save the results they post back. Returns once every item is done.
+
+    Only this process writes to the database. Workers lease batches of items,
+    and a batch that is not posted back within visibility_timeout seconds is
+    leased to another worker.
+    """
+    with connect(SQLITE_DB_PATH) as db:
+        store = open_page_store(db)
+        regions, seen_pages, items = start_regions(db, base_urls, max_levels, scrape, refresh)
+        queue = LeaseQueue(key=lambda item: item[0], visibility_timeout=visibility_timeout)
+        queue.add(encode_item(item) for item in items)
+
+        def save_results(results):
+            decoded = [decode_result(item, result) for item, result in results]
+            new_items = save_region_results(db, regions, decoded, store, seen_pages, max_levels, scrape)
+            return [encode_item(item) for item in new_items]
+
+        serve_until_done(coordinator_app(queue, save_results), queue, host, port)
+        finish_regions(db, regions, store)
+    LOGGER.warning('Finished coordinating {} regions, {} leases expired'.format(len(regions), queue.expired))
+
+
+def run_worker(coordinator_url, scheduler, concurrency=DEFAULT_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS,
+               lease_size=DEFAULT_LEASE_SIZE, cache=None):
+    """Fetch the work leased from the coordinator at coordinator_url through this machine's proxies."""
+    num_items = run_leased_work(coordinator_url, remote_pipeline_worker, lease_size=lease_size, headers=HEADER,
+                                concurrency=concurrency, scheduler=scheduler, max_attempts=max_attempts, cache=cache)
+    LOGGER.warning('Finished {} items for {}!'.format(num_items, coordinator_url))
+
+
+def read_regions(path):
+    """Return the base urls listed one per line in path, skipping blank lines and # comments."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
 
 
 if __name__ == '__main__':
@@ -308,19 +733,90 @@ if __name__ == '__main__':
              'Or just contain ip_addr,port columns if no auth needed.'
     )
     parser.add_argument(
-        'redfin_base_url',
+        'redfin_base_url', nargs='*',
         help='Redfin base url to specify the crawling location, '
-             'e.g., https://www.redfin.com/city/11203/CA/Los-Angeles/'
+             'e.g., https://www.redfin.com/city/11203/CA/Los-Angeles/. '
+             'With several urls, pages and properties crawl all of them together, see --regions_file.'
     )
+    parser.add_argument('--regions_file',
+                        help="File with more base urls, one per line. All regions are crawled through one work queue "
+                             "that takes turns between them, sharing the proxy budget.")
     parser.add_argument('--type', default='pages',
-                        choices=['properties', 'pages', 'property_details', 'filtered_properties'],
-                        help='pages or properties (default: properties)')
+                        choices=['properties', 'pages', 'property_details', 'filtered_properties',
+                                 'compact_listings', 'refresh'],
+                        help='pages or properties (default: properties). refresh probes the stored leaves and '
+                             'scrapes the pages of those whose counts changed. A leaf where as many sales came in '
+                             'as dropped out keeps its count and is missed.')
     parser.add_argument('--property_prefix', default='',
-                        help='The property prefix for crawling')
+                        help='Only scrape partition urls starting with this prefix')
     parser.add_argument('--partition_levels',
                         help="Determine the depth of partition. The higher the more properties scraped.",
                         type=int,
                         default=12)
+    parser.add_argument('--concurrency',
+                        help="Maximum number of requests in flight across all proxies.",
+                        type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--batch_size',
+                        help="Number of pages committed to sqlite at a time.",
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--proxy_rps',
+                        help="Requests per second allowed through each proxy.",
+                        type=float,
+                        default=DEFAULT_PROXY_RPS)
+    parser.add_argument('--global_rps',
+                        help="Requests per second allowed across all proxies. 0 means no global limit.",
+                        type=float,
+                        default=DEFAULT_GLOBAL_RPS)
+    parser.add_argument('--max_attempts',
+                        help="Attempts per url, each through a different proxy, before it goes to FAILED_URLS.",
+                        type=int,
+                        default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--warm_up', action='store_true',
+                        help="Probe every proxy before crawling and drop the ones that do not respond.")
+    parser.add_argument('--parse_workers',
+                        help="Processes used to parse listing details. Defaults to the number of CPUs.",
+                        type=int)
+    parser.add_argument('--full_parse', action='store_true',
+                        help="Re-parse every scraped page instead of only the pages added since the last parse.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="With --type properties, scrape the pages of each partition leaf as soon as it is found "
+                             "instead of after the whole partition.")
+    parser.add_argument('--cache_ttl',
+                        help="Hours a cached response is used without asking the server. "
+                             "Older responses are revalidated with a conditional request.",
+                        type=float,
+                        default=DEFAULT_TTL / 3600)
+    parser.add_argument('--cache_max_age',
+                        help="Days after which a cached response is deleted when the cache is opened. "
+                             "0 keeps every response.",
+                        type=float,
+                        default=DEFAULT_MAX_AGE / 86400)
+    parser.add_argument('--replay', action='store_true',
+                        help="Serve every request from the HTTP cache, without any network traffic.")
+    parser.add_argument('--no_http_cache', action='store_true',
+                        help="Neither read nor write the HTTP cache.")
+    parser.add_argument('--serve_port', type=int,
+                        help="Coordinate a distributed crawl of the regions on this port instead of fetching. "
+                             "Workers started with --coordinator_url do the fetching.")
+    parser.add_argument('--coordinator_url',
+                        help="Work for the coordinator at this url, e.g. http://10.0.0.5:{}/, "
+                             "fetching through the proxies of this machine.".format(DEFAULT_COORDINATOR_PORT))
+    parser.add_argument('--visibility_timeout', type=float, default=DEFAULT_VISIBILITY_TIMEOUT,
+                        help="Seconds a worker has to post back the results of a lease before it goes to another.")
+    parser.add_argument('--lease_size', type=int, default=DEFAULT_LEASE_SIZE,
+                        help="Number of urls a worker leases at a time.")
+    parser.add_argument('--fresh', action='store_true',
+                        help="Ignore the checkpointed partition progress of this url and start over.")
+    parser.add_argument('--metrics_file',
+                        help="Write request, latency, parse and db write metrics to this JSON file while crawling.")
+    parser.add_argument('--metrics_interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between two writes of --metrics_file.")
+    parser.add_argument('--metrics_port', type=int,
+                        help="Serve the live metrics on http://127.0.0.1:PORT/metrics.")
+    parser.add_argument('--profile',
+                        help="Run under cProfile and write the stats to this file, see python -m pstats.")
     parser.add_argument('--logging_level', default='info', choices=['info', 'debug'])
     args = parser.parse_args()
 
@@ -331,20 +827,78 @@ if __name__ == '__main__':
     LOGGER = logging.getLogger(__name__)
 
     create_tables_if_not_exist()
-    redfin_base_url = args.redfin_base_url
-    if redfin_base_url[-1] != '/':
-        redfin_base_url += '/'
+    regions = args.redfin_base_url + (read_regions(args.regions_file) if args.regions_file else [])
+    if not regions and not args.coordinator_url:
+        parser.error('Give at least one redfin_base_url or a --regions_file')
+    regions = list(collections.OrderedDict.fromkeys(url if url.endswith('/') else url + '/' for url in regions))
+    redfin_base_url = regions[0] if regions else None
+
+    if args.fresh:
+        for region in regions:
+            reset_frontier(region)
 
     proxies = pd.read_csv(args.proxy_csv_path, encoding='utf-8').values
-    if args.type == 'pages':
-        url_partition(redfin_base_url, proxies, max_levels=args.partition_levels)
-    elif args.type == 'properties':
-        url_partition(redfin_base_url, proxies, max_levels=args.partition_levels)
-        crawl_redfin_with_proxies(proxies)
-        parse_addresses()
-    elif args.type == 'property_details':
-        parse_addresses()
-    elif args.type == 'filtered_properties':
-        crawl_redfin_with_proxies(proxies, args.property_prefix)
-    else:
-        raise Exception('Unknown type {}'.format(args.type))
+    proxy_pool = ProxyPool([construct_proxy(*p) for p in proxies])
+    if args.warm_up:
+        proxy_pool.warm_up(headers=HEADER)
+    scheduler = RateScheduler(proxy_pool.proxies, proxy_rps=args.proxy_rps, global_rps=args.global_rps,
+                              pool=proxy_pool)
+    cache = None
+    if not args.no_http_cache:
+        cache = HttpCache(HTTP_CACHE_PATH, ttl=args.cache_ttl * 3600, replay=args.replay,
+                          max_age=args.cache_max_age * 86400)
+    snapshots = SnapshotWriter(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+    if snapshots:
+        snapshots.start()
+    metrics_server = serve_metrics(args.metrics_port) if args.metrics_port else None
+    with profiled(args.profile) if args.profile else contextlib.nullcontext():
+        if args.coordinator_url:
+            run_worker(args.coordinator_url, scheduler, concurrency=args.concurrency, max_attempts=args.max_attempts,
+                       lease_size=args.lease_size, cache=cache)
+        elif args.serve_port and args.type in ('pages', 'properties', 'refresh'):
+            coordinate_regions(regions, port=args.serve_port, max_levels=args.partition_levels,
+                               visibility_timeout=args.visibility_timeout, scrape=args.type != 'pages',
+                               refresh=args.type == 'refresh')
+            if args.type != 'pages':
+                parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif len(regions) > 1 and args.type in ('pages', 'properties'):
+            crawl_regions(regions, scheduler, max_levels=args.partition_levels, concurrency=args.concurrency,
+                          max_attempts=args.max_attempts, batch_size=args.batch_size, cache=cache,
+                          scrape=args.type == 'properties')
+            if args.type == 'properties':
+                parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif args.type == 'pages':
+            url_partition(redfin_base_url, scheduler, max_levels=args.partition_levels,
+                          concurrency=args.concurrency, max_attempts=args.max_attempts, batch_size=args.batch_size,
+                          cache=cache)
+        elif args.type == 'properties' and args.pipeline:
+            crawl_pipelined(redfin_base_url, scheduler, max_levels=args.partition_levels,
+                            concurrency=args.concurrency, max_attempts=args.max_attempts, batch_size=args.batch_size,
+                            cache=cache)
+            parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif args.type == 'properties':
+            url_partition(redfin_base_url, scheduler, max_levels=args.partition_levels,
+                          concurrency=args.concurrency, max_attempts=args.max_attempts, batch_size=args.batch_size,
+                          cache=cache)
+            crawl_redfin_with_proxies(scheduler, concurrency=args.concurrency, batch_size=args.batch_size,
+                                      max_attempts=args.max_attempts, cache=cache)
+            parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif args.type == 'refresh':
+            crawl_regions(regions, scheduler, max_levels=args.partition_levels, concurrency=args.concurrency,
+                          max_attempts=args.max_attempts, batch_size=args.batch_size, cache=cache, refresh=True)
+            parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif args.type == 'property_details':
+            parse_addresses(batch_size=args.batch_size, workers=args.parse_workers, full=args.full_parse)
+        elif args.type == 'filtered_properties':
+            crawl_redfin_with_proxies(scheduler, args.property_prefix, concurrency=args.concurrency,
+                                      batch_size=args.batch_size, max_attempts=args.max_attempts, cache=cache)
+        elif args.type == 'compact_listings':
+            compact_listings(batch_size=args.batch_size)
+        else:
+            raise Exception('Unknown type {}'.format(args.type))
+    if cache is not None:
+        cache.close()
+    if snapshots:
+        snapshots.stop()
+    if metrics_server:
+        metrics_server.shutdown()
@@ -0,0 +1,151 @@
+"""Export LISTING_DETAILS to a Parquet or Arrow IPC dataset for analytics.
+
+Rows are streamed out of SQLite in chunks, typed, and written as a hive
+partitioned dataset, one directory per region and locality:
+
+    listings/REGION=CA/LOCALITY=San%20Jose/part-<version>-<chunk>-0.parquet
+
+Low-cardinality text columns are dictionary encoded. The export is
+incremental: every run only writes the rows that were added or changed
+since the last export to the same directory, as new files next to the old
+ones. A listing that changed is then in more than one file; keep the row
+with the highest VERSION of each URL, e.g. with latest_listings:
+
+    python redfin_export.py redfin_properties.db listings/
+    python redfin_export.py redfin_properties.db listings.arrow/ --format ipc --full
+"""
+import argparse
+import itertools
+import logging
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from redfin_listings import LISTING_DETAILS_COLUMNS
+from redfin_storage import connect, get_state, migrate, set_state
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50000
+FORMATS = {'parquet': 'parquet', 'ipc': 'arrow'}
+PARTITION_COLUMNS = ('REGION', 'LOCALITY')
+
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+SCHEMA = pa.schema([
+    ('URL', pa.string()),
+    ('NUMBER_OF_ROOMS', pa.int32()),
+    ('NAME', pa.string()),
+    ('COUNTRY', _CATEGORY),
+    ('REGION', pa.string()),
+    ('LOCALITY', pa.string()),
+    ('STREET', pa.string()),
+    ('POSTAL', _CATEGORY),
+    ('TYPE', _CATEGORY),
+    ('PRICE', pa.float64()),
+    ('VERSION', pa.int64()),
+])
+PARTITIONING = ds.partitioning(pa.schema([SCHEMA.field(c) for c in PARTITION_COLUMNS]), flavor='hive')
+
+
+def _to_int(value):
+    # SQLite keeps values of the INT column that do not look like numbers as TEXT.
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() and abs(number) < 2 ** 31 else None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_text(value):
+    return None if value is None else str(value)
+
+
+CONVERTERS = {'NUMBER_OF_ROOMS': _to_int, 'PRICE': _to_float, 'VERSION': int}
+
+
+def to_record_batch(rows):
+    """Return a RecordBatch of SCHEMA from LISTING_DETAILS rows, nulling values that do not fit their type."""
+    columns = zip(*rows) if rows else [()] * len(SCHEMA)
+    arrays = []
+    for field, values in zip(SCHEMA, columns):
+        convert = CONVERTERS.get(field.name, _to_text)
+        values = [None if v is None else convert(v) for v in values]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def export_listing_details(db_path, output, fmt='parquet', full=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write the LISTING_DETAILS rows changed since the last export to output to a dataset there.
+    With full set, output is rewritten from scratch. Return the number of rows written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format {}'.format(fmt))
+    state_key = 'exported_version:{}:{}'.format(fmt, os.path.abspath(output))
+    with connect(db_path) as db:
+        migrate(db)
+        # Rows parsed before LISTING_DETAILS had versions are at version 0.
+        since = -1 if full else get_state(db, state_key, -1)
+        version = get_state(db, 'listing_details_version', 0)
+        if full and os.path.isdir(output):
+            shutil.rmtree(output)
+        num_rows, = db.execute("SELECT COUNT(*) FROM LISTING_DETAILS WHERE VERSION > ?", (since,)).fetchone()
+        if num_rows:
+            # Sorted by partition, so every file of a run holds one region and locality.
+            cursor = db.execute("""
+                SELECT {columns}, VERSION FROM LISTING_DETAILS
+                WHERE VERSION > ?
+                ORDER BY REGION, LOCALITY""".format(columns=', '.join(LISTING_DETAILS_COLUMNS)), (since,))
+            # Written a chunk at a time, as the dataset writer would pull from the cursor in its own thread.
+            for chunk in itertools.count():
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                ds.write_dataset(to_record_batch(rows), output, format=fmt, partitioning=PARTITIONING,
+                                 basename_template='part-{}-{}-{{i}}.{}'.format(version, chunk, FORMATS[fmt]),
+                                 existing_data_behavior='overwrite_or_ignore')
+        set_state(db, state_key, version)
+        db.commit()
+    LOGGER.info('Exported {} listing details to {}'.format(num_rows, output))
+    return num_rows
+
+
+def read_listing_details(output, fmt='parquet'):
+    """Return the dataset exported to output."""
+    return ds.dataset(output, format=fmt, partitioning=PARTITIONING)
+
+
+def latest_listings(table):
+    """Keep the row with the highest VERSION of every URL of an exported table."""
+    table = table.sort_by([('URL', 'ascending'), ('VERSION', 'descending')])
+    urls = table.column('URL').combine_chunks()
+    if len(urls) < 2:
+        return table
+    first = pc.fill_null(pc.not_equal(urls.slice(1), urls.slice(0, len(urls) - 1)), True)
+    return table.filter(pa.concat_arrays([pa.array([True]), first]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export LISTING_DETAILS to a partitioned Parquet or Arrow dataset.')
+    parser.add_argument('db_path', help='Crawler database, e.g. redfin_properties.db.')
+    parser.add_argument('output', help='Directory of the dataset. Later runs append the rows changed since.')
+    parser.add_argument('--format', default='parquet', choices=sorted(FORMATS),
+                        help='parquet, or ipc for Arrow IPC (Feather v2) files.')
+    parser.add_argument('--full', action='store_true', help='Rewrite the dataset with every row.')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Number of rows read from SQLite at a time.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    export_listing_details(args.db_path, args.output, fmt=args.format, full=args.full, chunk_size=args.chunk_size)
@@ -0,0 +1,72 @@
+"""Fast extraction of the few elements the crawler reads from a Redfin results page.
+
+Only three things are needed from a page: the JSON-LD script blocks, the
+"homes summary" div and the goToPage anchors. They are pulled out with
+precompiled regular expressions instead of building a DOM for the whole page.
+When a marker is present but the fast scan cannot make sense of it, we fall
+back to BeautifulSoup.
+"""
+import html as html_lib
+import json
+import logging
+import re
+
+from bs4 import BeautifulSoup
+
+LOGGER = logging.getLogger(__name__)
+
+LD_JSON_MARKER = 'application/ld+json'
+SUMMARY_MARKER = 'homes summary'
+GO_TO_PAGE_MARKER = 'goToPage'
+
+LD_JSON_PATTERN = re.compile(
+    r'<script[^>]*\btype=["\']application/ld\+json["\'][^>]*>(.*?)</script\s*>', re.S | re.I)
+SUMMARY_PATTERN = re.compile(r'<div[^>]*\bclass=["\']homes summary["\'][^>]*>(.*?)</div\s*>', re.S | re.I)
+GO_TO_PAGE_PATTERN = re.compile(r'<a[^>]*\bclass=["\'][^"\']*\bgoToPage\b[^"\']*["\'][^>]*>(.*?)</a\s*>',
+                                re.S | re.I)
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
+def _text(fragment):
+    return html_lib.unescape(TAG_PATTERN.sub('', fragment))
+
+
+def extract_listings_bs4(html):
+    bf = BeautifulSoup(html, 'lxml')
+    return [json.loads(x.text) for x in bf.find_all('script', type='application/ld+json')]
+
+
+def extract_summary_bs4(html):
+    bf = BeautifulSoup(html, 'lxml')
+    page_description_div = bf.find('div', {'class': 'homes summary'})
+    if not page_description_div:
+        return None, []
+    pages = [int(x.get_text()) for x in bf.find_all('a', {'class': "goToPage"})]
+    return page_description_div.get_text(), pages
+
+
+def extract_listings(html):
+    """Return the parsed JSON-LD blocks of a page."""
+    if LD_JSON_MARKER not in html:
+        return []
+    blocks = LD_JSON_PATTERN.findall(html)
+    if not blocks:
+        LOGGER.debug('Fast JSON-LD scan found nothing, falling back to BeautifulSoup')
+        return extract_listings_bs4(html)
+    return [json.loads(block) for block in blocks]
+
+
+def extract_summary(html):
+    """Return (text of the homes summary div, goToPage numbers).
+    The text is None when the page has no summary, i.e. no results.
+    """
+    if SUMMARY_MARKER not in html:
+        return None, []
+    m = SUMMARY_PATTERN.search(html)
+    if not m:
+        LOGGER.debug('Fast summary scan found nothing, falling back to BeautifulSoup')
+        return extract_summary_bs4(html)
+    pages = []
+    if GO_TO_PAGE_MARKER in html:
+        pages = [int(_text(x)) for x in GO_TO_PAGE_PATTERN.findall(html)]
+    return _text(m.group(1)), pages
@@ -0,0 +1,330 @@
+"""Local stand-in for Redfin search pages, and a stub proxy in front of it.
+
+The server answers partition and page urls like Redfin does, from a
+synthetic set of listings: a "homes summary" div with the count, goToPage
+anchors for at most max_pages pages, and one JSON-LD block per listing on
+the page, sorted by price. Filter ranges are read with the crawler's own
+parser and treated as half-open, so sibling partitions never share a
+listing. Latency and error responses can be injected, on the server and on
+every proxy stub, to measure crawler throughput, partition request counts
+and tail latency without touching redfin.com.
+
+    python redfin_fake_server.py --listings 20000 --proxies 4 --proxy_csv fake_proxies.csv
+    python redfin_crawler.py fake_proxies.csv http://127.0.0.1:8765/city/17420/CA/San-Jose/ --type properties
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import csv
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+
+import aiohttp
+from aiohttp import web
+
+from redfin_filters import MAX_PRICE, MAX_SQFT, MAX_YEAR, MIN_PRICE, MIN_SQFT, MIN_YEAR
+from redfin_partition import OPEN_ENDED, parse_filters
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+BASE_PATH = '/city/17420/CA/San-Jose/'
+PER_PAGE = 20
+MAX_PAGES = 18
+ERROR_STATUSES = (429, 503)
+PAGE_PATTERN = re.compile(r'/page-(\d+)$')
+STREETS = ('Main St', 'Oak Ave', 'Elm St', 'Park Ave', 'Lincoln Way', 'Willow St', 'Meridian Ave', 'Almaden Rd')
+
+Listing = collections.namedtuple('Listing', ['url', 'price', 'sqft', 'year', 'beds', 'block'])
+
+
+def _clip(value, lo, hi):
+    return int(min(hi - 1, max(lo, value)))
+
+
+def _listing(i, price, sqft, year, beds):
+    street = '{} {}'.format(100 + i % 9900, STREETS[i % len(STREETS)])
+    postal = str(95110 + i % 30)
+    url = '/CA/San-Jose/{}-95{}/home/{}'.format(street.replace(' ', '-'), postal[2:], 1000000 + i)
+    block = json.dumps([
+        {'@context': 'http://schema.org', '@type': 'SingleFamilyResidence', 'url': url, 'name': street,
+         'numberOfRooms': beds,
+         'address': {'@type': 'PostalAddress', 'streetAddress': street, 'addressLocality': 'San Jose',
+                     'addressRegion': 'CA', 'postalCode': postal, 'addressCountry': 'US'}},
+        {'@type': 'Product', 'offers': {'@type': 'Offer', 'price': price, 'priceCurrency': 'USD'}},
+    ])
+    return Listing(url, price, sqft, year, beds,
+                   '<script type="application/ld+json">{}</script>'.format(block))
+
+
+def generate_listings(count, seed=0, price_median=650000, price_sigma=0.7, towers=0, tower_size=400, first_id=0):
+    """Return count synthetic listings sorted by price.
+
+    Prices are log-normal around price_median. Square footage follows the price
+    at a log-normal price per sqft, beds follow the square footage and years are
+    spread a bit beyond the filter range with a post-war bump. Each of the towers is a
+    block of tower_size condos in a narrow price band, which the partitioner
+    cannot split by price alone. Listing ids start at first_id.
+    """
+    rng = random.Random(seed)
+    listings = []
+    min_beds, max_beds = OPEN_ENDED['beds']
+    for i in range(count):
+        price = _clip(round(rng.lognormvariate(math.log(price_median), price_sigma), -2), MIN_PRICE, MAX_PRICE)
+        # Sizes and years reach beyond the ranges the partitioner splits in.
+        sqft = _clip(price / rng.lognormvariate(math.log(450), 0.5), 1, 2 * MAX_SQFT)
+        year = _clip(rng.gauss(1965, 12) if rng.random() < 0.4 else rng.uniform(MIN_YEAR - 20, MAX_YEAR + 6),
+                     MIN_YEAR - 20, MAX_YEAR + 6)
+        beds = _clip(sqft / 550 + rng.gauss(0, 0.7), min_beds, max_beds)
+        listings.append((price, sqft, year, beds))
+    for _tower in range(towers):
+        price = rng.randrange(400000, 900000, 1000)
+        year = rng.randrange(2000, MAX_YEAR)
+        for _ in range(tower_size):
+            sqft = rng.randrange(500, 1400)
+            listings.append((price + rng.randrange(0, 2000, 100), sqft, year,
+                             _clip(sqft / 450, min_beds, max_beds)))
+    listings.sort()
+    return [_listing(i, *values) for i, values in enumerate(listings, start=first_id)]
+
+
+def churn(listings, sold=0.02, added=0.02, seed=1, **options):
+    """Return listings a day later: a sold share of them is gone and an added share
+    of new ones, drawn like generate_listings(**options), is on the market.
+    """
+    rng = random.Random(seed)
+    kept = [listing for listing in listings if rng.random() >= sold]
+    first_id = 1 + max(int(listing.url.rsplit('/', 1)[1]) - 1000000 for listing in listings) if listings else 0
+    new = generate_listings(round(added * len(listings)), seed=seed, first_id=first_id, **options)
+    return sorted(kept + new, key=lambda listing: listing.price)
+
+
+class FakeRedfin:
+    """aiohttp handler serving the search pages of a set of listings.
+
+    latency is the median response delay in seconds, spread log-normally by
+    latency_sigma. error_rate of the requests get one of error_statuses.
+    stats counts requests, response statuses and listings served.
+    """
+
+    def __init__(self, listings, per_page=PER_PAGE, max_pages=MAX_PAGES, latency=0, latency_sigma=0.5,
+                 error_rate=0, error_statuses=ERROR_STATUSES, seed=0):
+        self.update(listings)
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.rng = random.Random(seed)
+        self.stats = collections.Counter()
+        self.failures = []
+        self.failed = collections.Counter()
+
+    def fail(self, fragment, times=None, status=503):
+        """Answer status to the first times requests of every url whose path contains fragment,
+        or to all of them if times is None.
+        """
+        self.failures.append((fragment, times, status))
+
+    def update(self, listings):
+        """Serve listings, sorted by price, from now on."""
+        self.listings = listings
+        self.prices = [listing.price for listing in listings]
+
+    def search(self, filter_str):
+        """Listings matching the filters of a url, in price order."""
+        ranges = parse_filters(filter_str)
+        price = ranges.pop('price', None)
+        start, end = 0, len(self.listings)
+        if price is not None and price.lo is not None:
+            start = bisect.bisect_left(self.prices, price.lo)
+        if price is not None and price.hi is not None:
+            end = bisect.bisect_left(self.prices, price.hi)
+        # An end the url leaves out is open on Redfin, even though parse_filters fills it in.
+        checks = [(r.dimension, None if r.lo == OPEN_ENDED[r.dimension][0] else r.lo,
+                   None if r.hi == OPEN_ENDED[r.dimension][1] else r.hi) for r in ranges.values()]
+        return [listing for listing in self.listings[start:end]
+                if all((lo is None or getattr(listing, d) >= lo) and (hi is None or getattr(listing, d) < hi)
+                       for d, lo, hi in checks)]
+
+    def render(self, matches, page):
+        if not matches:
+            return '<html><body><div class="noResults">No results</div></body></html>'
+        num_pages = min(self.max_pages, math.ceil(len(matches) / self.per_page))
+        on_page = matches[(page - 1) * self.per_page:page * self.per_page] if page <= num_pages else []
+        if num_pages > 1:
+            summary = 'Showing {} of {} homes'.format(self.per_page, len(matches))
+        else:
+            summary = 'Showing {} homes'.format(len(matches))
+        links = ''.join('<a class="clickable goToPage" href="#">{}</a>'.format(p) for p in range(1, num_pages + 1))
+        return '<html><body><div class="homes summary">{}</div>{}<div class="PagingControls">{}</div></body></html>'\
+            .format(summary, ''.join(listing.block for listing in on_page), links)
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.rng.lognormvariate(math.log(self.latency), self.latency_sigma))
+
+    async def handle(self, request):
+        self.stats['requests'] += 1
+        await self.delay()
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return self.respond(web.Response(status=self.rng.choice(self.error_statuses)))
+        for fragment, times, status in self.failures:
+            if fragment in request.path and (times is None or self.failed[fragment, request.path] < times):
+                self.failed[fragment, request.path] += 1
+                return self.respond(web.Response(status=status))
+
+        path, page = request.path, 1
+        m = PAGE_PATTERN.search(path)
+        if m:
+            path, page = path[:m.start()], int(m.group(1))
+        _, _, filter_str = path.partition('/filter/')
+        matches = self.search(filter_str)
+        body = self.render(matches, page)
+        etag = '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return self.respond(web.Response(status=304, headers={'ETag': etag}))
+        self.stats['listings'] += min(self.per_page, max(0, len(matches) - (page - 1) * self.per_page))
+        return self.respond(web.Response(text=body, content_type='text/html', headers={'ETag': etag}))
+
+    def respond(self, response):
+        self.stats[response.status] += 1
+        return response
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self.handle)
+        return app
+
+
+class ProxyStub:
+    """Plain HTTP forward proxy with injected latency, blocks (403) and errors.
+    Only absolute-form http requests are relayed; there is no CONNECT support.
+    """
+
+    def __init__(self, latency=0, latency_sigma=0.5, block_rate=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.block_rate = block_rate
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.stats = collections.Counter()
+        self.session = None
+
+    async def handle(self, request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.lognormvariate(math.log(self.latency), self.latency_sigma))
+        roll = self.rng.random()
+        if roll < self.block_rate:
+            self.stats[403] += 1
+            return web.Response(status=403)
+        if roll < self.block_rate + self.error_rate:
+            self.stats[502] += 1
+            return web.Response(status=502)
+        if self.session is None:
+            self.session = aiohttp.ClientSession(auto_decompress=False)
+        headers = {k: v for k, v in request.headers.items()
+                   if k.lower() in ('user-agent', 'if-none-match', 'if-modified-since')}
+        async with self.session.get(str(request.url), headers=headers) as resp:
+            body = await resp.read()
+            self.stats[resp.status] += 1
+            return web.Response(body=body, status=resp.status,
+                                headers={k: v for k, v in resp.headers.items()
+                                         if k.lower() in ('content-type', 'etag', 'last-modified')})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+
+        async def on_cleanup(_):
+            await self.close()
+        app.on_cleanup.append(on_cleanup)
+        return app
+
+
+class ServerThread:
+    """Serve aiohttp applications from an event loop in a background thread,
+    so a crawl can run against them in the same process.
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.runners = []
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def _start(self, app, port):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, port)
+        await site.start()
+        self.runners.append(runner)
+        return runner.addresses[0][1]
+
+    def start(self, app, port=0):
+        """Serve app on port, a free one by default. Return the port."""
+        return asyncio.run_coroutine_threadsafe(self._start(app, port), self.loop).result()
+
+    def stop(self):
+        async def cleanup():
+            for runner in self.runners:
+                await runner.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def write_proxy_csv(path, host, ports):
+    """Write the proxy csv the crawler reads, one ip_addr,port row per proxy stub."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ip_addr', 'port'])
+        writer.writerows((host, port) for port in ports)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic Redfin search pages locally.')
+    parser.add_argument('--listings', type=int, default=20000, help='Number of synthetic listings.')
+    parser.add_argument('--towers', type=int, default=0, help='Condo towers: blocks of listings in one price band.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0, help='Median response delay in seconds.')
+    parser.add_argument('--error_rate', type=float, default=0, help='Share of requests answered with 429 or 503.')
+    parser.add_argument('--proxies', type=int, default=0, help='Number of proxy stubs, on the ports after --port.')
+    parser.add_argument('--proxy_latency', type=float, default=0, help='Median delay added by each proxy stub.')
+    parser.add_argument('--proxy_block_rate', type=float, default=0, help='Share of proxied requests answered 403.')
+    parser.add_argument('--proxy_csv', help='Write the proxy stubs to this csv, for redfin_crawler.py.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = ServerThread(args.host)
+    fake = FakeRedfin(generate_listings(args.listings, args.seed, towers=args.towers),
+                      latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    server.start(fake.app(), args.port)
+    proxy_ports = [server.start(ProxyStub(args.proxy_latency, block_rate=args.proxy_block_rate,
+                                          seed=args.seed + i).app(), args.port + i)
+                   for i in range(1, args.proxies + 1)]
+    if args.proxy_csv:
+        write_proxy_csv(args.proxy_csv, args.host, proxy_ports)
+    LOGGER.info('Serving {} listings at http://{}:{}{} through {} proxy stubs'.format(
+        len(fake.listings), args.host, args.port, BASE_PATH, len(proxy_ports)))
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+        LOGGER.info('Served {}'.format(dict(fake.stats)))
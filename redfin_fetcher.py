@@ -0,0 +1,294 @@
+"""Asyncio fetch engine shared by the partition and scrape stages.
+
+All requests go through one event loop. Every proxy gets its own aiohttp
+session (and therefore its own connection pool), and a global semaphore caps
+the number of requests in flight across all proxies. With an HttpCache,
+fresh cached responses are served without a request and stale ones are
+revalidated with a conditional GET. Requests are counted and timed per
+proxy in redfin_metrics.METRICS.
+"""
+import asyncio
+import collections
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from redfin_http_cache import CacheMiss
+from redfin_metrics import METRICS
+from redfin_rate_limit import NoProxyAvailableException
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 200
+DEFAULT_CONNECTIONS_PER_PROXY = 8
+DEFAULT_TIMEOUT = 60
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF = 2
+DEFAULT_MAX_BACKOFF = 60
+RETRYABLE_STATUSES = (403, 408, 429, 500, 502, 503, 504)
+_DONE = object()
+
+
+def proxy_label(proxy_url):
+    """host:port of a proxy url without its credentials, to label metrics with."""
+    if not proxy_url:
+        return 'direct'
+    parts = urlsplit(proxy_url)
+    return '{}:{}'.format(parts.hostname, parts.port) if parts.port else parts.hostname
+
+
+def proxy_url_for(url, proxy):
+    """Pick the proxy entry matching the url scheme, like requests does with its proxies dict."""
+    if not proxy:
+        return None
+    return proxy.get(urlsplit(url).scheme) or proxy.get('http')
+
+
+class FetchFailedException(Exception):
+    def __init__(self, url, attempts, error):
+        super().__init__('{} failed after {} attempts: {!r}'.format(url, attempts, error))
+        self.url = url
+        self.attempts = attempts
+        self.error = error
+
+
+def is_retryable(error):
+    """Network errors and timeouts are always retried, HTTP errors only for RETRYABLE_STATUSES."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return True
+
+
+class AsyncFetcher:
+    """Fetch pages concurrently with one connection pool per proxy.
+
+    Failed requests are retried up to max_attempts times with exponential
+    backoff, each time through a proxy that has not been tried for that url yet.
+    """
+
+    def __init__(self, headers=None, concurrency=DEFAULT_CONCURRENCY,
+                 connections_per_proxy=DEFAULT_CONNECTIONS_PER_PROXY, timeout=DEFAULT_TIMEOUT, scheduler=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 cache=None):
+        self.headers = headers
+        self.scheduler = scheduler
+        self.cache = cache
+        self.concurrency = concurrency
+        self.connections_per_proxy = connections_per_proxy
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.sessions = {}
+
+    def _session(self, proxy_url):
+        session = self.sessions.get(proxy_url)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=self.connections_per_proxy)
+            session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+            self.sessions[proxy_url] = session
+        return session
+
+    async def _fetch_once(self, url, proxy, tried, headers=None):
+        """Return (status, response headers, body). A 304 answer comes back with an empty body."""
+        async with self.semaphore:
+            index = None
+            if proxy is None and self.scheduler:
+                with METRICS.timer('proxy_wait_seconds'):
+                    index = await self.scheduler.acquire_index(exclude=tried)
+                tried.add(index)
+                proxy = self.scheduler.proxies[index]
+            proxy_url = proxy_url_for(url, proxy)
+            status, start = None, time.monotonic()
+            try:
+                async with self._session(proxy_url).get(url, proxy=proxy_url, headers=headers) as resp:
+                    status = resp.status
+                    resp.raise_for_status()
+                    return status, resp.headers, await resp.text()
+            finally:
+                elapsed = time.monotonic() - start
+                if index is not None:
+                    self.scheduler.record(index, status, elapsed)
+                METRICS.incr('responses', status=status or 'error')
+                METRICS.observe('fetch_seconds', elapsed, proxy=proxy_label(proxy_url))
+
+    async def fetch(self, url, proxy=None, revalidate=False):
+        """Return the body of url fetched through proxy.
+        Without an explicit proxy, wait for the scheduler to hand one out.
+        With revalidate set, a cached response is checked with a conditional GET even while fresh.
+        Raise FetchFailedException once the url cannot be fetched, or no proxy is left to fetch it through.
+        """
+        cached, headers = None, None
+        if self.cache is not None:
+            try:
+                cached, fresh = self.cache.lookup(url, revalidate)
+            except CacheMiss as e:
+                raise FetchFailedException(url, 0, e) from e
+            if fresh:
+                METRICS.incr('cache_hits')
+                return cached.body
+            if cached is not None:
+                headers = self.cache.conditional_headers(cached)
+
+        tried = set()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                status, response_headers, body = await self._fetch_once(url, proxy, tried, headers)
+                if self.cache is None:
+                    return body
+                if status == 304:
+                    METRICS.incr('cache_revalidated')
+                    self.cache.touch(url)
+                    return cached.body
+                self.cache.put(url, body, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+                return body
+            except NoProxyAvailableException as e:
+                METRICS.incr('fetch_failures')
+                raise FetchFailedException(url, attempt, e) from e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_attempts or not is_retryable(e):
+                    METRICS.incr('fetch_failures')
+                    raise FetchFailedException(url, attempt, e) from e
+                METRICS.incr('fetch_retries')
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                LOGGER.debug('Retrying {} in {:.1f}s after {!r}'.format(url, delay, e))
+                # Back off outside the semaphore so waiting retries do not hold request slots.
+                await asyncio.sleep(delay * (0.5 + random.random() / 2))
+
+    async def close(self):
+        sessions, self.sessions = list(self.sessions.values()), {}
+        await asyncio.gather(*(session.close() for session in sessions))
+
+
+def run_all(worker, inputs, **fetcher_options):
+    """Run the coroutine worker(fetcher, item) for every input on a single event loop.
+    fetcher_options are passed on to AsyncFetcher. Return the results in input order.
+    """
+    async def main():
+        fetcher = AsyncFetcher(**fetcher_options)
+        try:
+            return await asyncio.gather(*(worker(fetcher, item) for item in inputs))
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(main())
+
+
+def run_streaming(worker, inputs, write_batch, batch_size=DEFAULT_BATCH_SIZE, **fetcher_options):
+    """Run the coroutine worker(fetcher, item) for every input and hand completed results to
+    write_batch(results) in batches of batch_size, in completion order.
+
+    Results go through a bounded queue to a single writer, so at most about
+    concurrency + 2 * batch_size results are held in memory at any time.
+    Return the number of results written.
+    """
+    async def main():
+        fetcher = AsyncFetcher(**fetcher_options)
+        queue = asyncio.Queue(maxsize=batch_size)
+        items = iter(inputs)
+
+        async def produce():
+            for item in items:
+                await queue.put(await worker(fetcher, item))
+
+        async def consume():
+            written, batch = 0, []
+            while True:
+                result = await queue.get()
+                if result is _DONE:
+                    break
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    written, batch = written + len(batch), []
+            if batch:
+                write_batch(batch)
+                written += len(batch)
+            return written
+
+        async def produce_all():
+            await asyncio.gather(*(produce() for _ in range(fetcher.concurrency)))
+            await queue.put(_DONE)
+
+        # The producers block on the bounded queue, so they must not outlive a failed writer.
+        writer, producers = asyncio.create_task(consume()), asyncio.create_task(produce_all())
+        try:
+            await asyncio.wait([writer, producers], return_when=asyncio.FIRST_EXCEPTION)
+            for task in (writer, producers):
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+            return writer.result()
+        finally:
+            for task in (writer, producers):
+                task.cancel()
+            await asyncio.gather(writer, producers, return_exceptions=True)
+            await fetcher.close()
+
+    return asyncio.run(main())
+
+
+class FairQueue:
+    """Queue of inputs that takes turns between the keys of its inputs,
+    so that no key waits behind the backlog of another one.
+    """
+
+    def __init__(self, key, inputs=()):
+        self.key = key
+        self.queues = collections.OrderedDict()
+        self.extend(inputs)
+
+    def extend(self, inputs):
+        for item in inputs:
+            self.queues.setdefault(self.key(item), collections.deque()).append(item)
+
+    def popleft(self):
+        key, queue = next(iter(self.queues.items()))
+        item = queue.popleft()
+        # Move the key to the back of the line, or drop it once it has nothing left.
+        del self.queues[key]
+        if queue:
+            self.queues[key] = queue
+        return item
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def __bool__(self):
+        return bool(self.queues)
+
+
+def run_work_queue(worker, inputs, write_batch, batch_size=DEFAULT_BATCH_SIZE, key=None, **fetcher_options):
+    """Like run_streaming, but write_batch(results) may return new inputs, which join the
+    same queue. Runs until no input is queued, in flight or waiting to be written.
+
+    A batch is written as soon as it is full, or earlier when the queue runs dry,
+    so the inputs it produces reach idle workers without waiting for a full batch.
+    With a key function, inputs are started in turns between their keys, see FairQueue.
+    Return the number of results written.
+    """
+    async def main():
+        fetcher = AsyncFetcher(**fetcher_options)
+        queue = collections.deque(inputs) if key is None else FairQueue(key, inputs)
+        in_flight, batch, written = set(), [], 0
+        try:
+            while queue or in_flight or batch:
+                while queue and len(in_flight) < fetcher.concurrency:
+                    in_flight.add(asyncio.ensure_future(worker(fetcher, queue.popleft())))
+                if in_flight:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    batch.extend(task.result() for task in done)
+                if len(batch) >= batch_size or (batch and not queue):
+                    queue.extend(write_batch(batch) or ())
+                    written, batch = written + len(batch), []
+            return written
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await fetcher.close()
+
+    return asyncio.run(main())
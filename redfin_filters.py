@@ -1,88 +1,19 @@
-import re
 import logging
 
+from redfin_partition import OPEN_ENDED, Partition
+from redfin_planner import children_needed, expected_largest, plan_seed, plan_split
+
 LOGGER = logging.getLogger(__name__)
 
 
-MIN_SQFT_PATTERN = r'.*min-sqft=([0-9a-zA-Z]+)-sqft.*'
-MAX_SQFT_PATTERN = r'.*max-sqft=([0-9a-zA-Z]+)-sqft.*'
-MIN_SQFT = 10
-MAX_SQFT = 12000
+MIN_SQFT, MAX_SQFT = OPEN_ENDED['sqft']
 
-MIN_PRICE_PATTERN = r'.*min-price=([0-9a-zA-Z]+).*'
-MAX_PRICE_PATTERN = r'.*max-price=([0-9a-zA-Z]+).*'
 MIN_PRICE = 1000
 MAX_PRICE = 2000000
 
-MIN_YEAR_PATTERN = r'.*min-year-built=([0-9a-zA-Z]+).*'
-MAX_YEAR_PATTERN = r'.*max-year-built=([0-9a-zA-Z]+).*'
-MIN_YEAR = 1900
-MAX_YEAR = 2018
-
-# /filter/min-price=750k,max-price=780k,min-lot-size=3k-sqft,max-lot-size=4k-sqft,include=sold-3yr
-# min-year-built=2016
-# min-sqft=500-sqft
-BASE_FILTERS = ['include=sold-3yr']
-
-
-class MissPriceException(Exception):
-    pass
-
-
-class MissSqftException(Exception):
-    pass
-
-
-class MissYearException(Exception):
-    pass
-
-
-def parse_filter_params(filter_str):
-    min_sqft_m = re.match(MIN_SQFT_PATTERN, filter_str)
-    max_sqft_m = re.match(MAX_SQFT_PATTERN, filter_str)
-    min_price_m = re.match(MIN_PRICE_PATTERN, filter_str)
-    max_price_m = re.match(MAX_PRICE_PATTERN, filter_str)
-    min_year_m = re.match(MIN_YEAR_PATTERN, filter_str)
-    max_year_m = re.match(MAX_YEAR_PATTERN, filter_str)
-
-    min_sqft, max_sqft, min_price, max_price, min_year, max_year = None, None, None, None, None, None
-    if min_sqft_m:
-        min_sqft = int(min_sqft_m.group(1))
-    if max_sqft_m:
-        max_sqft = int(max_sqft_m.group(1))
-    if min_price_m:
-        min_price = int(min_price_m.group(1))
-    if max_price_m:
-        max_price = int(max_price_m.group(1))
-    if min_year_m:
-        min_year = int(min_year_m.group(1))
-    if max_year_m:
-        max_year = int(max_year_m.group(1))
-    return {
-        'min_sqft': min_sqft,
-        'max_sqft': max_sqft,
-        'min_price': min_price,
-        'max_price': max_price,
-        'min_year': min_year,
-        'max_year': max_year,
-    }
-
-
-def construct_filter_url(redfin_base_url, **kwargs):
-    filters = BASE_FILTERS[:]
-    if kwargs.get('min_price'):
-        filters.append('min-price={}'.format(kwargs['min_price']))
-    if kwargs.get('max_price'):
-        filters.append('max-price={}'.format(kwargs['max_price']))
-    if kwargs.get('min_sqft'):
-        filters.append('min-sqft={}-sqft'.format(kwargs['min_sqft']))
-    if kwargs.get('max_sqft'):
-        filters.append('max-sqft={}-sqft'.format(kwargs['max_sqft']))
-    if kwargs.get('min_year'):
-        filters.append('min-year-built={}'.format(kwargs['min_year']))
-    if kwargs.get('max_year'):
-        filters.append('max-year-built={}'.format(kwargs['max_year']))
-    return '{}filter/{}'.format(redfin_base_url, ','.join(filters))
+MIN_YEAR, MAX_YEAR = OPEN_ENDED['year']
+
+MIN_BEDS, MAX_BEDS = OPEN_ENDED['beds']
 
 
 def add_sqft_filters(min_sqft, max_sqft):
@@ -146,60 +77,174 @@ def add_year_filters(min_year, max_year):
     return year_filters
 
 
-def apply_filters(url, redfin_base_url):
-    """Apply more filters to make it more fine-grained.
-    Return a list of urls containing filters, which adds up
-    to the original url.
-    Filter priority: price, sqft-size, year-built
+def add_beds_filters(min_beds, max_beds):
+    # Half-open, one range per number of bedrooms.
+    return [(beds, beds + 1) for beds in range(min_beds, max_beds)]
+
+
+def price_granularity(price):
+    return 10000 if price >= 1000000 else 1000
+
+
+def sqft_granularity(sqft):
+    return 10 if sqft >= 1000 else 1
+
+
+def year_granularity(year):
+    return 1
+
+
+def beds_granularity(beds):
+    return 1
+
+
+# dimension -> (min param, max param, full range, granularity, fixed splitter), in split priority order
+DIMENSIONS = {
+    'price': ('min_price', 'max_price', (MIN_PRICE, MAX_PRICE), price_granularity, add_price_filters),
+    'sqft': ('min_sqft', 'max_sqft', (MIN_SQFT, MAX_SQFT), sqft_granularity, add_sqft_filters),
+    'year': ('min_year', 'max_year', (MIN_YEAR, MAX_YEAR), year_granularity, add_year_filters),
+    'beds': ('min_beds', 'max_beds', (MIN_BEDS, MAX_BEDS), beds_granularity, add_beds_filters),
+}
+
+
+# Rough share of listings per range of each dimension. They stand in for the sibling
+# partitions of a dimension until some are observed, and then weigh in as one of them.
+PRIOR_SHAPES = {
+    'price': [(1000, 100000, 0.05), (100000, 300000, 0.25), (300000, 600000, 0.35), (600000, 1000000, 0.2),
+              (1000000, 2000000, 0.15)],
+    'sqft': [(10, 500, 0.02), (500, 1000, 0.13), (1000, 1500, 0.25), (1500, 2000, 0.22), (2000, 3000, 0.24),
+             (3000, 5000, 0.12), (5000, 12000, 0.02)],
+    'year': [(1900, 1950, 0.12), (1950, 1980, 0.3), (1980, 2000, 0.26), (2000, 2018, 0.32)],
+    'beds': [(0, 1, 0.04), (1, 2, 0.12), (2, 3, 0.28), (3, 4, 0.33), (4, 5, 0.17), (5, 6, 0.06)],
+}
+PRIOR_GROUP = ('prior',)
+
+
+def observe_priors(density):
+    for dimension, bins in PRIOR_SHAPES.items():
+        for lo, hi, share in bins:
+            density.observe(dimension, PRIOR_GROUP, lo, hi, share)
+
+
+def observe_partition(density, partition, count):
+    """Feed the property count of a Partition, or a partition url, into a DensityModel."""
+    if isinstance(partition, str):
+        partition = Partition.from_url(partition)
+    for r in partition.ranges:
+        if r.lo is not None and r.hi is not None and r.dimension in DIMENSIONS:
+            density.observe(r.dimension, partition.sibling_key(r.dimension), r.lo, r.hi, count)
+
+
+def split_dimension(dimension, lo, hi, count=None, limit=None, density=None):
+    """Split [lo, hi] along dimension. With a known count and page limit the
+    split is planned from the observed density, otherwise cut into fixed fifths.
     """
-    if '/filter/' not in url:
-        price_filters = [(1000, 300000), (300000, 600000), (600000, 1000000), (1000000, 2000000)]
-        return [construct_filter_url(redfin_base_url, min_price=x[0], max_price=x[1]) for x in price_filters]
+    _, _, _, granularity, fixed_splitter = DIMENSIONS[dimension]
+    if count and limit:
+        shape = density.shape(dimension, lo, hi) if density else None
+        return plan_split(lo, hi, count, limit, granularity, shape)
+    return fixed_splitter(lo, hi)
+
+
+def choose_split(partition, count, limit, density=None):
+    """Return (dimension, ranges) of the planned split of partition, or None when no
+    dimension can be split any further.
+
+    The partition keeps being split along the last dimension of the filter
+    priority it is filtered on, as long as that range is wide enough for as
+    many children as needed. Otherwise, e.g. for a narrow price band with a
+    big count, it is split along the dimension whose fullest child is expected
+    to hold the fewest listings.
+    """
+    candidates = []
+    for dimension, (_, _, full_range, granularity, _) in DIMENSIONS.items():
+        current = partition.get(dimension)
+        lo, hi = (current.lo, current.hi) if current else full_range
+        if lo is None or hi is None:
+            continue
+        shape = density.shape(dimension, lo, hi) if density else None
+        ranges = plan_split(lo, hi, count, limit, granularity, shape)
+        if len(ranges) < 2:
+            continue
+        candidates.append((expected_largest(ranges, count, shape), dimension, ranges, current is not None))
+    if not candidates:
+        return None
+
+    filtered = [c for c in candidates if c[3]]
+    if filtered and len(filtered[-1][2]) >= children_needed(count, limit):
+        _, dimension, ranges, _ = filtered[-1]
+        return dimension, ranges
+    _, dimension, ranges, _ = min(candidates, key=lambda c: c[0])
+    LOGGER.debug('Splitting {} along {}'.format(partition.url, dimension))
+    return dimension, ranges
+
+
+def split_partition(partition, count=None, limit=None, density=None):
+    """Return the child Partitions that together cover partition.
+    A partition that cannot be split any further is returned as its only child.
+
+    When the property count of the partition and its page limit are given,
+    the dimension to split is picked per partition by choose_split, into as
+    many children as needed for each to fit under the limit, at cut points
+    taken from the density model. The base url is then split along the whole
+    price histogram of the model, if it has one.
+    Otherwise ranges are cut into fixed fifths, with the filter priority
+    price, sqft-size, year-built, and then one child per number of bedrooms.
+    """
+    planned = bool(count and limit)
+
+    def split_along(dimension, ranges):
+        return [partition.with_range(dimension, lo, hi) for lo, hi in ranges]
 
-    _, filters = url.split('/filter/')
-    filter_params = parse_filter_params(filters)
-    filter_params = {k: v for k, v in filter_params.items() if v is not None}
-    if not filter_params:
+    if not partition.ranges:
         # Make it a bit fine-grained to take care of cities with 100k+ listings.
         price_filters = [(1000, 300000), (300000, 600000), (600000, 1000000), (1000000, 2000000)]
-        return [construct_filter_url(redfin_base_url, min_price=x[0], max_price=x[1]) for x in price_filters]
-
-    min_price = filter_params.get('min_price')
-    max_price = filter_params.get('max_price')
-    min_sqft = filter_params.get('min_sqft')
-    max_sqft = filter_params.get('max_sqft')
-    min_year = filter_params.get('min_year')
-    max_year = filter_params.get('max_year')
-
-    if min_year:
-        year_filters = add_year_filters(min_year, max_year)
-        if len(year_filters) == 1:
+        shape = density.shape('price', MIN_PRICE, MAX_PRICE) if planned and density else None
+        if shape:
+            # Go straight for leaf-sized ranges when the price histogram is known.
+            price_filters = plan_seed(shape, count, limit, price_granularity)
+        return split_along('price', price_filters)
+
+    if planned:
+        choice = choose_split(partition, count, limit, density)
+        if choice is None:
             LOGGER.warning('Reaching the finest granularity. Cannot split any more.')
-            return [url]
-        sub_urls = []
-        for x in year_filters:
-            params = {**filter_params, **{'min_year': x[0], 'max_year': x[1]}}
-            sub_urls.append(construct_filter_url(redfin_base_url, **params))
-        return sub_urls
-
-    if min_sqft:
-        sqft_filters = add_sqft_filters(min_sqft, max_sqft)
-        if len(sqft_filters) == 1:
-            return [construct_filter_url(redfin_base_url, **{**filter_params, **{'min_year': MIN_YEAR, 'max_year': MAX_YEAR}})]
-        else:
-            sub_urls = []
-            for x in sqft_filters:
-                params = {**filter_params, **{'min_sqft': x[0], 'max_sqft': x[1]}}
-                sub_urls.append(construct_filter_url(redfin_base_url, **params))
-            return sub_urls
-
-    if min_price:
-        price_filters = add_price_filters(min_price, max_price)
-        if len(price_filters) == 1:
-            return [construct_filter_url(redfin_base_url, **{**filter_params, **{'min_sqft': MIN_SQFT, 'max_sqft': 1000}}), construct_filter_url(redfin_base_url, **{**filter_params, **{'min_sqft': 1000, 'max_sqft': MAX_SQFT}})]
-        else:
-            sub_urls = []
-            for x in price_filters:
-                params = {**filter_params, **{'min_price': x[0], 'max_price': x[1]}}
-                sub_urls.append(construct_filter_url(redfin_base_url, **params))
-            return sub_urls
+            return [partition]
+        return split_along(*choice)
+
+    year = partition.get('year')
+    if year and year.lo:
+        year_filters = split_dimension('year', year.lo, year.hi, count, limit, density)
+        if len(year_filters) > 1:
+            return split_along('year', year_filters)
+        beds = partition.get('beds')
+        lo, hi = (beds.lo, beds.hi) if beds else (MIN_BEDS, MAX_BEDS)
+        beds_filters = split_dimension('beds', lo, hi, count, limit, density)
+        if len(beds_filters) == 1:
+            LOGGER.warning('Reaching the finest granularity. Cannot split any more.')
+            return [partition]
+        return split_along('beds', beds_filters)
+
+    sqft = partition.get('sqft')
+    if sqft and sqft.lo:
+        sqft_filters = split_dimension('sqft', sqft.lo, sqft.hi, count, limit, density)
+        if len(sqft_filters) > 1:
+            return split_along('sqft', sqft_filters)
+        return split_along('year', split_dimension('year', MIN_YEAR, MAX_YEAR, count, limit, density))
+
+    price = partition.get('price')
+    if price and price.lo:
+        price_filters = split_dimension('price', price.lo, price.hi, count, limit, density)
+        if len(price_filters) > 1:
+            return split_along('price', price_filters)
+        return split_along('sqft', [(MIN_SQFT, 1000), (1000, MAX_SQFT)])
+    return [partition]
+
+
+def apply_filters(url, redfin_base_url, count=None, limit=None, density=None):
+    """Apply more filters to make it more fine-grained.
+    Return a list of urls containing filters, which adds up
+    to the original url. See split_partition.
+    """
+    partition = Partition.from_url(url, redfin_base_url)
+    return [child.url for child in split_partition(partition, count, limit, density)]
@@ -0,0 +1,124 @@
+"""On-disk HTTP response cache shared by the partition and scrape stages.
+
+Responses are kept per url in their own SQLite file together with their
+ETag and Last-Modified validators. Entries younger than the TTL are served
+without touching the network; older ones are revalidated with a conditional
+GET, and a 304 answer serves the cached body again. Entries older than
+max_age are deleted when the cache is opened, so it does not grow without
+bound. In replay mode every url is served from the cache and urls missing
+from it fail.
+"""
+import collections
+import logging
+import time
+import zlib
+
+from redfin_storage import connect
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TTL = 12 * 60 * 60
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_COMMIT_EVERY = 100
+
+CachedResponse = collections.namedtuple('CachedResponse', ['body', 'etag', 'last_modified', 'fetched_at'])
+
+
+class CacheMiss(Exception):
+    """Raised for urls that are not cached while replaying."""
+
+
+class HttpCache:
+    """Bodies and validators of fetched urls, stored in the SQLite file at path.
+
+    Writes are committed every commit_every responses and on close. Unless replaying,
+    responses fetched more than max_age seconds ago are pruned on open; a falsy max_age keeps them all.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, replay=False, commit_every=DEFAULT_COMMIT_EVERY, clock=time.time,
+                 max_age=DEFAULT_MAX_AGE):
+        self.db = connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS HTTP_CACHE
+                 (
+                 URL            TEXT    PRIMARY KEY,
+                 BODY           BLOB    NOT NULL,
+                 ETAG           TEXT,
+                 LAST_MODIFIED  TEXT,
+                 FETCHED_AT     REAL    NOT NULL);''')
+        self.ttl = ttl
+        self.replay = replay
+        self.commit_every = commit_every
+        self.clock = clock
+        self.pending = 0
+        self.hits = self.revalidated = self.misses = 0
+        if max_age and not replay:
+            self.prune(max_age)
+
+    def prune(self, max_age):
+        """Delete the responses fetched more than max_age seconds ago. Return how many were deleted."""
+        deleted = self.db.execute('DELETE FROM HTTP_CACHE WHERE FETCHED_AT < ?', (self.clock() - max_age,)).rowcount
+        self.db.commit()
+        if deleted:
+            LOGGER.info('Pruned {} responses older than {:.0f} hours from the HTTP cache'.format(
+                deleted, max_age / 3600))
+        return deleted
+
+    def get(self, url):
+        row = self.db.execute("""
+            SELECT BODY, ETAG, LAST_MODIFIED, FETCHED_AT FROM HTTP_CACHE WHERE URL = ?""", (url,)).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, fetched_at = row
+        return CachedResponse(zlib.decompress(body).decode('utf-8'), etag, last_modified, fetched_at)
+
+    def is_fresh(self, cached):
+        return self.replay or self.clock() - cached.fetched_at < self.ttl
+
+    def lookup(self, url, revalidate=False):
+        """Return (cached response or None, True if it can be served without a request).
+        With revalidate set, only replay serves a response without a request, however fresh.
+        Raise CacheMiss for urls that are not cached while replaying.
+        """
+        cached = self.get(url)
+        if cached is None:
+            if self.replay:
+                raise CacheMiss(url)
+            self.misses += 1
+            return None, False
+        if self.is_fresh(cached) and (self.replay or not revalidate):
+            self.hits += 1
+            return cached, True
+        return cached, False
+
+    @staticmethod
+    def conditional_headers(cached):
+        """Request headers revalidating cached, or None when it carries no validator."""
+        headers = {}
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers or None
+
+    def put(self, url, body, etag=None, last_modified=None):
+        self.db.execute("""
+            INSERT OR REPLACE INTO HTTP_CACHE (URL, BODY, ETAG, LAST_MODIFIED, FETCHED_AT)
+            VALUES (?, ?, ?, ?, ?)""", (url, zlib.compress(body.encode('utf-8')), etag, last_modified, self.clock()))
+        self._written()
+
+    def touch(self, url):
+        """Mark url as fetched now, after the server confirmed the cached body is still current."""
+        self.revalidated += 1
+        self.db.execute("UPDATE HTTP_CACHE SET FETCHED_AT = ? WHERE URL = ?", (self.clock(), url))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        LOGGER.info('HTTP cache: {} hits, {} revalidated, {} misses'.format(self.hits, self.revalidated, self.misses))
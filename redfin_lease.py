@@ -0,0 +1,205 @@
+"""Leased work queue for crawls spread over several worker machines.
+
+A coordinator process owns the crawl database and a LeaseQueue of work
+items. Workers lease a batch of items over HTTP, fetch them through their
+own proxies and post the results of the whole batch back. A lease that is
+not completed within its visibility timeout, e.g. because its worker died,
+goes back to the queue for another worker. Results are saved even when they
+come back after their lease expired; the copies queued again are then
+dropped instead of being fetched twice.
+
+Items and results are JSON values; encoding crawl work is up to the caller.
+"""
+import asyncio
+import collections
+import logging
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+from redfin_fetcher import AsyncFetcher, FairQueue
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_LEASE_SIZE = 50
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_REQUEST_ATTEMPTS = 5
+
+Lease = collections.namedtuple('Lease', ['worker', 'deadline', 'items'])
+# Exception classes standing in for the ones raised on workers, by name.
+_REMOTE_ERRORS = {}
+
+
+class LeaseQueue:
+    """Work items handed out in leases that expire after visibility_timeout seconds.
+    With a key function, leases take items in turns between keys, see FairQueue.
+    """
+
+    def __init__(self, key=None, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, clock=time.monotonic):
+        self.queue = collections.deque() if key is None else FairQueue(key)
+        self.visibility_timeout = visibility_timeout
+        self.clock = clock
+        self.leases = {}
+        # Items queued again after their lease expired, and those of them completed since.
+        self.requeued = set()
+        self.skip = set()
+        self.expired = 0
+
+    def add(self, items):
+        self.queue.extend(tuple(item) for item in items)
+
+    def expire(self):
+        now = self.clock()
+        for lease_id, lease in list(self.leases.items()):
+            if lease.deadline <= now:
+                LOGGER.warning('Lease {} of {} expired, queueing its {} items again'.format(
+                    lease_id, lease.worker, len(lease.items)))
+                del self.leases[lease_id]
+                self.expired += 1
+                self.requeued.update(lease.items)
+                self.queue.extend(lease.items)
+
+    def lease(self, worker, max_items):
+        """Return (lease id, items) of up to max_items queued items, or (None, []) if none is queued."""
+        self.expire()
+        items = []
+        while self.queue and len(items) < max_items:
+            item = self.queue.popleft()
+            if item in self.skip:
+                self.skip.discard(item)
+                self.requeued.discard(item)
+                continue
+            items.append(item)
+        if not items:
+            return None, []
+        lease_id = uuid.uuid4().hex
+        self.leases[lease_id] = Lease(worker, self.clock() + self.visibility_timeout, items)
+        return lease_id, items
+
+    def complete(self, lease_id, items):
+        """Close a lease whose items are done. Return False if it had expired already."""
+        lease = self.leases.pop(lease_id, None)
+        for item in map(tuple, items):
+            if item in self.requeued:
+                if lease is None:
+                    self.skip.add(item)
+                self.requeued.discard(item)
+        return lease is not None
+
+    @property
+    def done(self):
+        """Whether nothing is queued or leased."""
+        self.expire()
+        return not self.queue and not self.leases
+
+    def status(self):
+        return {'queued': len(self.queue), 'leases': len(self.leases),
+                'leased_items': sum(len(lease.items) for lease in self.leases.values()), 'expired': self.expired}
+
+
+def remote_error(name, message):
+    """Return an exception with the class name and message of one raised on a worker."""
+    cls = _REMOTE_ERRORS.get(name)
+    if cls is None:
+        cls = _REMOTE_ERRORS[name] = type(name, (Exception,), {})
+    return cls(message)
+
+
+def coordinator_app(queue, save_results, poll_interval=DEFAULT_POLL_INTERVAL):
+    """aiohttp application handing out leases of queue.
+
+    POST /lease {"worker": name, "max_items": n} returns the lease id, its items
+    and whether the crawl is done. POST /complete {"lease": id, "results":
+    [[item, result], ...]} passes the results to save_results, which returns
+    new items to queue. GET /status reports the queue.
+    """
+    async def lease(request):
+        body = await request.json()
+        lease_id, items = queue.lease(body.get('worker'), int(body.get('max_items', DEFAULT_LEASE_SIZE)))
+        return web.json_response({'lease': lease_id, 'items': items, 'done': queue.done,
+                                  'timeout': queue.visibility_timeout, 'retry_after': poll_interval})
+
+    async def complete(request):
+        body = await request.json()
+        results = body['results']
+        queue.add(save_results(results) or ())
+        live = queue.complete(body['lease'], [item for item, _ in results])
+        return web.json_response({'accepted': len(results), 'expired': not live})
+
+    async def status(request):
+        return web.json_response(dict(queue.status(), done=queue.done))
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/lease', lease)
+    app.router.add_post('/complete', complete)
+    app.router.add_get('/status', status)
+    return app
+
+
+def serve_until_done(app, queue, host='0.0.0.0', port=8080, linger=2 * DEFAULT_POLL_INTERVAL):
+    """Serve app until queue is done, then linger seconds so polling workers learn it, and stop."""
+    async def main():
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        LOGGER.info('Coordinating on {}:{}'.format(host, port))
+        try:
+            while not queue.done:
+                await asyncio.sleep(DEFAULT_POLL_INTERVAL / 4)
+            await asyncio.sleep(linger)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+async def _post(session, url, payload, attempts=DEFAULT_REQUEST_ATTEMPTS):
+    for attempt in range(1, attempts + 1):
+        try:
+            async with session.post(url, json=payload) as resp:
+                resp.raise_for_status()
+                return await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == attempts:
+                raise
+            LOGGER.warning('Retrying {} after {!r}'.format(url, e))
+            await asyncio.sleep(DEFAULT_POLL_INTERVAL * attempt)
+
+
+def run_leased_work(coordinator_url, worker, name=None, lease_size=DEFAULT_LEASE_SIZE, **fetcher_options):
+    """Lease items from the coordinator at coordinator_url, run the coroutine
+    worker(fetcher, item) on each and post every lease's [item, result] pairs back,
+    until the coordinator reports the crawl done. fetcher_options are passed on to
+    AsyncFetcher; enough leases are worked on at a time to keep its concurrency busy.
+    Return the number of items done.
+    """
+    name = name or uuid.uuid4().hex[:8]
+    coordinator_url = coordinator_url.rstrip('/') + '/'
+
+    async def main():
+        fetcher = AsyncFetcher(**fetcher_options)
+        num_loops = max(1, -(-fetcher.concurrency // lease_size))
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+            async def loop():
+                num_done = 0
+                while True:
+                    lease = await _post(session, coordinator_url + 'lease', {'worker': name, 'max_items': lease_size})
+                    if not lease['items']:
+                        if lease['done']:
+                            return num_done
+                        await asyncio.sleep(lease['retry_after'])
+                        continue
+                    results = await asyncio.gather(*(worker(fetcher, item) for item in lease['items']))
+                    await _post(session, coordinator_url + 'complete',
+                                {'lease': lease['lease'], 'results': [list(pair) for pair in zip(lease['items'], results)]})
+                    num_done += len(results)
+
+            try:
+                return sum(await asyncio.gather(*(loop() for _ in range(num_loops))))
+            finally:
+                await fetcher.close()
+
+    return asyncio.run(main())
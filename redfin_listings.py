@@ -0,0 +1,65 @@
+"""Turn the JSON-LD blocks stored in LISTINGS into LISTING_DETAILS rows."""
+import json
+import logging
+import zlib
+
+from redfin_page_store import PageRef, read_page
+
+LOGGER = logging.getLogger(__name__)
+
+LISTING_DETAILS_COLUMNS = ('URL', 'NUMBER_OF_ROOMS', 'NAME', 'COUNTRY', 'REGION', 'LOCALITY', 'STREET',
+                           'POSTAL', 'TYPE', 'PRICE')
+
+
+def parse_listing(listing):
+    """Return a LISTING_DETAILS row for one JSON-LD block, or None if it does not describe a home.
+
+    A block is either a dict describing the home, or a list of dicts where one
+    describes the home and another one carries the offer with the price.
+    """
+    if isinstance(listing, dict):
+        listing = [listing]
+    elif not isinstance(listing, list):
+        return None
+
+    listing_url, num_rooms, name, country, region, locality, street, postal, house_type, price = \
+        None, None, None, None, None, None, None, None, None, None
+    for info in listing:
+        if not isinstance(info, dict):
+            continue
+        if ('url' in info) and ('address' in info):
+            listing_url = info.get('url')
+            address_details = info['address']
+            num_rooms = info.get('numberOfRooms')
+            name = info.get('name')
+            country = address_details.get('addressCountry')
+            region = address_details.get('addressRegion')
+            locality = address_details.get('addressLocality')
+            street = address_details.get('streetAddress')
+            postal = address_details.get('postalCode')
+            house_type = info.get('@type')
+        if 'offers' in info:
+            price = info['offers'].get('price')
+    if not listing_url:
+        return None
+    return (listing_url, num_rooms, name, country, region, locality, street, postal, house_type, price)
+
+
+def parse_pages(rows):
+    """Parse (page url, JSON text or PageRef into the page store) rows from LISTINGS into
+    LISTING_DETAILS rows. Runs in worker processes, so it only depends on its arguments.
+    """
+    listing_details = {}
+    for url, json_details in rows:
+        try:
+            if isinstance(json_details, PageRef):
+                json_details = read_page(json_details)
+            listings_on_page = json.loads(json_details)
+        except (TypeError, ValueError, OSError, zlib.error):
+            LOGGER.warning('Cannot decode listings of {}'.format(url))
+            continue
+        for listing in listings_on_page:
+            details = parse_listing(listing)
+            if details:
+                listing_details[details[0]] = details
+    return list(listing_details.values())
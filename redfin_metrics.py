@@ -0,0 +1,210 @@
+"""Counters and latency histograms of a running crawl.
+
+The fetcher, the partition and scrape stages, the parser and the database
+writes record into the module level METRICS registry. Its snapshot() is a
+JSON-ready dict, which a SnapshotWriter thread writes to a file every few
+seconds and serve_metrics answers on GET /metrics:
+
+    python redfin_crawler.py proxies.csv URL --metrics_file metrics.json --metrics_port 8781
+    curl localhost:8781/metrics
+
+Metric names carry their labels, e.g. fetch_seconds{proxy=10.0.0.1:3128}.
+Histograms have fixed buckets, so recording is cheap and their quantiles are
+estimates within a bucket.
+"""
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+# Upper bounds of the histogram buckets, in seconds for latencies.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FANOUT_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+
+
+def metric_name(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for k, v in sorted(labels.items())))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, and the last one for values above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the q quantile by interpolating inside its bucket."""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[index - 1] if index else 0.0
+                high = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(low + (high - low) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99), 'max': self.max,
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['inf'], self.counts))}
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = self.clock()
+            self.counters = {}
+            self.histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        key = metric_name(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = metric_name(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self, since=None):
+        """Return the counters, their rates per second and the histogram summaries.
+        Rates are since the snapshot since, or since the start.
+        """
+        with self.lock:
+            now = self.clock()
+            counters = dict(self.counters)
+            histograms = {key: h.to_dict() for key, h in self.histograms.items()}
+        uptime = now - self.started
+        previous, elapsed = {}, uptime
+        if since is not None:
+            previous, elapsed = since['counters'], uptime - since['uptime']
+        rates = {key: (value - previous.get(key, 0)) / elapsed if elapsed > 0 else None
+                 for key, value in counters.items()}
+        return {'time': time.time(), 'uptime': uptime, 'counters': counters, 'rates': rates,
+                'histograms': histograms}
+
+
+METRICS = Metrics()
+
+
+def write_snapshot(path, snapshot):
+    # Write next to the file and rename, so readers never see half a snapshot.
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter(threading.Thread):
+    """Write a snapshot of metrics to path every interval seconds, with rates over the interval,
+    and a last one when stopped.
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, metrics=METRICS):
+        super().__init__(name='metrics-snapshot', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+        self.last = None
+
+    def write(self):
+        snapshot = self.metrics.snapshot(since=self.last)
+        write_snapshot(self.path, snapshot)
+        self.last = snapshot
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                LOGGER.exception('Cannot write metrics to {}'.format(self.path))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.write()
+
+
+def serve_metrics(port, host='127.0.0.1', metrics=METRICS):
+    """Answer GET /metrics with a snapshot from a background thread. Return the server; shutdown() stops it."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.snapshot(), sort_keys=True).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    LOGGER.info('Serving metrics on http://{}:{}/metrics'.format(host, server.server_address[1]))
+    return server
+
+
+@contextlib.contextmanager
+def profiled(path, top=30):
+    """Run the with block under cProfile, dump the stats to path and log the top functions by cumulative time.
+    Read them back with python -m pstats path, or snakeviz.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        LOGGER.info('Wrote profile to {}'.format(path))
+        if LOGGER.isEnabledFor(logging.INFO):
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(top)
@@ -0,0 +1,111 @@
+"""Append-only, content-addressed store for scraped page payloads.
+
+Payloads are zlib compressed and appended to segment files. Every record is
+a header with the SHA-256 of the uncompressed payload and its compressed
+length, followed by the compressed bytes. The PAGE_STORE table maps each
+hash to its segment, offset and length, so a payload that was already
+stored, e.g. by an earlier crawl of the same page, is only referenced again.
+Readers map segments into memory instead of reading them through the DB.
+"""
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+DEFAULT_LEVEL = 6
+RECORD_HEADER = struct.Struct('>32sI')
+SEGMENT_PATTERN = re.compile(r'^segment-(\d+)\.bin$')
+
+PageRef = collections.namedtuple('PageRef', ['path', 'offset', 'length'])
+
+# Segments mapped by this process, by path.
+_MAPS = {}
+
+
+class PageStore:
+    """Writer of the segment files in directory, indexed in the PAGE_STORE table of db."""
+
+    def __init__(self, directory, db, segment_size=DEFAULT_SEGMENT_SIZE, level=DEFAULT_LEVEL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.db = db
+        self.segment_size = segment_size
+        self.level = level
+        segments = [int(m.group(1)) for m in map(SEGMENT_PATTERN.match, os.listdir(directory)) if m]
+        self.segment = max(segments, default=0)
+        self.file = None
+        self.size = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-{:06d}.bin'.format(segment))
+
+    def _writable(self, length):
+        if self.file is not None and self.size + length > self.segment_size:
+            self.close()
+            self.segment += 1
+        if self.file is None:
+            self.segment = max(self.segment, 1)
+            path = self.segment_path(self.segment)
+            self.file = open(path, 'ab')
+            self.size = os.path.getsize(path)
+        return self.file
+
+    def put(self, text):
+        """Store text unless an identical payload is stored already. Return its hash."""
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+        key = digest.hex()
+        if self.db.execute("SELECT 1 FROM PAGE_STORE WHERE HASH = ?", (key,)).fetchone():
+            return key
+        compressed = zlib.compress(data, self.level)
+        f = self._writable(RECORD_HEADER.size + len(compressed))
+        offset = self.size + RECORD_HEADER.size
+        f.write(RECORD_HEADER.pack(digest, len(compressed)))
+        f.write(compressed)
+        self.size = offset + len(compressed)
+        self.db.execute("""
+            INSERT INTO PAGE_STORE (HASH, SEGMENT, OFFSET, LENGTH)
+            VALUES (?, ?, ?, ?)""", (key, self.segment, offset, len(compressed)))
+        return key
+
+    def flush(self):
+        """Make the appended records durable. Call before committing the rows that reference them."""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def ref(self, segment, offset, length):
+        return PageRef(self.segment_path(segment), offset, length)
+
+    def get(self, key):
+        row = self.db.execute("SELECT SEGMENT, OFFSET, LENGTH FROM PAGE_STORE WHERE HASH = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.flush()
+        return read_page(self.ref(*row))
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_page(ref):
+    """Return the text stored at a PageRef, through a memory map of its segment."""
+    segment = _MAPS.get(ref.path)
+    if segment is None or len(segment) < ref.offset + ref.length:
+        # Not mapped yet, or the segment grew since it was mapped.
+        if segment is not None:
+            segment.close()
+        with open(ref.path, 'rb') as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _MAPS[ref.path] = segment
+    return zlib.decompress(segment[ref.offset:ref.offset + ref.length]).decode('utf-8')
@@ -0,0 +1,141 @@
+"""Typed partitions of a Redfin search.
+
+A Partition is the base url of a region plus one FilterRange per filtered
+dimension. It is an immutable tuple, so it can be hashed, deduped and kept in
+memory for the whole partition tree, and it is only rendered to a url when
+it is fetched or stored.
+"""
+import collections
+
+# /filter/min-price=750k,max-price=780k,min-lot-size=3k-sqft,max-lot-size=4k-sqft,include=sold-3yr
+# min-year-built=2016
+# min-sqft=500-sqft
+BASE_FILTERS = ['include=sold-3yr']
+
+# dimension -> (min url param, max url param, value format), in the order they appear in urls.
+URL_PARAMS = collections.OrderedDict([
+    ('price', ('min-price', 'max-price', '{}')),
+    ('sqft', ('min-sqft', 'max-sqft', '{}-sqft')),
+    ('year', ('min-year-built', 'max-year-built', '{}')),
+    ('beds', ('min-beds', 'max-beds', '{}')),
+])
+# Outer ends of the range each dimension is split in. Homes can lie beyond them, e.g. built
+# after 2018, so a range reaching an end is rendered without it and stays open on Redfin.
+OPEN_ENDED = {
+    'sqft': (10, 12000),
+    'year': (1900, 2018),
+    'beds': (0, 6),
+}
+# Dimensions with a few integer values. They are kept as half-open [lo, hi) ranges,
+# rendered as min=lo and max=hi - 1.
+DISCRETE = ('beds',)
+# dimension -> (min keyword, max keyword) of Partition.from_params and Partition.params.
+PARAM_KEYS = {
+    'price': ('min_price', 'max_price'),
+    'sqft': ('min_sqft', 'max_sqft'),
+    'year': ('min_year', 'max_year'),
+    'beds': ('min_beds', 'max_beds'),
+}
+_BY_URL_PARAM = {}
+for _dimension, (_min_param, _max_param, _value_format) in URL_PARAMS.items():
+    _suffix = _value_format[2:]
+    _BY_URL_PARAM[_min_param] = (_dimension, 0, _suffix)
+    _BY_URL_PARAM[_max_param] = (_dimension, 1, _suffix)
+
+
+class FilterRange(collections.namedtuple('FilterRange', ['dimension', 'lo', 'hi'])):
+    """Range of one filter dimension. Either end may be None when the url leaves it open."""
+    __slots__ = ()
+
+
+def parse_filters(filter_str):
+    """Return {dimension: FilterRange} for the comma separated filters of a url."""
+    bounds = {}
+    for item in filter_str.split(','):
+        name, _, value = item.partition('=')
+        if name not in _BY_URL_PARAM:
+            continue
+        dimension, end, suffix = _BY_URL_PARAM[name]
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            bounds.setdefault(dimension, [None, None])[end] = int(value)
+        except ValueError:
+            continue
+    for dimension, (open_lo, open_hi) in OPEN_ENDED.items():
+        if dimension in bounds:
+            lo, hi = bounds[dimension]
+            if hi is not None and dimension in DISCRETE:
+                hi += 1
+            bounds[dimension] = (open_lo if lo is None else lo, open_hi if hi is None else hi)
+    return {dimension: FilterRange(dimension, lo, hi) for dimension, (lo, hi) in bounds.items()}
+
+
+class Partition(collections.namedtuple('Partition', ['base_url', 'ranges'])):
+    """A region base url and its filter ranges, sorted in url order."""
+    __slots__ = ()
+
+    @classmethod
+    def from_ranges(cls, base_url, ranges):
+        # A range over the whole of an open ended dimension filters nothing.
+        ranges = {r.dimension: r for r in ranges
+                  if (r.lo is not None or r.hi is not None) and (r.lo, r.hi) != OPEN_ENDED.get(r.dimension)}
+        return cls(base_url, tuple(ranges[d] for d in URL_PARAMS if d in ranges))
+
+    @classmethod
+    def from_params(cls, base_url, **params):
+        """Build a partition from min_price=..., max_sqft=... style keywords; falsy values are left out."""
+        return cls.from_ranges(base_url, [
+            FilterRange(dimension, params.get(min_key) or None, params.get(max_key) or None)
+            for dimension, (min_key, max_key) in PARAM_KEYS.items()])
+
+    @classmethod
+    def from_url(cls, url, base_url=None):
+        """Parse a partition url. base_url overrides the base taken from the url."""
+        base, _, filter_str = url.partition('filter/')
+        return cls.from_ranges(base_url or base, parse_filters(filter_str).values())
+
+    def get(self, dimension):
+        for r in self.ranges:
+            if r.dimension == dimension:
+                return r
+        return None
+
+    def with_range(self, dimension, lo, hi):
+        return Partition.from_ranges(self.base_url, [r for r in self.ranges if r.dimension != dimension] +
+                                     [FilterRange(dimension, lo, hi)])
+
+    def sibling_key(self, dimension):
+        """Key shared by all partitions that only differ in their range along dimension."""
+        return tuple(r for r in self.ranges if r.dimension != dimension)
+
+    def params(self):
+        """Return the non-empty ranges as min_price=..., max_sqft=... style keywords."""
+        params = {}
+        for r in self.ranges:
+            min_key, max_key = PARAM_KEYS[r.dimension]
+            if r.lo is not None:
+                params[min_key] = r.lo
+            if r.hi is not None:
+                params[max_key] = r.hi
+        return params
+
+    @property
+    def url(self):
+        if not self.ranges:
+            return self.base_url
+        filters = BASE_FILTERS[:]
+        for r in self.ranges:
+            min_param, max_param, value_format = URL_PARAMS[r.dimension]
+            lo, hi = r.lo, r.hi
+            if r.dimension in OPEN_ENDED:
+                open_lo, open_hi = OPEN_ENDED[r.dimension]
+                lo = lo if lo != open_lo else None
+                hi = hi if hi != open_hi else None
+                if hi is not None and r.dimension in DISCRETE:
+                    hi -= 1
+            if lo is not None:
+                filters.append('{}={}'.format(min_param, value_format.format(lo)))
+            if hi is not None:
+                filters.append('{}={}'.format(max_param, value_format.format(hi)))
+        return '{}filter/{}'.format(self.base_url, ','.join(filters))
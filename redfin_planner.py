@@ -0,0 +1,164 @@
+"""Count-aware split planning for the partition tree.
+
+Instead of always cutting a filter range into fifths, plan_split decides how
+many children a node needs from its property count and the page limit, and
+places the cut points at equal quantiles of an estimated listing density.
+The density comes from DensityModel, which remembers how the counts of
+already fetched sibling partitions were spread along each filter dimension.
+"""
+import collections
+import logging
+import math
+
+LOGGER = logging.getLogger(__name__)
+
+# Aim each child at this share of the page limit, so most land under it.
+DEFAULT_FILL = 0.7
+MAX_CHILDREN = 20
+MAX_SHAPE_GROUPS = 50
+# Without observed siblings, assume the fullest child holds this much more than an even share.
+UNOBSERVED_SKEW = 1.5
+
+
+class DensityModel:
+    """Observed (range, count) pairs per filter dimension, grouped by sibling set.
+
+    Siblings are partitions that only differ in the range of one dimension.
+    Each sibling set gives the shape of the listing distribution along that
+    dimension; the shapes of different sets are averaged, which assumes the
+    distribution along one dimension looks alike across the other filters.
+    """
+
+    def __init__(self, max_groups=MAX_SHAPE_GROUPS):
+        self.max_groups = max_groups
+        self.groups = collections.defaultdict(collections.OrderedDict)
+
+    def observe(self, dimension, group, lo, hi, count):
+        if count is None or hi <= lo:
+            return
+        intervals = self.groups[dimension].setdefault(group, {})
+        intervals[(lo, hi)] = count
+        self.groups[dimension].move_to_end(group)
+
+    def shape(self, dimension, lo, hi, skip=()):
+        """Return [(lo, hi, share)] bins covering [lo, hi] with shares adding up to 1,
+        or None when no sibling set tells anything about the inside of the range.
+        Sibling sets in skip are left out.
+        """
+        shapes = []
+        for group, intervals in reversed(self.groups[dimension].items()):
+            if group in skip:
+                continue
+            inside = _finest_cover([(a, b, c) for (a, b), c in intervals.items() if a < hi and b > lo])
+            if not any(lo < a < hi or lo < b < hi for a, b, _ in inside):
+                continue
+            covered = sum(min(b, hi) - max(a, lo) for a, b, _ in inside)
+            if covered < hi - lo:
+                # Gaps in the sibling set, the shape would be skewed.
+                continue
+            mass = sum(c * (min(b, hi) - max(a, lo)) / (b - a) for a, b, c in inside)
+            if mass <= 0:
+                continue
+            shapes.append([(max(a, lo), min(b, hi), c * (min(b, hi) - max(a, lo)) / (b - a) / mass)
+                           for a, b, c in inside])
+            if len(shapes) >= self.max_groups:
+                break
+        if not shapes:
+            return None
+
+        points = sorted({lo, hi} | {x for bins in shapes for a, b, _ in bins for x in (a, b)})
+        combined = []
+        for a, b in zip(points[:-1], points[1:]):
+            share = 0
+            for bins in shapes:
+                share += sum(s * (min(b, y) - max(a, x)) / (y - x) for x, y, s in bins if x < b and y > a)
+            combined.append((a, b, share / len(shapes)))
+        return combined
+
+
+def _finest_cover(intervals):
+    """Keep the narrowest intervals that do not overlap each other.
+    For a partition tree this replaces every split node by its children.
+    """
+    chosen = []
+    for a, b, c in sorted(intervals, key=lambda x: x[1] - x[0]):
+        if all(b <= x or a >= y for x, y, _ in chosen):
+            chosen.append((a, b, c))
+    return sorted(chosen)
+
+
+def _mass(bins, lo, hi):
+    """Share of bins that falls inside [lo, hi]."""
+    return sum(s * (min(hi, b) - max(lo, a)) / (b - a) for a, b, s in bins if a < hi and b > lo)
+
+
+def _quantile(bins, target):
+    """Position where the cumulative share of bins reaches target."""
+    cumulative = 0
+    for a, b, share in bins:
+        if share > 0 and cumulative + share >= target:
+            return a + (b - a) * (target - cumulative) / share
+        cumulative += share
+    return bins[-1][1]
+
+
+def children_needed(count, limit, fill=DEFAULT_FILL, max_children=MAX_CHILDREN):
+    return min(max_children, max(2, math.ceil(count / (limit * fill))))
+
+
+def plan_split(lo, hi, count, limit, granularity, shape=None, fill=DEFAULT_FILL, max_children=MAX_CHILDREN):
+    """Split [lo, hi] into ranges that each hold about fill * limit of the count listings.
+
+    granularity(x) is the step filter values are rounded to around x. shape is
+    a DensityModel.shape() result; without one listings are assumed uniform.
+    Return [(lo, hi)] when the range cannot be split at this granularity.
+    """
+    num_children = children_needed(count, limit, fill, max_children)
+    bins = shape or [(lo, hi, 1.0)]
+    cuts = [lo]
+    for i in range(1, num_children):
+        x = _quantile(bins, i / num_children)
+        step = granularity(x)
+        x = int(round(x / step) * step)
+        if cuts[-1] < x < hi:
+            cuts.append(x)
+    cuts.append(hi)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def plan_seed(bins, total, limit, granularity, fill=DEFAULT_FILL):
+    """Turn a cached histogram [(lo, hi, share)] of a region into first-level ranges
+    that are each expected to hold about fill * limit of its total listings.
+    Neighbouring sparse bins are merged, dense bins are split.
+    """
+    target = limit * fill
+    ranges = []
+    start, pending = bins[0][0], 0
+    for lo, hi, share in bins:
+        expected = share * total
+        if expected > target:
+            if lo > start:
+                ranges.append((start, lo))
+            ranges.extend(plan_split(lo, hi, expected, limit, granularity, fill=fill))
+            start, pending = hi, 0
+            continue
+        if pending and pending + expected > target:
+            ranges.append((start, lo))
+            start, pending = lo, 0
+        pending += expected
+    if start < bins[-1][1]:
+        ranges.append((start, bins[-1][1]))
+    return ranges
+
+
+def shape_distance(shape, other):
+    """Total variation distance between two histograms over the same range."""
+    points = sorted({x for a, b, _ in shape + other for x in (a, b)})
+    return sum(abs(_mass(shape, a, b) - _mass(other, a, b)) for a, b in zip(points[:-1], points[1:])) / 2
+
+
+def expected_largest(ranges, count, shape=None):
+    """Listings expected in the fullest of ranges when count listings are split into them."""
+    bins = shape or [(ranges[0][0], ranges[-1][1], 1.0)]
+    skew = 1 if shape else UNOBSERVED_SKEW
+    return max(count * _mass(bins, lo, hi) * skew for lo, hi in ranges)
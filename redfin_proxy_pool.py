@@ -0,0 +1,143 @@
+"""In-process proxy health tracking.
+
+Every response updates the stats of the proxy that served it. Only failures
+of the proxy itself count against it, not errors the target site answered
+with. Blocked (403) or throttled (429) proxies are cooled down, proxies that
+keep failing are ejected for a long cooldown, and the remaining ones are
+picked with probability proportional to their smoothed success rate over
+their latency EWMA.
+"""
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.proxy_checker import URL as WARM_UP_URL, check_proxy
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCKED_STATUSES = (403, 429)
+# Statuses a proxy answers with itself when it cannot reach the target.
+PROXY_ERROR_STATUSES = (407, 502, 504)
+DEFAULT_LATENCY = 1.0
+
+
+class ProxyStats:
+    __slots__ = ('requests', 'successes', 'blocked', 'throttled', 'consecutive_failures',
+                 'latency_ewma', 'cooldown_until', 'ejected_until', 'ejections')
+
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.blocked = 0
+        self.throttled = 0
+        self.consecutive_failures = 0
+        self.latency_ewma = None
+        self.cooldown_until = 0
+        self.ejected_until = 0
+        self.ejections = 0
+
+    @property
+    def success_rate(self):
+        # Laplace smoothing keeps new proxies in play.
+        return (self.successes + 1) / (self.requests + 2)
+
+
+class ProxyPool:
+    """Health scores for a fixed list of proxies, addressed by index."""
+
+    def __init__(self, proxies, alpha=0.3, cooldown=30, max_cooldown=600, min_requests=20,
+                 min_success_rate=0.2, max_consecutive_failures=10, eject_cooldown=1800, clock=time.monotonic,
+                 rng=random):
+        self.proxies = list(proxies)
+        self.stats = [ProxyStats() for _ in self.proxies]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.min_requests = min_requests
+        self.min_success_rate = min_success_rate
+        self.max_consecutive_failures = max_consecutive_failures
+        self.eject_cooldown = eject_cooldown
+        self.clock = clock
+        self.rng = rng
+
+    def record(self, index, status=None, latency=None):
+        """Record the outcome of one request through proxy index.
+        status is the HTTP status, or None when no response came back at all.
+        Any other status than BLOCKED_STATUSES and PROXY_ERROR_STATUSES got through
+        to the target and counts as a success of the proxy, 5xx errors of the target included.
+        """
+        stats = self.stats[index]
+        stats.requests += 1
+        if latency is not None:
+            if stats.latency_ewma is None:
+                stats.latency_ewma = latency
+            else:
+                stats.latency_ewma = self.alpha * latency + (1 - self.alpha) * stats.latency_ewma
+
+        if status is not None and status not in BLOCKED_STATUSES and status not in PROXY_ERROR_STATUSES:
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            return
+
+        stats.consecutive_failures += 1
+        if status == 403:
+            stats.blocked += 1
+        elif status == 429:
+            stats.throttled += 1
+        if status in BLOCKED_STATUSES:
+            backoff = self.cooldown * 2 ** (stats.blocked + stats.throttled - 1)
+            stats.cooldown_until = self.clock() + min(self.max_cooldown, backoff)
+            LOGGER.info('Cooling down proxy {} after status {}'.format(index, status))
+
+        if (stats.consecutive_failures >= self.max_consecutive_failures or
+                (stats.requests >= self.min_requests and stats.success_rate < self.min_success_rate)):
+            self.eject(index)
+
+    def eject(self, index):
+        """Take proxy index out of rotation for eject_cooldown seconds. It comes back with fresh stats."""
+        stats = self.stats[index]
+        LOGGER.warning('Ejecting proxy {} for {}s: {} requests, success rate {:.2f}'.format(
+            index, self.eject_cooldown, stats.requests, stats.success_rate))
+        stats.ejected_until = self.clock() + self.eject_cooldown
+        stats.ejections += 1
+        stats.requests = stats.successes = stats.consecutive_failures = 0
+
+    def is_ejected(self, index):
+        return self.stats[index].ejected_until > self.clock()
+
+    def is_available(self, index):
+        return not self.is_ejected(index) and self.stats[index].cooldown_until <= self.clock()
+
+    def cooldown_remaining(self, index):
+        return max(0, self.stats[index].cooldown_until - self.clock())
+
+    def weight(self, index):
+        stats = self.stats[index]
+        latency = stats.latency_ewma if stats.latency_ewma is not None else DEFAULT_LATENCY
+        return stats.success_rate / max(latency, 0.05)
+
+    def choose(self, candidates):
+        """Pick one of the candidate indexes, favouring fast and healthy proxies."""
+        candidates = [i for i in candidates if self.is_available(i)]
+        if not candidates:
+            return None
+        return self.rng.choices(candidates, weights=[self.weight(i) for i in candidates])[0]
+
+    def warm_up(self, url=WARM_UP_URL, headers=None, timeout=10, max_workers=20):
+        """Probe every proxy once in parallel to seed latencies and drop dead proxies."""
+        def probe(proxy):
+            return check_proxy(proxy, url=url, headers=headers, timeout=timeout)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(probe, self.proxies))
+
+        for index, (success_counts, tries, elapsed) in enumerate(results):
+            stats = self.stats[index]
+            stats.requests += tries
+            stats.successes += success_counts
+            stats.latency_ewma = elapsed / tries
+            if not success_counts:
+                self.eject(index)
+        LOGGER.info('Warm up done: {} of {} proxies usable'.format(
+            sum(not self.is_ejected(index) for index in range(len(self.stats))), len(self.stats)))
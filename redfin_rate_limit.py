@@ -0,0 +1,121 @@
+"""Token-bucket request budgets per proxy and for the whole crawl."""
+import asyncio
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PROXY_RPS = 0.2
+DEFAULT_GLOBAL_RPS = 50
+
+
+class NoProxyAvailableException(Exception):
+    pass
+
+
+class TokenBucket:
+    """Classic token bucket: refills rate tokens per second up to capacity."""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def wait_time(self):
+        """Seconds until one token is available."""
+        tokens = self.available()
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def try_acquire(self):
+        if self.available() >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateScheduler:
+    """Hand out proxies so that no proxy, and not the crawl as a whole,
+    exceeds its requests-per-second budget.
+
+    acquire_index() hands out the proxy with the most budget left, so requests go
+    to idle proxies first instead of queueing behind busy ones. With a
+    ProxyPool, the pool picks among the proxies that have budget left and
+    cooled down or ejected proxies are skipped.
+    A global_rps of 0 or None disables the global budget.
+    """
+
+    def __init__(self, proxies, proxy_rps=DEFAULT_PROXY_RPS, global_rps=DEFAULT_GLOBAL_RPS,
+                 burst=1, clock=time.monotonic, pool=None):
+        if not proxies:
+            raise ValueError('RateScheduler needs at least one proxy')
+        self.proxies = list(proxies)
+        self.pool = pool
+        self.buckets = [TokenBucket(proxy_rps, burst, clock) for _ in self.proxies]
+        self.global_bucket = TokenBucket(global_rps, max(burst, 1), clock) if global_rps else None
+
+    def _candidates(self, exclude=()):
+        """Indexes of proxies still in play, leaving out exclude unless nothing else is left."""
+        live = [i for i in range(len(self.proxies)) if not (self.pool and self.pool.is_ejected(i))]
+        if not live:
+            raise NoProxyAvailableException('Every proxy is ejected')
+        return [i for i in live if i not in exclude] or live
+
+    def _try_acquire_index(self, exclude=()):
+        if self.global_bucket and self.global_bucket.available() < 1:
+            return None
+        ready = [i for i in self._candidates(exclude) if self.buckets[i].available() >= 1]
+        if self.pool:
+            best = self.pool.choose(ready)
+        else:
+            best = max(ready, key=lambda i: self.buckets[i].available(), default=None)
+        if best is None:
+            return None
+        self.buckets[best].try_acquire()
+        if self.global_bucket:
+            self.global_bucket.try_acquire()
+        return best
+
+    def try_acquire(self, exclude=()):
+        """Return a proxy if both its budget and the global budget allow a request now, else None.
+        Proxies in exclude are only used when no other proxy is left.
+        """
+        index = self._try_acquire_index(exclude)
+        return None if index is None else self.proxies[index]
+
+    def wait_time(self, exclude=()):
+        """Seconds until try_acquire can succeed."""
+        waits = []
+        for i in self._candidates(exclude):
+            wait = self.buckets[i].wait_time()
+            if self.pool:
+                wait = max(wait, self.pool.cooldown_remaining(i))
+            waits.append(wait)
+        wait = min(waits)
+        if self.global_bucket:
+            wait = max(wait, self.global_bucket.wait_time())
+        return wait
+
+    async def acquire_index(self, exclude=()):
+        while True:
+            index = self._try_acquire_index(exclude)
+            if index is not None:
+                return index
+            await asyncio.sleep(self.wait_time(exclude))
+
+    def record(self, index, status=None, latency=None):
+        """Report the outcome of a request made through proxy index."""
+        if self.pool:
+            self.pool.record(index, status, latency)
@@ -0,0 +1,308 @@
+"""SQLite storage: connection tuning, versioned schema migrations and batched writes.
+
+The schema version is kept in PRAGMA user_version. Every entry of MIGRATIONS
+moves the schema one version forward, so databases written by older versions
+of the crawler are upgraded in place the first time they are opened.
+"""
+import logging
+import sqlite3
+
+from redfin_listings import LISTING_DETAILS_COLUMNS
+
+LOGGER = logging.getLogger(__name__)
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 30000',
+)
+
+
+def connect(path):
+    """Open the crawler database with WAL and the tuned pragmas."""
+    conn = sqlite3.connect(path, timeout=30)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+
+
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS URLS
+             (
+             URL            TEXT    NOT NULL,
+             NUM_PROPERTIES INT,
+             NUM_PAGES      INT,
+             PER_PAGE_PROPERTIES   INT);''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS LISTINGS
+             (
+             ID             INTEGER PRIMARY KEY,
+             URL            TEXT    NOT NULL,
+             INFO           TEXT);''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS LISTING_DETAILS
+             (
+             URL            TEXT    PRIMARY KEY,
+             NUMBER_OF_ROOMS INT,
+             NAME           TEXT,
+             COUNTRY        TEXT,
+             REGION         TEXT,
+             LOCALITY       TEXT,
+             STREET         TEXT,
+             POSTOAL        TEXT,
+             TYPE           TEXT,
+             PRICE          REAL
+             );''')
+    _add_listing_details_key(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS CRAWL_STATE
+             (
+             KEY            TEXT    PRIMARY KEY,
+             VALUE);''')
+    # Partition progress: pending urls still need get_partition_info_async, the others are done.
+    # STATUS is one of pending, split, leaf, unsplittable or failed.
+    conn.execute('''CREATE TABLE IF NOT EXISTS FRONTIER
+             (
+             URL            TEXT    PRIMARY KEY,
+             BASE_URL       TEXT    NOT NULL,
+             LEVEL          INT     NOT NULL,
+             STATUS         TEXT    NOT NULL DEFAULT 'pending');''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS FRONTIER_BASE_URL_STATUS
+             ON FRONTIER (BASE_URL, STATUS, LEVEL);''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS FAILED_URLS
+             (
+             URL            TEXT    NOT NULL,
+             STAGE          TEXT    NOT NULL,
+             ATTEMPTS       INT,
+             ERROR          TEXT,
+             FAILED_AT      TIMESTAMP DEFAULT CURRENT_TIMESTAMP);''')
+
+
+def _add_listing_details_key(conn):
+    """Rebuild LISTING_DETAILS tables created before URL became its primary key,
+    keeping the latest row of every listing.
+    """
+    columns = conn.execute("PRAGMA table_info(LISTING_DETAILS)").fetchall()
+    if any(name == 'URL' and pk for _, name, _, _, _, pk in columns):
+        return
+    LOGGER.warning('Adding a primary key to LISTING_DETAILS')
+    conn.execute("ALTER TABLE LISTING_DETAILS RENAME TO LISTING_DETAILS_OLD")
+    conn.execute('''CREATE TABLE LISTING_DETAILS
+             (
+             URL            TEXT    PRIMARY KEY,
+             NUMBER_OF_ROOMS INT,
+             NAME           TEXT,
+             COUNTRY        TEXT,
+             REGION         TEXT,
+             LOCALITY       TEXT,
+             STREET         TEXT,
+             POSTOAL        TEXT,
+             TYPE           TEXT,
+             PRICE          REAL
+             );''')
+    conn.execute("""
+        INSERT OR REPLACE INTO LISTING_DETAILS
+        SELECT * FROM LISTING_DETAILS_OLD ORDER BY rowid""")
+    conn.execute("DROP TABLE LISTING_DETAILS_OLD")
+
+
+def _rename_postal_column(conn):
+    if 'POSTOAL' in _columns(conn, 'LISTING_DETAILS'):
+        conn.execute("ALTER TABLE LISTING_DETAILS RENAME COLUMN POSTOAL TO POSTAL")
+
+
+def _add_url_indexes(conn):
+    # URLS used to get a new row every time a url was fetched. Keep the latest one.
+    conn.execute("""
+        DELETE FROM URLS
+        WHERE rowid NOT IN (SELECT MAX(rowid) FROM URLS GROUP BY URL)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS URLS_URL ON URLS (URL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS LISTINGS_URL ON LISTINGS (URL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS FAILED_URLS_URL ON FAILED_URLS (URL)")
+
+
+def _add_density_cache(conn):
+    # Learned histogram of each filter dimension per region, as shares of its listings.
+    conn.execute('''CREATE TABLE IF NOT EXISTS DENSITY_CACHE
+             (
+             REGION         TEXT    NOT NULL,
+             DIMENSION      TEXT    NOT NULL,
+             LO             INT     NOT NULL,
+             HI             INT     NOT NULL,
+             SHARE          REAL    NOT NULL,
+             UPDATED_AT     TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+             PRIMARY KEY (REGION, DIMENSION, LO));''')
+
+
+def _add_page_store(conn):
+    # Index of the segment files of redfin_page_store. LISTINGS rows written with a
+    # page store keep the hash of their payload instead of the INFO text.
+    conn.execute('''CREATE TABLE IF NOT EXISTS PAGE_STORE
+             (
+             HASH           TEXT    PRIMARY KEY,
+             SEGMENT        INT     NOT NULL,
+             OFFSET         INT     NOT NULL,
+             LENGTH         INT     NOT NULL);''')
+    if 'PAGE_HASH' not in _columns(conn, 'LISTINGS'):
+        conn.execute("ALTER TABLE LISTINGS ADD COLUMN PAGE_HASH TEXT")
+
+
+def _add_listing_versions(conn):
+    # VERSION of the save_listing_details call that last inserted or changed each row,
+    # so exports can pick up only what changed since they last ran.
+    if 'VERSION' not in _columns(conn, 'LISTING_DETAILS'):
+        conn.execute("ALTER TABLE LISTING_DETAILS ADD COLUMN VERSION INT NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS LISTING_DETAILS_VERSION ON LISTING_DETAILS (VERSION)")
+
+
+def _add_listing_ids(conn):
+    """Rebuild LISTINGS tables created before ID became their INTEGER PRIMARY KEY. VACUUM may renumber
+    plain rowids, which would move pages behind the listings_parsed_rowid high-water mark, but keeps ID.
+    """
+    if 'ID' in _columns(conn, 'LISTINGS'):
+        return
+    LOGGER.warning('Adding a primary key to LISTINGS')
+    conn.execute("ALTER TABLE LISTINGS RENAME TO LISTINGS_OLD")
+    conn.execute('''CREATE TABLE LISTINGS
+             (
+             ID             INTEGER PRIMARY KEY,
+             URL            TEXT    NOT NULL,
+             INFO           TEXT,
+             PAGE_HASH      TEXT);''')
+    conn.execute("""
+        INSERT INTO LISTINGS (ID, URL, INFO, PAGE_HASH)
+        SELECT rowid, URL, INFO, PAGE_HASH FROM LISTINGS_OLD""")
+    conn.execute("DROP TABLE LISTINGS_OLD")
+    conn.execute("CREATE INDEX IF NOT EXISTS LISTINGS_URL ON LISTINGS (URL)")
+
+
+MIGRATIONS = [
+    _create_base_tables,
+    _rename_postal_column,
+    _add_url_indexes,
+    _add_density_cache,
+    _add_page_store,
+    _add_listing_versions,
+    _add_listing_ids,
+]
+
+
+def migrate(conn):
+    """Bring the schema up to the latest version. Return the version."""
+    version, = conn.execute('PRAGMA user_version').fetchone()
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        LOGGER.info('Migrating database to schema version {}'.format(target))
+        with conn:
+            migration(conn)
+            conn.execute('PRAGMA user_version = {}'.format(target))
+    return len(MIGRATIONS)
+
+
+def prefix_range(prefix):
+    """Return (low, high) so that low <= URL < high selects the urls starting with prefix
+    through the URL index.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def get_state(db, key, default=None):
+    row = db.execute("SELECT VALUE FROM CRAWL_STATE WHERE KEY = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(db, key, value):
+    db.execute("INSERT OR REPLACE INTO CRAWL_STATE (KEY, VALUE) VALUES (?, ?)", (key, value))
+
+
+def save_page_infos(db, page_infos):
+    """Insert or refresh (url, total properties, page count, properties per page) rows in URLS."""
+    db.executemany("""
+        INSERT INTO URLS (URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (URL) DO UPDATE SET
+            NUM_PROPERTIES = excluded.NUM_PROPERTIES,
+            NUM_PAGES = excluded.NUM_PAGES,
+            PER_PAGE_PROPERTIES = excluded.PER_PAGE_PROPERTIES""", page_infos)
+
+
+def save_listings(db, pages, store=None):
+    """Insert (url, JSON-LD text) rows into LISTINGS.
+    With a PageStore the text goes to the store and the row only keeps its hash.
+    """
+    if store is None:
+        db.executemany("INSERT INTO LISTINGS (URL, INFO) VALUES (?, ?)", pages)
+        return
+    rows = [(url, store.put(info)) for url, info in pages]
+    store.flush()
+    db.executemany("INSERT INTO LISTINGS (URL, PAGE_HASH) VALUES (?, ?)", rows)
+
+
+def move_listings_to_store(db, store, batch_size=1000):
+    """Move the INFO text of older LISTINGS rows into store, committing every batch_size rows.
+    Return the number of rows moved.
+    """
+    moved = 0
+    while True:
+        rows = db.execute("""
+            SELECT rowid, INFO FROM LISTINGS
+            WHERE PAGE_HASH IS NULL AND INFO IS NOT NULL
+            LIMIT ?""", (batch_size,)).fetchall()
+        if not rows:
+            return moved
+        updates = [(store.put(info), rowid) for rowid, info in rows]
+        store.flush()
+        db.executemany("UPDATE LISTINGS SET INFO = NULL, PAGE_HASH = ? WHERE rowid = ?", updates)
+        db.commit()
+        moved += len(rows)
+
+
+def save_listing_details(db, listing_details):
+    """Insert or refresh LISTING_DETAILS rows, keyed by listing url.
+    Rows that are new or changed get the next listing details version. Return it.
+    """
+    version = get_state(db, 'listing_details_version', 0) + 1
+    set_state(db, 'listing_details_version', version)
+    db.executemany("""
+        INSERT INTO LISTING_DETAILS ({columns}, VERSION)
+        VALUES ({values}, {version})
+        ON CONFLICT (URL) DO UPDATE SET {updates}, VERSION = excluded.VERSION
+        WHERE {changed}""".format(
+        columns=', '.join(LISTING_DETAILS_COLUMNS),
+        values=', '.join('?' for _ in LISTING_DETAILS_COLUMNS),
+        version=version,
+        updates=', '.join('{0} = excluded.{0}'.format(c) for c in LISTING_DETAILS_COLUMNS[1:]),
+        changed=' OR '.join('{0} IS NOT excluded.{0}'.format(c) for c in LISTING_DETAILS_COLUMNS[1:])),
+        listing_details)
+    return version
+
+
+def record_failures(db, stage, failures):
+    """Write urls that could not be fetched or parsed to the FAILED_URLS dead-letter table."""
+    if not failures:
+        return
+    LOGGER.warning('{} urls failed in stage {}'.format(len(failures), stage))
+    db.executemany("""
+        INSERT INTO FAILED_URLS (URL, STAGE, ATTEMPTS, ERROR)
+        VALUES (?, ?, ?, ?)""", [(f.url, stage, f.attempts, '{}: {}'.format(type(f.error).__name__, f.error))
+                                 for f in failures])
+
+
+def load_density_cache(db, region):
+    """Return the cached (region, dimension, lo, hi, share) rows of region.
+    A region crawled for the first time gets the rows of all other regions instead.
+    """
+    query = "SELECT REGION, DIMENSION, LO, HI, SHARE FROM DENSITY_CACHE WHERE REGION {} ? ORDER BY REGION, DIMENSION, LO"
+    rows = db.execute(query.format('='), (region,)).fetchall()
+    return rows or db.execute(query.format('!='), (region,)).fetchall()
+
+
+def save_density_cache(db, region, dimension, bins):
+    """Replace the cached [(lo, hi, share)] histogram of one dimension of region."""
+    db.execute("DELETE FROM DENSITY_CACHE WHERE REGION = ? AND DIMENSION = ?", (region, dimension))
+    db.executemany("""
+        INSERT INTO DENSITY_CACHE (REGION, DIMENSION, LO, HI, SHARE)
+        VALUES (?, ?, ?, ?, ?)""", [(region, dimension, lo, hi, share) for lo, hi, share in bins])
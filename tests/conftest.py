@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+
+import redfin_crawler
+from redfin_fake_server import BASE_PATH, ServerThread
+from redfin_proxy_pool import ProxyPool
+from redfin_rate_limit import RateScheduler
+
+
+class FakeClock:
+    """Clock the tests move by setting now."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CrawlServer:
+    """Fake Redfin regions and proxy stubs served from one ServerThread."""
+
+    def __init__(self, thread):
+        self.thread = thread
+
+    def serve(self, fake):
+        """Start a FakeRedfin and return its base url."""
+        return 'http://127.0.0.1:{}{}'.format(self.thread.start(fake.app()), BASE_PATH)
+
+    def scheduler(self, *stubs):
+        """Start ProxyStubs and return a scheduler over a pool of them, fast enough not to hold tests up."""
+        pool = ProxyPool([redfin_crawler.construct_proxy('127.0.0.1', self.thread.start(stub.app())) for stub in stubs])
+        return RateScheduler(pool.proxies, proxy_rps=500, global_rps=0, pool=pool)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def server_thread():
+    thread = ServerThread()
+    yield thread
+    thread.stop()
+
+
+@pytest.fixture
+def crawl_server(server_thread):
+    return CrawlServer(server_thread)
+
+
+@pytest.fixture
+def crawl_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(redfin_crawler, 'LOGGER', logging.getLogger(__name__))
+    monkeypatch.setattr(redfin_crawler, 'SQLITE_DB_PATH', str(tmp_path / 'crawl.db'))
+    monkeypatch.setattr(redfin_crawler, 'PAGE_STORE_PATH', str(tmp_path / 'pages'))
+    redfin_crawler.create_tables_if_not_exist()
+    return redfin_crawler.SQLITE_DB_PATH
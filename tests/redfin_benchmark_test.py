@@ -0,0 +1,21 @@
+from redfin_benchmark import Result, compare, report, simulate_partition
+from redfin_fake_server import FakeRedfin, generate_listings
+
+
+def test_simulated_partition_covers_every_listing():
+    fake = FakeRedfin(generate_listings(3000, towers=1, tower_size=400))
+    planned = simulate_partition(fake, planned=True)
+    fixed = simulate_partition(fake, planned=False)
+    for stats in (planned, fixed):
+        assert stats['covered'] == 3400
+        assert stats['unsplittable'] == 0
+    assert planned['partition_requests'] <= fixed['partition_requests']
+
+
+def test_compare_flags_regressions_beyond_tolerance():
+    baseline = report([Result('rate', 100.0, 'rows/s', 'higher'), Result('requests', 50.0, 'requests', 'lower')])
+    assert compare([Result('rate', 95.0, 'rows/s', 'higher'), Result('requests', 54.0, 'requests', 'lower')],
+                   baseline) == []
+    regressions = compare([Result('rate', 80.0, 'rows/s', 'higher'), Result('requests', 60.0, 'requests', 'lower'),
+                           Result('new', 1.0, 'rows/s', 'higher')], baseline)
+    assert [(r.name, base) for r, base in regressions] == [('rate', 100.0), ('requests', 50.0)]
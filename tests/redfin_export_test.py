@@ -0,0 +1,45 @@
+import pyarrow as pa
+
+from redfin_export import SCHEMA, export_listing_details, latest_listings, read_listing_details, to_record_batch
+from redfin_storage import connect, migrate, save_listing_details
+
+SAN_JOSE = ('https://www.redfin.com/CA/San-Jose/1', 3, '1 Main St', 'US', 'CA', 'San Jose', '1 Main St', '95123',
+            'SingleFamilyResidence', 1000000.0)
+SEATTLE = ('https://www.redfin.com/WA/Seattle/2', 2, '2 Pike St', 'US', 'WA', 'Seattle', '2 Pike St', '98101',
+           'Apartment', 500000.0)
+
+
+def test_rows_are_typed():
+    batch = to_record_batch([SAN_JOSE + (1,), ('u', 'three', None, 'US', None, None, None, 95123, None, 'n/a', 1)])
+    assert batch.schema == SCHEMA
+    assert batch.column(1).to_pylist() == [3, None]
+    assert batch.column(7).to_pylist() == ['95123', '95123']
+    assert batch.column(9).to_pylist() == [1000000.0, None]
+
+
+def test_export_appends_changed_rows(tmp_path):
+    db_path, output = str(tmp_path / 'crawl.db'), str(tmp_path / 'listings')
+    db = connect(db_path)
+    migrate(db)
+    save_listing_details(db, [SAN_JOSE, SEATTLE])
+    db.commit()
+    for fmt in ('parquet', 'ipc'):
+        assert export_listing_details(db_path, output + fmt, fmt=fmt) == 2
+        assert export_listing_details(db_path, output + fmt, fmt=fmt) == 0
+
+    # Saving an unchanged row does not make it new again.
+    save_listing_details(db, [SAN_JOSE[:-1] + (900000.0,), SEATTLE])
+    db.commit()
+    assert export_listing_details(db_path, output + 'parquet') == 1
+
+    dataset = read_listing_details(output + 'parquet')
+    table = dataset.to_table()
+    assert table.num_rows == 3
+    assert pa.types.is_dictionary(table.schema.field('TYPE').type)
+    latest = latest_listings(table).sort_by('URL')
+    assert latest.column('PRICE').to_pylist() == [900000.0, 500000.0]
+    assert latest.column('LOCALITY').to_pylist() == ['San Jose', 'Seattle']
+
+    assert export_listing_details(db_path, output + 'parquet', full=True) == 2
+    assert read_listing_details(output + 'parquet').count_rows() == 2
+    assert read_listing_details(output + 'ipc', fmt='ipc').count_rows() == 2
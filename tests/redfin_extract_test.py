@@ -0,0 +1,31 @@
+from redfin_extract import extract_listings, extract_listings_bs4, extract_summary, extract_summary_bs4
+
+PAGE = '''<html><head>
+<script type="application/ld+json">[{"@type": "SingleFamilyResidence", "url": "/CA/Belmont/home/1",
+ "address": {"streetAddress": "1 Main St"}}, {"offers": {"price": 1500000}}]</script>
+<script type="text/javascript">var x = 1;</script>
+</head><body>
+<div class="homes summary">Showing 20 of 45 <span>homes</span> &amp; more</div>
+<a class="clickable goToPage" href="/page-1">1</a><a class="goToPage" href="/page-2"> 2 </a>
+<a class="other">3</a>
+<script type='application/ld+json'>{"url": "/CA/Belmont/home/2", "address": {}}</script>
+</body></html>'''
+
+
+def test_extract_listings_matches_bs4():
+    assert extract_listings(PAGE) == extract_listings_bs4(PAGE)
+    assert len(extract_listings(PAGE)) == 2
+    assert extract_listings('<html></html>') == []
+
+
+def test_extract_summary_matches_bs4():
+    assert extract_summary(PAGE) == extract_summary_bs4(PAGE)
+    assert extract_summary(PAGE) == ('Showing 20 of 45 homes & more', [1, 2])
+    assert extract_summary('<html><div class="homes">x</div></html>') == (None, [])
+
+
+def test_extract_summary_falls_back_to_bs4():
+    page = '<div data-x="homes summary" class=\'homes summary\' >Showing 3 homes</div>'
+    assert extract_summary(page) == ('Showing 3 homes', [])
+    page = '<div class = "homes summary">Showing 3 homes</div>'
+    assert extract_summary(page) == ('Showing 3 homes', [])
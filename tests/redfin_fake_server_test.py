@@ -0,0 +1,288 @@
+import sqlite3
+
+import pytest
+
+import redfin_crawler
+from redfin_extract import extract_listings
+from redfin_fetcher import DEFAULT_MAX_ATTEMPTS, FetchFailedException, run_all
+from redfin_http_cache import HttpCache
+from redfin_fake_server import BASE_PATH, FakeRedfin, ProxyStub, churn, generate_listings
+from redfin_listings import parse_pages
+from redfin_rate_limit import NoProxyAvailableException
+
+
+def test_pages_follow_filters_and_pagination():
+    fake = FakeRedfin(generate_listings(500, towers=1, tower_size=100))
+    assert len(fake.search('')) == 600
+    matches = fake.search('include=sold-3yr,min-price=300000,max-price=600000,min-beds=2,max-beds=2')
+    assert matches and all(300000 <= m.price < 600000 and m.beds == 2 for m in matches)
+    # Half-open siblings add up to their parent.
+    assert len(fake.search('min-sqft=10-sqft,max-sqft=1000-sqft')) + len(fake.search('min-sqft=1000-sqft')) == 600
+
+    url, total, num_pages, per_page = redfin_crawler.parse_page_info('u', fake.render(fake.search(''), 1))
+    assert (total, num_pages, per_page) == (600, 18, 20)
+    assert len(extract_listings(fake.render(fake.search(''), 18))) == 20
+    assert extract_listings(fake.render(fake.search(''), 19)) == []
+    assert redfin_crawler.parse_page_info('u', fake.render([], 1)) == ('u', 0, 0, 20)
+
+
+def test_crawl_through_proxy_stubs_finds_every_listing(crawl_paths, crawl_server):
+    listings = generate_listings(1500, towers=1, tower_size=400)
+    fake = FakeRedfin(listings)
+    stubs = [ProxyStub(seed=i) for i in range(2)]
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(*stubs)
+    redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+    redfin_crawler.crawl_redfin_with_proxies(scheduler)
+    redfin_crawler.parse_addresses(workers=1)
+
+    with sqlite3.connect(crawl_paths) as db:
+        found = {row[0] for row in db.execute('SELECT URL FROM LISTING_DETAILS')}
+    assert found == {listing.url for listing in listings}
+    assert sum(stub.stats['requests'] for stub in stubs) == fake.stats['requests']
+
+
+def test_transient_failures_are_retried_through_another_proxy(crawl_server):
+    fake = FakeRedfin(generate_listings(100))
+    fake.fail(BASE_PATH, times=1)
+    stubs = [ProxyStub(seed=i) for i in range(2)]
+    url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(*stubs)
+    info, = run_all(redfin_crawler.get_page_info_async, [url], scheduler=scheduler, max_attempts=2)
+    assert info == (url, 100, 5, 20)
+    assert fake.stats[503] == 1
+    assert [stub.stats['requests'] for stub in stubs] == [1, 1]
+
+
+def test_target_errors_are_dead_lettered_without_ejecting_proxies(crawl_server):
+    fake = FakeRedfin(generate_listings(100))
+    fake.fail(BASE_PATH)
+    stubs = [ProxyStub(seed=i) for i in range(2)]
+    base_url = crawl_server.serve(fake)
+    urls = [base_url + 'filter/min-price={}'.format(price) for price in range(6)]
+    scheduler = crawl_server.scheduler(*stubs)
+    pool = scheduler.pool
+    results = run_all(redfin_crawler.get_page_info_async, urls, scheduler=scheduler, backoff=0.01)
+    assert fake.stats[503] == 6 * DEFAULT_MAX_ATTEMPTS
+    assert all(isinstance(result, FetchFailedException) for result in results)
+    assert not any(pool.is_ejected(index) for index in range(len(pool.proxies)))
+
+    # Without a proxy left, urls fail instead of the whole run.
+    for index in range(len(pool.proxies)):
+        pool.eject(index)
+    result, = run_all(redfin_crawler.get_page_info_async, urls[:1], scheduler=scheduler)
+    assert isinstance(result.error, NoProxyAvailableException)
+
+
+def test_crawl_recovers_from_transient_failures_and_dead_letters_permanent_ones(crawl_paths, crawl_server):
+    listings = generate_listings(600)
+    fake = FakeRedfin(listings)
+    fake.fail('page-', times=1)
+    fake.fail('page-3')
+    stub = ProxyStub()
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12, max_attempts=3)
+    redfin_crawler.parse_addresses(workers=1)
+
+    with sqlite3.connect(crawl_paths) as db:
+        failed = db.execute('SELECT URL, STAGE, ATTEMPTS FROM FAILED_URLS').fetchall()
+        found = {row[0] for row in db.execute('SELECT URL FROM LISTING_DETAILS')}
+    assert failed and all(url.endswith('/page-3') and stage == 'page' and attempts == 3
+                          for url, stage, attempts in failed)
+    # Every page but the third ones of their leaves got through after a retry.
+    assert len(found) == len(listings) - 20 * len(failed)
+    assert fake.stats[200] == fake.stats['requests'] - fake.stats[503]
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_partitions_failing_for_good_end_the_crawl(crawl_paths, crawl_server, pipelined):
+    fake = FakeRedfin(generate_listings(1000))
+    # Every filtered partition is fetched through its first page, only the base url gets through.
+    fake.fail('/page-1', status=404)
+    stub = ProxyStub()
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    if pipelined:
+        redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12)
+    else:
+        redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+
+    with sqlite3.connect(crawl_paths) as db:
+        statuses = dict(db.execute('SELECT URL, STATUS FROM FRONTIER').fetchall())
+        num_failed, = db.execute("SELECT COUNT(*) FROM FAILED_URLS WHERE STAGE = 'partition'").fetchone()
+    assert statuses.pop(base_url) == 'split'
+    assert statuses and set(statuses.values()) == {'failed'}
+    assert num_failed == len(statuses) == fake.stats[404]
+
+
+def _record_urls(fake):
+    """Keep the urls the server is asked for in fake.urls."""
+    fake.urls = []
+    handle = fake.handle
+
+    async def recording(request):
+        fake.urls.append(str(request.url))
+        return await handle(request)
+    fake.handle = recording
+
+
+def test_partition_resumes_after_a_crash(crawl_paths, crawl_server, monkeypatch):
+    fake = FakeRedfin(generate_listings(3000), max_pages=3)
+    _record_urls(fake)
+    # The first fetch of every filtered partition gets a 404, which is not retried within a run.
+    fake.fail('/page-1', times=1, status=404)
+    stub = ProxyStub()
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+    with sqlite3.connect(crawl_paths) as db:
+        failed = {row[0] for row in db.execute("SELECT URL FROM FRONTIER WHERE STATUS = 'failed'")}
+    assert failed
+    del fake.failures[:]
+
+    # The next run retries the failed partitions and crashes after its second batch.
+    save_partition_results = redfin_crawler.save_partition_results
+    batches = []
+
+    def crash(*args, **kwargs):
+        batches.append(args)
+        if len(batches) > 2:
+            raise sqlite3.OperationalError('database is locked')
+        return save_partition_results(*args, **kwargs)
+    monkeypatch.setattr(redfin_crawler, 'save_partition_results', crash)
+    with pytest.raises(sqlite3.OperationalError):
+        redfin_crawler.url_partition(base_url, scheduler, max_levels=12, batch_size=10)
+    monkeypatch.setattr(redfin_crawler, 'save_partition_results', save_partition_results)
+    with sqlite3.connect(crawl_paths) as db:
+        done = {row[0] for row in db.execute("SELECT URL FROM FRONTIER WHERE STATUS NOT IN ('pending', 'failed')")}
+        retried = failed & done
+    assert retried and retried != failed
+
+    del fake.urls[:]
+    leaves = redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+    fetched = {url.replace(',sort=lo-price/page-1', '') for url in fake.urls}
+    assert failed - retried <= fetched and not done & fetched
+    with sqlite3.connect(crawl_paths) as db:
+        assert db.execute("SELECT URL FROM FRONTIER WHERE STATUS NOT IN ('split', 'leaf')").fetchall() == []
+    assert sum(redfin_crawler.property_count(leaf[1:]) for leaf in leaves) == len(fake.listings)
+
+
+def test_scraping_skips_pages_already_in_listings(crawl_paths, crawl_server):
+    fake = FakeRedfin(generate_listings(2000))
+    _record_urls(fake)
+    stub = ProxyStub()
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+    redfin_crawler.crawl_redfin_with_proxies(scheduler)
+    with sqlite3.connect(crawl_paths) as db:
+        lost = {row[0] for row in db.execute("SELECT URL FROM LISTINGS WHERE rowid % 3 = 0")}
+        db.execute("DELETE FROM LISTINGS WHERE rowid % 3 = 0")
+    assert lost
+
+    del fake.urls[:]
+    redfin_crawler.crawl_redfin_with_proxies(scheduler)
+    assert sorted(fake.urls) == sorted(lost)
+
+
+def test_scraping_stops_when_a_batch_cannot_be_saved(crawl_paths, crawl_server, monkeypatch):
+    fake = FakeRedfin(generate_listings(2000))
+    stub = ProxyStub()
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.url_partition(base_url, scheduler, max_levels=12)
+    with sqlite3.connect(crawl_paths) as db:
+        num_first_pages, = db.execute('SELECT COUNT(*) FROM LISTINGS').fetchone()
+
+    # The second batch is half written when the database gives up.
+    save_listings = redfin_crawler.save_listings
+    batches = []
+
+    def fail_second(db, pages, store=None):
+        batches.append(pages)
+        save_listings(db, pages[:5], store)
+        if len(batches) == 2:
+            raise sqlite3.OperationalError('disk I/O error')
+        save_listings(db, pages[5:], store)
+    monkeypatch.setattr(redfin_crawler, 'save_listings', fail_second)
+    with pytest.raises(sqlite3.OperationalError):
+        redfin_crawler.crawl_redfin_with_proxies(scheduler, batch_size=10)
+    with sqlite3.connect(crawl_paths) as db:
+        assert db.execute('SELECT COUNT(*) FROM LISTINGS').fetchone()[0] == num_first_pages + len(batches[0])
+
+    monkeypatch.setattr(redfin_crawler, 'save_listings', save_listings)
+    redfin_crawler.crawl_redfin_with_proxies(scheduler)
+    with sqlite3.connect(crawl_paths) as db:
+        assert db.execute('SELECT COUNT(*) FROM LISTINGS').fetchone()[0] == len(redfin_crawler.get_paginated_urls(''))
+
+
+def test_regions_share_one_crawl(crawl_paths, crawl_server):
+    fakes = [FakeRedfin(generate_listings(1200, seed=1)), FakeRedfin(generate_listings(300, seed=2))]
+    stub = ProxyStub()
+    base_urls = [crawl_server.serve(fake) for fake in fakes]
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.crawl_regions(base_urls, scheduler, max_levels=12)
+
+    with sqlite3.connect(crawl_paths) as db:
+        store = redfin_crawler.open_page_store(db)
+        for base_url, fake in zip(base_urls, fakes):
+            rows = db.execute("""
+                SELECT L.URL, S.SEGMENT, S.OFFSET, S.LENGTH
+                FROM LISTINGS L JOIN PAGE_STORE S ON L.PAGE_HASH = S.HASH
+                WHERE L.URL LIKE ?""", (base_url + '%',)).fetchall()
+            details = parse_pages([(url, store.ref(*location)) for url, *location in rows])
+            assert {d[0] for d in details} == {listing.url for listing in fake.listings}
+    assert stub.stats['requests'] == sum(fake.stats['requests'] for fake in fakes)
+
+
+def _matches(url, listing):
+    """Whether listing is under the partition url."""
+    return bool(FakeRedfin([listing]).search(url.partition('/filter/')[2]))
+
+
+def test_refresh_recrawls_only_changed_leaves(crawl_paths, crawl_server, tmp_path):
+    listings = generate_listings(3000)
+    fake = FakeRedfin(listings, max_pages=3)
+    stub = ProxyStub()
+    cache = HttpCache(str(tmp_path / 'cache.db'))
+    base_url = crawl_server.serve(fake)
+    scheduler = crawl_server.scheduler(stub)
+    redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12, cache=cache)
+    full_requests = fake.stats['requests']
+    with sqlite3.connect(crawl_paths) as db:
+        num_leaves, = db.execute("SELECT COUNT(*) FROM FRONTIER WHERE STATUS = 'leaf'").fetchone()
+
+    # Probes are revalidated although their cached copies are fresh.
+    redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12, cache=cache, refresh=True)
+    assert fake.stats['requests'] - full_requests == fake.stats[304] == num_leaves
+
+    # A sale dropped out of the sold-3yr window and another one came in, in another leaf
+    # of the same split partition, whose count stayed the same.
+    with sqlite3.connect(crawl_paths) as db:
+        frontier = db.execute('SELECT URL, STATUS FROM FRONTIER WHERE LEVEL > 0 ORDER BY LEVEL DESC').fetchall()
+    gone = listings[len(listings) // 2]
+    split = next(url for url, status in frontier if status == 'split' and _matches(url, gone))
+    leaf = next(url for url, status in frontier if status == 'leaf' and _matches(url, gone))
+    new = next(listing for listing in generate_listings(100, seed=1, first_id=20000)
+               if _matches(split, listing) and not _matches(leaf, listing))
+    listings = sorted([listing for listing in listings if listing != gone] + [new],
+                      key=lambda listing: listing.price)
+    fake.update(listings)
+    redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12, cache=cache, refresh=True)
+
+    # A day later some more sales dropped out, as many new ones came in,
+    # and a new tower went up in one of the leaves.
+    tower = generate_listings(0, towers=1, tower_size=80, first_id=10000)
+    fake.update(sorted(churn(listings, sold=0.003, added=0.003) + tower, key=lambda listing: listing.price))
+    before = fake.stats['requests']
+    redfin_crawler.crawl_regions([base_url], scheduler, max_levels=12, cache=cache, refresh=True)
+    refresh_requests = fake.stats['requests'] - before
+    cache.close()
+    redfin_crawler.parse_addresses(workers=1)
+
+    with sqlite3.connect(crawl_paths) as db:
+        found = {row[0] for row in db.execute('SELECT URL FROM LISTING_DETAILS')}
+    assert new.url in found
+    assert {listing.url for listing in fake.listings} <= found
+    assert refresh_requests < full_requests / 1.5
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from redfin_fetcher import FairQueue, run_all, run_streaming, run_work_queue
+
+
+def test_run_all_fetches_concurrently_in_input_order(server_thread):
+    in_flight, peak = [0], [0]
+
+    async def page(request):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return web.Response(text='body of {}'.format(request.path))
+
+    app = web.Application()
+    app.router.add_get('/{name}', page)
+    base_url = 'http://127.0.0.1:{}/'.format(server_thread.start(app))
+
+    async def fetch(fetcher, url):
+        return await fetcher.fetch(url)
+
+    names = [str(i) for i in range(20)]
+    assert run_all(fetch, [base_url + name for name in names], concurrency=4) == [
+        'body of /{}'.format(name) for name in names]
+    assert 1 < peak[0] <= 4
+
+
+def test_run_work_queue_feeds_written_items_back():
+    async def worker(fetcher, item):
+        return item
+
+    batches = []
+
+    def write_batch(results):
+        batches.append(sorted(results))
+        # Every item n > 0 spawns two items n - 1.
+        return [n - 1 for n in results if n > 0 for _ in range(2)]
+
+    assert run_work_queue(worker, [3], write_batch, batch_size=4, concurrency=2) == 15
+    assert sorted(n for batch in batches for n in batch) == [0] * 8 + [1] * 4 + [2] * 2 + [3]
+    assert all(len(batch) <= 4 for batch in batches)
+
+
+def test_fair_queue_takes_turns_between_keys():
+    queue = FairQueue(lambda item: item[0], ['a1', 'a2', 'a3', 'b1'])
+    queue.extend(['c1', 'b2'])
+    order = []
+    while queue:
+        order.append(queue.popleft())
+    assert order == ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+    assert len(queue) == 0
+
+
+def test_run_streaming_stops_when_write_batch_fails():
+    async def worker(fetcher, item):
+        return item
+
+    def write_batch(results):
+        raise RuntimeError('database is locked')
+
+    # More results than fit in the queue, so the producers would block on a dead writer.
+    with pytest.raises(RuntimeError, match='database is locked'):
+        run_streaming(worker, range(1000), write_batch, batch_size=4, concurrency=2)
@@ -1,4 +1,6 @@
-from redfin_filters import add_sqft_filters, add_price_filters, add_year_filters, apply_filters, REDFIN_BASE_URL
+from redfin_filters import add_sqft_filters, add_price_filters, add_year_filters, apply_filters
+
+REDFIN_BASE_URL = 'https://www.redfin.com/city/17420/CA/San-Jose/'
 
 
 # def test_add_sqft_filters():
@@ -25,11 +27,16 @@ from redfin_filters import add_sqft_filters, add_price_filters, add_year_filters
 
 def test_apply_filters():
     def base_url():
-        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/')
-        assert sub_urls == [REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1000,max-price=1000000', REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1000000,max-price=2000000']
+        sub_urls = apply_filters(REDFIN_BASE_URL, REDFIN_BASE_URL)
+        assert sub_urls == [
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1000,max-price=300000',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=300000,max-price=600000',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=600000,max-price=1000000',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1000000,max-price=2000000',
+        ]
 
     def price_only_url():
-        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=1000000,max-price=2000000')
+        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=1000000,max-price=2000000', REDFIN_BASE_URL)
         assert sub_urls == [
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1000000,max-price=1200000',
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1200000,max-price=1400000',
@@ -38,38 +45,53 @@ def test_apply_filters():
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=1800000,max-price=2000000',
         ]
 
-        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000')
+        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000', REDFIN_BASE_URL)
         assert sub_urls == [
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=1000-sqft',
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=1000-sqft,max-sqft=12000-sqft',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=1000-sqft',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=1000-sqft',
         ]
 
     def price_sqft_filter_url():
-        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=1000-sqft')
+        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=1000-sqft', REDFIN_BASE_URL)
         assert sub_urls == [
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=208-sqft',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=208-sqft',
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=208-sqft,max-sqft=406-sqft',
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=406-sqft,max-sqft=604-sqft',
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=604-sqft,max-sqft=802-sqft',
             REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=802-sqft,max-sqft=1000-sqft',
         ]
 
-        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft')
+        sub_urls = apply_filters('https://www.redfin.com/city/17420/CA/San-Jose/filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft', REDFIN_BASE_URL)
+        # The year children reach beyond 1900 and 2018 on their open ends.
         assert sub_urls == [
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1900,max-year-built=2018'
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,max-year-built=1923',
+        ] + [
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built={},max-year-built={}'.format(lo, lo + 23)
+            for lo in (1923, 1946, 1969)
+        ] + [
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1992',
         ]
 
     def price_sqft_year_filter_url():
-        sub_urls = apply_filters(REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1900,max-year-built=2000')
+        sub_urls = apply_filters(REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,max-year-built=2000', REDFIN_BASE_URL)
         assert sub_urls == [
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1900,max-year-built=1920',
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1920,max-year-built=1940',
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1940,max-year-built=1960',
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1960,max-year-built=1980',
-            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=10-sqft,max-sqft=11-sqft,min-year-built=1980,max-year-built=2000',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,max-year-built=1920',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1920,max-year-built=1940',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1940,max-year-built=1960',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1960,max-year-built=1980',
+            REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1980,max-year-built=2000',
         ]
 
+    def price_sqft_year_beds_filter_url():
+        # A single year falls back to one child per number of bedrooms.
+        url = REDFIN_BASE_URL + 'filter/include=sold-3yr,min-price=100000,max-price=101000,max-sqft=11-sqft,min-year-built=1990,max-year-built=1991'
+        sub_urls = apply_filters(url, REDFIN_BASE_URL)
+        assert sub_urls == [url + ',max-beds=0'] + [url + ',min-beds={0},max-beds={0}'.format(beds) for beds in range(1, 5)] + [
+            url + ',min-beds=5']
+        assert apply_filters(sub_urls[2], REDFIN_BASE_URL) == [sub_urls[2]]
+
     base_url()
     price_only_url()
     price_sqft_filter_url()
     price_sqft_year_filter_url()
+    price_sqft_year_beds_filter_url()
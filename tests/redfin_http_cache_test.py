@@ -0,0 +1,78 @@
+import pytest
+from aiohttp import web
+
+from redfin_fetcher import FetchFailedException, run_all
+from redfin_http_cache import HttpCache
+
+
+@pytest.fixture
+def server(server_thread):
+    """A page served with an ETag, answering 304 to matching conditional requests."""
+    requests = []
+
+    async def page(request):
+        requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text='body of {}'.format(request.path), headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/{name}', page)
+    return 'http://127.0.0.1:{}/'.format(server_thread.start(app)), requests
+
+
+async def fetch(fetcher, url):
+    try:
+        return await fetcher.fetch(url)
+    except FetchFailedException as e:
+        return e
+
+
+def test_cache_serves_fresh_and_revalidates_stale(server, tmp_path, clock):
+    base_url, requests = server
+    clock.now = 1000.0
+    cache = HttpCache(str(tmp_path / 'cache.db'), ttl=60, clock=clock)
+
+    urls = [base_url + 'a', base_url + 'b']
+    assert run_all(fetch, urls, cache=cache) == ['body of /a', 'body of /b']
+    assert run_all(fetch, urls, cache=cache) == ['body of /a', 'body of /b']
+    assert requests == [None, None]
+
+    clock.now += 61
+    assert run_all(fetch, urls, cache=cache) == ['body of /a', 'body of /b']
+    assert requests == [None, None, '"v1"', '"v1"']
+    assert (cache.hits, cache.revalidated, cache.misses) == (2, 2, 2)
+
+    async def revalidate(fetcher, url):
+        return await fetcher.fetch(url, revalidate=True)
+    assert run_all(revalidate, urls, cache=cache) == ['body of /a', 'body of /b']
+    assert requests[4:] == ['"v1"', '"v1"']
+    cache.close()
+
+    replay = HttpCache(str(tmp_path / 'cache.db'), replay=True)
+    results = run_all(fetch, urls + [base_url + 'c'], cache=replay)
+    assert results[:2] == ['body of /a', 'body of /b']
+    assert isinstance(results[2], FetchFailedException)
+    assert run_all(revalidate, urls, cache=replay) == ['body of /a', 'body of /b']
+    assert len(requests) == 6
+    replay.close()
+
+
+def test_old_responses_are_pruned_on_open(tmp_path, clock):
+    path = str(tmp_path / 'cache.db')
+    cache = HttpCache(path, clock=clock)
+    cache.put('old', 'old body')
+    clock.now = 100.0
+    cache.put('new', 'new body')
+    cache.close()
+
+    # Replaying keeps everything the cache holds.
+    replay = HttpCache(path, replay=True, max_age=50, clock=clock)
+    assert replay.get('old') is not None
+    replay.close()
+
+    clock.now = 120.0
+    cache = HttpCache(path, max_age=50, clock=clock)
+    assert cache.get('old') is None
+    assert cache.get('new').body == 'new body'
+    cache.close()
@@ -0,0 +1,71 @@
+import socket
+import sqlite3
+import threading
+
+import redfin_crawler
+from redfin_fake_server import FakeRedfin, ProxyStub, generate_listings
+from redfin_lease import LeaseQueue
+
+
+def test_expired_leases_are_requeued_and_not_done_twice(clock):
+    queue = LeaseQueue(visibility_timeout=10, clock=clock)
+    queue.add([['a', 1], ['b', 2], ['c', 3]])
+    lost, items = queue.lease('w1', 2)
+    assert items == [('a', 1), ('b', 2)]
+    clock.now = 11
+    assert not queue.done
+    second, items = queue.lease('w2', 5)
+    assert items == [('c', 3), ('a', 1), ('b', 2)]
+    assert queue.expired == 1
+
+    # The first worker was only slow: its results count, and the copies leased again are not handed out twice.
+    assert not queue.complete(lost, [['a', 1], ['b', 2]])
+    assert queue.complete(second, [['c', 3], ['a', 1], ['b', 2]])
+    assert queue.done
+    assert queue.lease('w1', 5) == (None, [])
+
+
+def test_late_results_skip_the_requeued_copy(clock):
+    queue = LeaseQueue(visibility_timeout=10, clock=clock)
+    queue.add([['a', 1]])
+    lost, _ = queue.lease('w1', 1)
+    clock.now = 11
+    queue.expire()
+    assert queue.status()['queued'] == 1
+    assert not queue.complete(lost, [['a', 1]])
+    assert queue.lease('w2', 1) == (None, [])
+    assert queue.done
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_workers_crawl_for_a_coordinator(crawl_paths, crawl_server):
+    fakes = [FakeRedfin(generate_listings(1200, seed=1)), FakeRedfin(generate_listings(300, seed=2))]
+    stubs = [ProxyStub(seed=i) for i in range(2)]
+    base_urls = [crawl_server.serve(fake) for fake in fakes]
+    port = _free_port()
+    coordinator = threading.Thread(target=redfin_crawler.coordinate_regions, args=(base_urls, '127.0.0.1', port),
+                                   kwargs={'max_levels': 12})
+    coordinator.start()
+    workers = []
+    for stub in stubs:
+        scheduler = crawl_server.scheduler(stub)
+        workers.append(threading.Thread(target=redfin_crawler.run_worker,
+                                        args=('http://127.0.0.1:{}/'.format(port), scheduler),
+                                        kwargs={'concurrency': 10, 'lease_size': 5}))
+    for worker in workers:
+        worker.start()
+    for thread in workers + [coordinator]:
+        thread.join(timeout=120)
+        assert not thread.is_alive()
+    redfin_crawler.parse_addresses(workers=1)
+
+    with sqlite3.connect(crawl_paths) as db:
+        found = {row[0] for row in db.execute('SELECT URL FROM LISTING_DETAILS')}
+        assert db.execute("SELECT COUNT(*) FROM FRONTIER WHERE STATUS = 'pending'").fetchone()[0] == 0
+    assert found == {listing.url for fake in fakes for listing in fake.listings}
+    assert sum(stub.stats['requests'] for stub in stubs) == sum(fake.stats['requests'] for fake in fakes)
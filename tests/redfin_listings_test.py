@@ -0,0 +1,39 @@
+import json
+
+from redfin_listings import parse_listing, parse_pages
+
+HOME = {
+    '@type': 'SingleFamilyResidence',
+    'url': '/CA/Belmont/1-Main-St-94002/home/1',
+    'name': '1 Main St',
+    'numberOfRooms': 3,
+    'address': {
+        'addressCountry': 'US',
+        'addressRegion': 'CA',
+        'addressLocality': 'Belmont',
+        'streetAddress': '1 Main St',
+        'postalCode': '94002',
+    },
+}
+OFFER = {'@type': 'Product', 'offers': {'price': 1500000}}
+
+
+def test_parse_listing():
+    row = ('/CA/Belmont/1-Main-St-94002/home/1', 3, '1 Main St', 'US', 'CA', 'Belmont', '1 Main St', '94002',
+           'SingleFamilyResidence', None)
+    assert parse_listing(HOME) == row
+    assert parse_listing([HOME, OFFER]) == row[:-1] + (1500000,)
+    assert parse_listing([OFFER]) is None
+    assert parse_listing('text') is None
+
+
+def test_parse_pages_keeps_last_copy_of_a_listing():
+    cheaper = {'@type': 'Product', 'offers': {'price': 1000}}
+    rows = [
+        ('page-1', json.dumps([[HOME, OFFER], {'@type': 'BreadcrumbList'}])),
+        ('page-2', json.dumps([[HOME, cheaper]])),
+        ('page-3', 'not json'),
+    ]
+    details = parse_pages(rows)
+    assert len(details) == 1
+    assert details[0][-1] == 1000
@@ -0,0 +1,56 @@
+import json
+import urllib.request
+
+from redfin_metrics import FANOUT_BUCKETS, Histogram, Metrics, SnapshotWriter, metric_name, serve_metrics
+
+
+def test_histogram_quantiles_stay_in_their_bucket():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.02)
+    for _ in range(10):
+        histogram.observe(3.0)
+    assert 0.01 < histogram.quantile(0.5) <= 0.025
+    assert 2.5 < histogram.quantile(0.99) <= 3.0
+    assert histogram.to_dict()['buckets']['0.025'] == 90
+
+    fanout = Histogram(FANOUT_BUCKETS)
+    fanout.observe(100)
+    assert fanout.to_dict()['buckets']['inf'] == 1
+    assert 64 < fanout.quantile(0.5) <= 100
+
+
+def test_snapshot_rates_and_labels(clock):
+    metrics = Metrics(clock)
+    metrics.incr('responses', status=200)
+    metrics.incr('responses', 3, status=200)
+    with metrics.timer('db_write_seconds', stage='page'):
+        pass
+    clock.now = 2
+    first = metrics.snapshot()
+    assert first['counters'] == {metric_name('responses', {'status': 200}): 4}
+    assert first['rates']['responses{status=200}'] == 2
+    assert first['histograms']['db_write_seconds{stage=page}']['count'] == 1
+
+    metrics.incr('responses', 10, status=200)
+    clock.now = 4
+    assert metrics.snapshot(since=first)['rates']['responses{status=200}'] == 5
+
+
+def test_snapshots_on_disk_and_over_http(tmp_path):
+    metrics = Metrics()
+    metrics.incr('pages_scraped', 7)
+    path = str(tmp_path / 'metrics.json')
+    writer = SnapshotWriter(path, interval=60, metrics=metrics)
+    writer.start()
+    writer.stop()
+    with open(path) as f:
+        assert json.load(f)['counters'] == {'pages_scraped': 7}
+
+    server = serve_metrics(0, metrics=metrics)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as resp:
+            assert json.load(resp)['counters'] == {'pages_scraped': 7}
+    finally:
+        server.shutdown()
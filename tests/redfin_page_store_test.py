@@ -0,0 +1,75 @@
+import json
+import os
+import sqlite3
+
+import redfin_crawler
+from redfin_listings import parse_pages
+from redfin_page_store import PageStore, read_page
+from redfin_storage import connect, migrate, move_listings_to_store, save_listings
+
+
+def _page(i):
+    return json.dumps([{'url': '/home/{}'.format(i), 'address': {'streetAddress': '{} Main St'.format(i)}}])
+
+
+def test_put_dedupes_and_rolls_over_segments(tmp_path):
+    conn = connect(str(tmp_path / 'pages.db'))
+    migrate(conn)
+    store = PageStore(str(tmp_path / 'pages'), conn, segment_size=200)
+
+    keys = [store.put(_page(i)) for i in range(5)]
+    assert store.put(_page(0)) == keys[0]
+    assert conn.execute('SELECT COUNT(*) FROM PAGE_STORE').fetchone()[0] == 5
+    assert len(os.listdir(str(tmp_path / 'pages'))) > 1
+    assert [store.get(key) for key in keys] == [_page(i) for i in range(5)]
+    store.close()
+
+    # A new store appends after the existing segments.
+    store = PageStore(str(tmp_path / 'pages'), conn, segment_size=200)
+    key = store.put(_page(5))
+    store.close()
+    assert read_page(store.ref(*conn.execute(
+        'SELECT SEGMENT, OFFSET, LENGTH FROM PAGE_STORE WHERE HASH = ?', (key,)).fetchone())) == _page(5)
+
+
+def test_listings_moved_to_store_still_parse(tmp_path):
+    conn = connect(str(tmp_path / 'pages.db'))
+    migrate(conn)
+    save_listings(conn, [('page-1', _page(1)), ('page-2', _page(2))])
+    store = PageStore(str(tmp_path / 'pages'), conn)
+    save_listings(conn, [('page-3', _page(1))], store)
+
+    assert move_listings_to_store(conn, store) == 2
+    assert move_listings_to_store(conn, store) == 0
+    rows = conn.execute("""
+        SELECT L.URL, S.SEGMENT, S.OFFSET, S.LENGTH
+        FROM LISTINGS L JOIN PAGE_STORE S ON L.PAGE_HASH = S.HASH
+        WHERE L.INFO IS NULL ORDER BY L.URL""").fetchall()
+    assert [url for url, *_ in rows] == ['page-1', 'page-2', 'page-3']
+    details = parse_pages([(url, store.ref(*location)) for url, *location in rows])
+    assert sorted(d[0] for d in details) == ['/home/1', '/home/2']
+    store.close()
+
+
+def test_compaction_keeps_pages_ahead_of_the_parse_high_water_mark(crawl_paths):
+    def parsed():
+        with sqlite3.connect(crawl_paths) as db:
+            urls = {row[0] for row in db.execute('SELECT URL FROM LISTING_DETAILS')}
+            db.execute('DELETE FROM LISTING_DETAILS')
+        return urls
+
+    with connect(crawl_paths) as db:
+        save_listings(db, [('page-{}'.format(i), _page(i)) for i in range(1, 5)])
+        db.execute("DELETE FROM LISTINGS WHERE URL IN ('page-1', 'page-2')")
+    redfin_crawler.parse_addresses(workers=1)
+    assert parsed() == {'/home/3', '/home/4'}
+
+    redfin_crawler.compact_listings()
+    with connect(crawl_paths) as db:
+        save_listings(db, [('page-5', _page(5))])
+    redfin_crawler.parse_addresses(workers=1)
+    assert parsed() == {'/home/5'}
+    redfin_crawler.parse_addresses(workers=1)
+    assert parsed() == set()
+    redfin_crawler.parse_addresses(workers=1, full=True)
+    assert parsed() == {'/home/3', '/home/4', '/home/5'}
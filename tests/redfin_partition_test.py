@@ -0,0 +1,39 @@
+from redfin_partition import FilterRange, Partition
+
+BASE = 'https://www.redfin.com/city/17420/CA/San-Jose/'
+
+
+def test_partition_round_trips_through_url():
+    url = BASE + 'filter/include=sold-3yr,min-price=100000,max-price=101000,min-sqft=100-sqft,max-sqft=110-sqft'
+    partition = Partition.from_url(url)
+    assert partition.base_url == BASE
+    assert partition.ranges == (FilterRange('price', 100000, 101000), FilterRange('sqft', 100, 110))
+    assert partition.url == url
+    assert Partition.from_url(BASE).url == BASE
+    assert partition.params() == {'min_price': 100000, 'max_price': 101000, 'min_sqft': 100, 'max_sqft': 110}
+
+
+def test_partition_is_hashable_and_canonical():
+    a = Partition(BASE, ()).with_range('sqft', 100, 110).with_range('price', 1000, 2000)
+    b = Partition.from_params(BASE, min_price=1000, max_price=2000, min_sqft=100, max_sqft=110)
+    assert a == b and len({a, b}) == 1
+    assert a.get('year') is None
+    assert a.sibling_key('sqft') == (FilterRange('price', 1000, 2000),)
+    assert a.with_range('price', 2000, 3000).url == BASE + (
+        'filter/include=sold-3yr,min-price=2000,max-price=3000,min-sqft=100-sqft,max-sqft=110-sqft')
+
+
+def test_beds_are_half_open_ranges():
+    assert Partition(BASE, ()).with_range('beds', 0, 1).url == BASE + 'filter/include=sold-3yr,max-beds=0'
+    assert Partition(BASE, ()).with_range('beds', 2, 3).url == BASE + 'filter/include=sold-3yr,min-beds=2,max-beds=2'
+    assert Partition(BASE, ()).with_range('beds', 5, 6).url == BASE + 'filter/include=sold-3yr,min-beds=5'
+    for lo in range(6):
+        partition = Partition(BASE, ()).with_range('beds', lo, lo + 1)
+        assert Partition.from_url(partition.url) == partition
+
+
+def test_outer_ends_stay_open():
+    assert Partition(BASE, ()).with_range('sqft', 10, 12000) == Partition(BASE, ())
+    partition = Partition(BASE, ()).with_range('sqft', 10, 500).with_range('year', 2000, 2018)
+    assert partition.url == BASE + 'filter/include=sold-3yr,max-sqft=500-sqft,min-year-built=2000'
+    assert Partition.from_url(partition.url) == partition
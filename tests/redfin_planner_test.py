@@ -0,0 +1,65 @@
+from redfin_planner import DensityModel, expected_largest, plan_seed, plan_split, shape_distance
+
+
+def unit(x):
+    return 1
+
+
+def test_plan_split_uniform():
+    # 1000 listings with a limit of 100 need ceil(1000 / 70) = 15 children.
+    assert len(plan_split(0, 1500, 1000, 100, unit)) == 15
+    assert plan_split(0, 100, 120, 100, unit) == [(0, 50), (50, 100)]
+    assert plan_split(0, 1, 500, 100, unit) == [(0, 1)]
+
+
+def test_plan_split_follows_density():
+    density = DensityModel()
+    # Siblings under another filter: 90% of the listings in the lower half.
+    density.observe('price', ('other',), 0, 50, 900)
+    density.observe('price', ('other',), 50, 100, 100)
+    shape = density.shape('price', 0, 100)
+    assert shape == [(0, 50, 0.9), (50, 100, 0.1)]
+    assert plan_split(0, 100, 140, 100, unit, shape) == [(0, 28), (28, 100)]
+
+
+def test_density_shape_needs_informative_siblings():
+    density = DensityModel()
+    density.observe('price', (), 0, 100, 1000)
+    assert density.shape('price', 0, 100) is None
+    density.observe('price', ('a',), 0, 60, 10)
+    # Does not cover the whole range.
+    assert density.shape('price', 0, 100) is None
+    density.observe('price', ('a',), 60, 100, 30)
+    assert density.shape('price', 0, 100) == [(0, 60, 0.25), (60, 100, 0.75)]
+
+
+def test_density_shape_prefers_children_over_parents():
+    density = DensityModel()
+    # A whole partition tree in one sibling set, as read back from URLS.
+    density.observe('price', (), 0, 100, 1000)
+    density.observe('price', (), 0, 50, 800)
+    density.observe('price', (), 50, 100, 200)
+    assert density.shape('price', 0, 100) == [(0, 50, 0.8), (50, 100, 0.2)]
+    assert density.shape('price', 0, 100, skip={()}) is None
+
+
+def test_plan_seed_merges_sparse_and_splits_dense_bins():
+    bins = [(0, 10, 0.04), (10, 20, 0.02), (20, 30, 0.04), (30, 40, 0.7), (40, 100, 0.2)]
+    # 1000 listings, about 70 per range.
+    ranges = plan_seed(bins, 1000, 100, unit)
+    assert ranges[:2] == [(0, 20), (20, 30)]
+    assert len([r for r in ranges if 30 <= r[0] < 40]) == 10
+    assert ranges[-3:] == [(40, 60), (60, 80), (80, 100)]
+    assert plan_seed(bins, 10, 100, unit) == [(0, 100)]
+
+
+def test_shape_distance():
+    bins = [(0, 50, 0.9), (50, 100, 0.1)]
+    assert shape_distance(bins, bins) == 0
+    assert abs(shape_distance(bins, [(0, 100, 1.0)]) - 0.4) < 1e-9
+
+
+def test_expected_largest():
+    assert expected_largest([(0, 50), (50, 100)], 100, [(0, 50, 0.9), (50, 100, 0.1)]) == 90
+    # Without a shape the split is assumed to be uneven.
+    assert expected_largest([(0, 50), (50, 100)], 100) == 75
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from redfin_proxy_pool import ProxyPool
+from redfin_rate_limit import NoProxyAvailableException, RateScheduler
+
+
+def test_blocked_proxy_cools_down(clock):
+    pool = ProxyPool(['a', 'b'], cooldown=10, clock=clock)
+    pool.record(0, 403, 0.5)
+    assert not pool.is_available(0)
+    assert pool.choose([0, 1]) == 1
+    assert pool.cooldown_remaining(0) == 10
+    clock.now = 10
+    assert pool.is_available(0)
+    pool.record(0, 429, 0.5)
+    assert pool.stats[0].cooldown_until == 30
+
+
+def test_failing_proxy_is_ejected_for_a_while(clock):
+    pool = ProxyPool(['a', 'b'], max_consecutive_failures=3, eject_cooldown=100, clock=clock)
+    for status in (None, 502, 407):
+        pool.record(1, status)
+    assert pool.is_ejected(1)
+    assert pool.choose([0, 1]) == 0
+    clock.now = 100
+    assert pool.is_available(1) and pool.stats[1].requests == 0
+
+
+def test_target_errors_do_not_count_against_the_proxy():
+    pool = ProxyPool(['a'], max_consecutive_failures=3, min_requests=3)
+    for _ in range(10):
+        pool.record(0, 503)
+        pool.record(0, 404)
+    assert not pool.is_ejected(0)
+    assert pool.stats[0].success_rate > 0.9
+
+
+def test_fast_proxies_get_more_weight():
+    pool = ProxyPool(['fast', 'slow'], rng=random.Random(0))
+    for _ in range(5):
+        pool.record(0, 200, 0.1)
+        pool.record(1, 200, 2.0)
+    picks = [pool.choose([0, 1]) for _ in range(200)]
+    assert picks.count(0) > 150
+
+
+def test_scheduler_raises_without_live_proxies(clock):
+    pool = ProxyPool(['a'], max_consecutive_failures=1, clock=clock)
+    scheduler = RateScheduler(pool.proxies, proxy_rps=1, global_rps=0, clock=clock, pool=pool)
+    index = scheduler._try_acquire_index()
+    scheduler.record(index, None)
+    clock.now = 5
+    with pytest.raises(NoProxyAvailableException):
+        scheduler.try_acquire()
+
+
+def test_scheduler_avoids_excluded_proxies(clock):
+    pool = ProxyPool(['a', 'b'], clock=clock)
+    scheduler = RateScheduler(pool.proxies, proxy_rps=1, global_rps=0, clock=clock, pool=pool)
+    assert scheduler.try_acquire(exclude={0}) == 'b'
+    assert scheduler.try_acquire(exclude={0}) is None
+    assert scheduler.wait_time(exclude={0}) == 1
+    assert scheduler.try_acquire(exclude={0, 1}) == 'a'
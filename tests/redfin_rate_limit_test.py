@@ -0,0 +1,27 @@
+from redfin_rate_limit import TokenBucket, RateScheduler
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(2, capacity=1, clock=clock)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.wait_time() == 0.5
+    clock.now = 0.5
+    assert bucket.try_acquire()
+
+
+def test_scheduler_prefers_proxies_with_budget(clock):
+    scheduler = RateScheduler(['a', 'b', 'c'], proxy_rps=1, global_rps=0, clock=clock)
+    assert sorted(scheduler.try_acquire() for _ in range(3)) == ['a', 'b', 'c']
+    assert scheduler.try_acquire() is None
+    assert scheduler.wait_time() == 1
+    clock.now = 1
+    assert scheduler.try_acquire() is not None
+
+
+def test_scheduler_global_budget(clock):
+    scheduler = RateScheduler(['a', 'b', 'c'], proxy_rps=1, global_rps=2, burst=2, clock=clock)
+    assert scheduler.try_acquire() is not None
+    assert scheduler.try_acquire() is not None
+    assert scheduler.try_acquire() is None
+    assert scheduler.wait_time() == 0.5
@@ -0,0 +1,61 @@
+import logging
+import sqlite3
+
+from redfin_storage import (MIGRATIONS, connect, load_density_cache, migrate, prefix_range, save_density_cache,
+                            save_page_infos)
+
+
+def test_migrate_upgrades_old_schema(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE URLS (URL TEXT NOT NULL, NUM_PROPERTIES INT, NUM_PAGES INT, PER_PAGE_PROPERTIES INT)')
+    conn.execute('CREATE TABLE LISTING_DETAILS (URL TEXT NOT NULL, NUMBER_OF_ROOMS INT, NAME TEXT, COUNTRY TEXT, '
+                 'REGION TEXT, LOCALITY TEXT, STREET TEXT, POSTOAL TEXT, TYPE TEXT, PRICE REAL)')
+    conn.executemany('INSERT INTO URLS VALUES (?, ?, ?, ?)', [('a', 1, 1, 20), ('a', 2, 1, 20), ('b', 3, 1, 20)])
+    conn.executemany('INSERT INTO LISTING_DETAILS (URL, POSTOAL) VALUES (?, ?)', [('x', '1'), ('x', '2')])
+    conn.execute('CREATE TABLE LISTINGS (URL TEXT NOT NULL, INFO TEXT)')
+    conn.executemany('INSERT INTO LISTINGS VALUES (?, ?)', [('p1', '[]'), ('p2', '[]'), ('p3', '[]')])
+    conn.execute("DELETE FROM LISTINGS WHERE URL = 'p2'")
+    conn.commit()
+    conn.close()
+
+    conn = connect(path)
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('SELECT URL, NUM_PROPERTIES FROM URLS ORDER BY URL').fetchall() == [('a', 2), ('b', 3)]
+    assert conn.execute('SELECT URL, POSTAL FROM LISTING_DETAILS').fetchall() == [('x', '2')]
+    # LISTINGS rowids are kept as ID, which VACUUM may not renumber.
+    conn.execute('VACUUM')
+    assert conn.execute('SELECT ID, rowid, URL FROM LISTINGS').fetchall() == [(1, 1, 'p1'), (3, 3, 'p3')]
+
+    save_page_infos(conn, [('a', 5, 1, 20), ('c', None, 1, 20)])
+    assert conn.execute('SELECT URL, NUM_PROPERTIES FROM URLS ORDER BY URL').fetchall() == [
+        ('a', 5), ('b', 3), ('c', None)]
+    # Running the migrations again is a no-op.
+    assert migrate(conn) == len(MIGRATIONS)
+
+
+def test_new_database_needs_no_rebuilds(tmp_path, caplog):
+    conn = connect(str(tmp_path / 'new.db'))
+    with caplog.at_level(logging.WARNING):
+        migrate(conn)
+    assert caplog.records == []
+    assert [row[1] for row in conn.execute('PRAGMA table_info(LISTINGS)')] == ['ID', 'URL', 'INFO', 'PAGE_HASH']
+
+
+def test_prefix_range():
+    low, high = prefix_range('https://www.redfin.com/city/1362/')
+    assert low <= 'https://www.redfin.com/city/1362/filter/min-price=1' < high
+    assert not (low <= 'https://www.redfin.com/city/13620/' < high)
+
+
+def test_density_cache_falls_back_to_other_regions(tmp_path):
+    conn = connect(str(tmp_path / 'cache.db'))
+    migrate(conn)
+    save_density_cache(conn, 'a', 'price', [(0, 10, 0.5), (10, 20, 0.5)])
+    save_density_cache(conn, 'b', 'price', [(0, 20, 1.0)])
+    assert load_density_cache(conn, 'a') == [('a', 'price', 0, 10, 0.5), ('a', 'price', 10, 20, 0.5)]
+    assert len(load_density_cache(conn, 'c')) == 3
+    save_density_cache(conn, 'a', 'price', [(0, 20, 1.0)])
+    assert load_density_cache(conn, 'a') == [('a', 'price', 0, 20, 1.0)]
@@ -1,9 +1,11 @@
 import requests
 import time
 import argparse
-import fake_useragent
+import logging
 import pandas as pd
 
+LOGGER = logging.getLogger(__name__)
+
 TOTAL_TRIES_PER_URL = 2
 URL = 'https://www.redfin.com/city/1362/CA/Belmont/filter/include=sold-3yr,min-price=500000'
 
@@ -21,23 +23,32 @@ def build_proxies(ip_addr, port, user=None, password=None):
     }
 
 
-def time_proxy(ip_addr, port, proxy_user=None, proxy_pass=None,  url='https://www.google.com', timeout=10):
+def check_proxy(pull_proxies, url='https://www.google.com', headers=None, timeout=10, tries=TOTAL_TRIES_PER_URL):
+    """Visit url tries times through pull_proxies.
+    Return (success counts, tries, total time in seconds).
+    """
     success_counts = 0
     start = time.time()
-    ua = fake_useragent.UserAgent()
-
-    pull_proxies = build_proxies(ip_addr, port, proxy_user, proxy_pass)
-    for i in range(TOTAL_TRIES_PER_URL):
+    for i in range(tries):
         try:
-            r = requests.get(url, proxies=pull_proxies, headers={'User-agent': ua.chrome}, timeout=timeout)
+            r = requests.get(url, proxies=pull_proxies, headers=headers, timeout=timeout)
             if r.status_code == 200:
                 success_counts += 1
         except Exception as e:
-            print(e)
+            LOGGER.warning('Proxy check of {} failed: {!r}'.format(url, e))
+    return success_counts, tries, time.time() - start
+
+
+def time_proxy(ip_addr, port, proxy_user=None, proxy_pass=None,  url='https://www.google.com', timeout=10):
+    import fake_useragent
+    ua = fake_useragent.UserAgent()
+
+    pull_proxies = build_proxies(ip_addr, port, proxy_user, proxy_pass)
+    success_counts, tries, total_time = check_proxy(pull_proxies, url, {'User-agent': ua.chrome}, timeout)
 
     print('for proxy {}'.format(pull_proxies))
-    print('total time {} for visiting {} times'.format(time.time() - start, TOTAL_TRIES_PER_URL))
-    print('success rate = {}'.format(success_counts / TOTAL_TRIES_PER_URL))
+    print('total time {} for visiting {} times'.format(total_time, tries))
+    print('success rate = {}'.format(success_counts / tries))
 
 
 def time_no_proxy(url='https://www.google.com'):
@@ -61,6 +72,7 @@ if __name__ == '__main__':
              'Or just contain ip_addr,port columns if no auth needed.'
     )
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     proxies = pd.read_csv(args.proxy_csv_path, encoding='utf-8').values
     for proxy_info in proxies: